@@ -0,0 +1,507 @@
+#!/usr/bin/env python
+# Landmark alignment solver, Python counterpart of AlignmentSolver in Landmark.cs.
+#
+# Given a set of reference points in the local tangent plane (the sky coordinate
+# system, +Y up), and a set of observations (head position + view direction) in
+# the SK world coordinate system, compute a rotation in Y followed by translation
+# in XZ that maps the reference points onto the observations.
+#
+# Used by calib-fd.py. The annealing chains are plain functions of their inputs
+# (including the random seed), so they can be run in a process pool.
+#
+# compute_energy() is a direct translation of ComputeEnergy() in the app. The
+# ObservationSet class computes the same energy, but with the observations
+# grouped per landmark in NumPy arrays, so it scales to thousands of observations.
+import os, math, json
+from math import sqrt, radians, sin, cos, exp
+from random import Random
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+def line_point_distance_xz(p, q, t):
+    """Return closest distance between 3D point t
+    and the line between points p and q *in the XZ plane*"""
+
+    x1 = p[0]
+    y1 = p[1]
+    z1 = p[2]
+
+    x2 = q[0]
+    y2 = q[1]
+    z2 = q[2]
+
+    x0 = t[0]
+    y0 = t[1]
+    z0 = t[2]
+
+    num = abs((x2-x1)*(z1-z0) - (x1-x0)*(z2-z1))
+    den = sqrt((x2-x1)**2 + (z2-z1)**2)
+    return num/den
+
+def behind_xz(p, q, t):
+    """Return if point t is behind the observer at p (who is viewing from p to q).
+    Ignores Y"""
+    v = (q[0]-p[0], q[1]-p[1], q[2]-p[2])
+    w = (t[0]-p[0], t[1]-p[1], t[2]-p[2])
+    return v[0]*w[0] + v[2]*w[2] < 0
+
+def rot_y(p, angle_degrees):
+    """Positive rotation = CCW"""
+    a = radians(angle_degrees)
+    cos_a = cos(a)
+    sin_a = sin(a)
+
+    qx = cos_a*p[0] + sin_a*p[2]
+    qz = -sin_a*p[0] + cos_a*p[2]
+
+    return (qx, p[1], qz)
+
+def compute_energy(ground_truth, observations, tx, ty, tz, r):
+    """Returns RMS in meters"""
+
+    e2 = 0.0
+    n = 0
+
+    for ref_name, ref_position in ground_truth.items():
+
+        r2 = rot_y(ref_position, r)
+        r2 = (r2[0] + tx, r2[1] + ty, r2[2] + tz)
+
+        for observation in observations:
+            if observation['lm'] != ref_name:
+                # XXX yuck
+                continue
+            ob_origin = observation['head_pos']
+            ob_direction = observation['head_ori']
+            ob2 = (ob_origin[0] + ob_direction[0], ob_origin[1] + ob_direction[1], ob_origin[2] + ob_direction[2])
+            dist = line_point_distance_xz(ob_origin, ob2, r2)
+
+            # Penalize solution when point is behind, as seen along viewing direction
+            if behind_xz(ob_origin, ob2, r2):
+                dist += 1000
+
+            e2 += dist*dist
+
+        n += 1
+
+        if n == 0:
+            print('WARNING: no observations for "%s"' % ref_name)
+
+    return sqrt(e2/n)
+
+def load_observations(fname):
+    """Load observations from a JSONL file, one observation per line, e.g.
+    {"lm":"HKB","head_pos":[-0.144786, 0.057414, 0.179659],"head_ori":[0.166631, 0.251750, 0.953340]}
+    Empty lines and lines starting with # are skipped"""
+
+    observations = []
+    with open(fname, 'rt') as f:
+        for lineno, line in enumerate(f):
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            ob = json.loads(line)
+            if 'lm' not in ob or 'head_pos' not in ob or 'head_ori' not in ob:
+                print('WARNING: %s:%d: incomplete observation, ignoring' % (fname, lineno+1))
+                continue
+            observations.append(ob)
+
+    return observations
+
+def load_ground_truth(fname):
+    """Load reference points from a ground truth file made by make_ground_truth.py,
+    returns { landmark id: (x, y, z) } (meters, StereoKit axes, i.e. +Y up)"""
+
+    with open(fname, 'rt') as f:
+        ground_truth = json.load(f)
+    return dict((name, tuple(p)) for name, p in ground_truth['points'].items())
+
+
+
+class ObservationSet:
+
+    """
+    Observations grouped by landmark into contiguous arrays, built once
+    up front, so an energy evaluation is a single pass over all observations.
+    Observations of landmarks not in the ground truth are ignored.
+    """
+
+    def __init__(self, ground_truth, observations):
+        self.names = list(ground_truth.keys())
+        self.reference_points = np.array([ground_truth[name] for name in self.names], dtype=np.float64)
+        index = { name: i for i, name in enumerate(self.names) }
+
+        obs = [ob for ob in observations if ob['lm'] in index]
+        # Stable sort on landmark, so each landmark's observations are contiguous
+        obs.sort(key=lambda ob: index[ob['lm']])
+
+        self.landmark_index = np.array([index[ob['lm']] for ob in obs], dtype=np.int32)
+        self.origins = np.array([ob['head_pos'] for ob in obs], dtype=np.float64).reshape(-1, 3)
+        self.directions = np.array([ob['head_ori'] for ob in obs], dtype=np.float64).reshape(-1, 3)
+
+        # Observation range [offsets[i], offsets[i+1]) per landmark
+        counts = np.bincount(self.landmark_index, minlength=len(self.names))
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+
+        if len(obs) > 0:
+            for name, count in zip(self.names, counts):
+                if count == 0:
+                    print('WARNING: no observations for "%s"' % name)
+
+        # Same normalization as compute_energy(), i.e. per landmark
+        self.n = len(self.names)
+
+        self.direction_length_xz = np.hypot(self.directions[:,0], self.directions[:,2])
+
+    def __len__(self):
+        return len(self.landmark_index)
+
+    def add(self, observation):
+        """Add a single observation, keeping the per-landmark grouping.
+        Returns False if the observation is for an unknown landmark."""
+
+        if observation['lm'] not in self.names:
+            return False
+
+        i = self.names.index(observation['lm'])
+        pos = self.offsets[i+1]
+
+        self.landmark_index = np.insert(self.landmark_index, pos, i)
+        self.origins = np.insert(self.origins, pos, observation['head_pos'], axis=0)
+        self.directions = np.insert(self.directions, pos, observation['head_ori'], axis=0)
+        self.direction_length_xz = np.insert(self.direction_length_xz, pos,
+            math.hypot(observation['head_ori'][0], observation['head_ori'][2]))
+        self.offsets[i+1:] += 1
+
+        return True
+
+    def landmark_count(self):
+        """Number of landmarks that have at least one observation"""
+        return np.count_nonzero(np.diff(self.offsets))
+
+    def landmark_observations(self, name):
+        """Return (origins, directions) arrays of the given landmark"""
+        i = self.names.index(name)
+        s = slice(self.offsets[i], self.offsets[i+1])
+        return self.origins[s], self.directions[s]
+
+    def distances(self, tx, ty, tz, r):
+        """Per-observation distance in the XZ plane, including the penalty
+        for landmarks behind the observer. tx, ty, tz, r can be scalars,
+        or arrays of K candidate transforms, giving shape (K, M)."""
+
+        tx = np.asarray(tx, dtype=np.float64)[..., None]
+        tz = np.asarray(tz, dtype=np.float64)[..., None]
+        a = np.radians(np.asarray(r, dtype=np.float64))[..., None]
+        cos_a = np.cos(a)
+        sin_a = np.sin(a)
+
+        # Transformed reference points, then one per observation
+        g = self.reference_points
+        px = (cos_a*g[:,0] + sin_a*g[:,2] + tx)[..., self.landmark_index]
+        pz = (-sin_a*g[:,0] + cos_a*g[:,2] + tz)[..., self.landmark_index]
+
+        ox = self.origins[:,0]
+        oz = self.origins[:,2]
+        dx = self.directions[:,0]
+        dz = self.directions[:,2]
+
+        dist = np.abs(dx*(oz-pz) - (ox-px)*dz) / self.direction_length_xz
+
+        # Penalize solution when point is behind, as seen along viewing direction
+        dist += 1000 * (dx*(px-ox) + dz*(pz-oz) < 0)
+
+        return dist
+
+    def energy(self, tx, ty, tz, r):
+        """Returns RMS in meters, same value as compute_energy()"""
+        dist = self.distances(tx, ty, tz, r)
+        return sqrt(np.dot(dist, dist) / self.n)
+
+    def energy_batch(self, tx, ty, tz, r):
+        """Returns RMS for each of the K candidate transforms in arrays tx, ty, tz, r"""
+        dist = self.distances(tx, ty, tz, r)
+        return np.sqrt(np.einsum('km,km->k', dist, dist) / self.n)
+
+    def residuals(self, tx, tz, r):
+        """Signed per-observation distances in the XZ plane (without the
+        behind penalty), plus their Jacobian w.r.t. (tx, tz, r)"""
+
+        a = radians(r)
+        cos_a = cos(a)
+        sin_a = sin(a)
+
+        g = self.reference_points
+        gx = g[self.landmark_index, 0]
+        gz = g[self.landmark_index, 2]
+        px = cos_a*gx + sin_a*gz + tx
+        pz = -sin_a*gx + cos_a*gz + tz
+
+        ox = self.origins[:,0]
+        oz = self.origins[:,2]
+        dx = self.directions[:,0]
+        dz = self.directions[:,2]
+        L = self.direction_length_xz
+
+        e = (dx*(oz-pz) - (ox-px)*dz) / L
+
+        J = np.empty((len(e), 3))
+        J[:,0] = dz / L
+        J[:,1] = -dx / L
+        # d(px)/da = pz - tz, d(pz)/da = -(px - tx), with r in degrees
+        J[:,2] = (dz*(pz-tz) + dx*(px-tx)) / L * radians(1)
+
+        return e, J
+
+
+def anneal(observation_set, seed=None, K=50000, WO=2000, verbose=False):
+    """
+    Simulated annealing for the transformation rot(R) followed by T(tx,ty,tz).
+    Uses its own random generator, so runs with the same seed are reproducible.
+
+    Returns (energy, tx, ty, tz, r)
+    """
+
+    rng = Random(seed)
+
+    def rand_unit():
+        return (rng.random()-0.5)*2
+
+    tx = 0.0
+    ty = 0.0
+    tz = 0.0
+    r = 0.0
+
+    best_tx = tx
+    best_ty = ty
+    best_tz = tz
+    best_r = r
+    compute_energy = observation_set.energy
+
+    best_energy = compute_energy(tx, ty, tz, r)
+    if verbose:
+        print('[initial] Energy %.6f | tx=%.6f, ty=%.6f, tz=%.6f, r=%.6f' % \
+            (best_energy, best_tx, best_ty, best_tz, best_r))
+
+    without_improvement = 0
+
+    for k in range(0, K):
+
+        T = 1 - (k+1)/K
+
+        # Pick neighbour
+        can_tx = tx
+        can_ty = ty
+        can_tz = tz
+        can_r = r
+
+        idx = rng.randint(0, 2)
+        if idx == 0:
+            can_tx = tx + rand_unit()*2000*T
+        # NOTE: ty never mutated
+        elif idx == 1:
+            can_tz = tz + rand_unit()*2000*T
+        elif idx == 2:
+            can_r = (r + rand_unit()*360*T) % 360
+        #elif idx == 3:
+        #    # Negate all values
+        #    can_tx = -tx
+        #    can_tz = -tz
+        #    can_r = -r
+
+        energy = compute_energy(can_tx, can_ty, can_tz, can_r)
+
+        if energy < best_energy:
+            if verbose:
+                print('[%05d] Energy %8.3f (new best)         | tx=%.6f, ty=%.6f, tz=%6f, r=%.6f' % \
+                    (k, energy, can_tx, can_ty, can_tz, can_r))
+            best_energy = energy
+            best_tx = can_tx
+            best_ty = can_ty
+            best_tz = can_tz
+            best_r = can_r
+            without_improvement = 0
+            tx = can_tx
+            ty = can_ty
+            tz = can_tz
+            r = can_r
+        elif T > 0:
+            without_improvement += 1
+            if without_improvement == WO:
+                # Restart with last best solution
+                if verbose:
+                    print('[%05d] %d steps without improvement, restarting' % (k, WO))
+                tx = best_tx
+                ty = best_ty
+                tz = best_tz
+                r = best_r
+                without_improvement = 0
+                continue
+
+            p = exp(-(energy-best_energy)/T)
+            if rng.random() <= p:
+                tx = can_tx
+                ty = can_ty
+                tz = can_tz
+                r = can_r
+
+    return (best_energy, best_tx, best_ty, best_tz, best_r)
+
+def angle_difference(a, b):
+    """Smallest difference between two angles in degrees, in [0, 180]"""
+    d = abs(a - b) % 360
+    return min(d, 360 - d)
+
+def multi_start(observation_set, chains, seed=0, processes=None, K=50000, WO=2000):
+    """
+    Run independent annealing chains, with seeds seed, seed+1, ..., in a
+    process pool (by default one process per CPU core).
+
+    Returns the list of chain results (seed, energy, tx, ty, tz, r), sorted
+    on energy, i.e. the best solution first.
+    """
+
+    if processes is None:
+        processes = os.cpu_count()
+    seeds = [seed + i for i in range(chains)]
+
+    with ProcessPoolExecutor(max_workers=min(processes, chains)) as pool:
+        futures = [pool.submit(anneal, observation_set, s, K, WO) for s in seeds]
+        results = [(s,) + f.result() for s, f in zip(seeds, futures)]
+
+    results.sort(key=lambda res: res[1])
+    return results
+
+def chain_spread(results, position_tolerance=1.0, angle_tolerance=1.0):
+    """
+    Summarize the spread of multi_start() results, as a confidence measure.
+    Returns a dict with the energy range, the standard deviation of the
+    solution parameters, and the fraction of chains that agree with the best
+    solution (within the given tolerances in meters and degrees).
+    """
+
+    n = len(results)
+    energies = [res[1] for res in results]
+    best = results[0]
+
+    def stddev(values):
+        mean = sum(values) / n
+        return sqrt(sum((v-mean)**2 for v in values) / n)
+
+    # Rotation spread relative to the best solution, to handle wrap-around at 360
+    r_offsets = [angle_difference(res[5], best[5]) for res in results]
+
+    agree = 0
+    for res in results:
+        d = math.hypot(res[2]-best[2], res[4]-best[4])
+        if d <= position_tolerance and angle_difference(res[5], best[5]) <= angle_tolerance:
+            agree += 1
+
+    return dict(
+        chains=n,
+        energy_min=min(energies),
+        energy_median=sorted(energies)[n//2],
+        energy_max=max(energies),
+        tx_std=stddev([res[2] for res in results]),
+        tz_std=stddev([res[4] for res in results]),
+        r_std=sqrt(sum(d*d for d in r_offsets) / n),
+        agreement=agree / n
+    )
+
+
+def refine(observation_set, start, radius=5.0, angle_radius=2.0, candidates=32, iterations=10, rng=None):
+    """
+    Local search around a (tx, ty, tz, r) start solution. First a single batch
+    of random candidates within radius (meters) and angle_radius (degrees) is
+    scored, then the best one is polished with Gauss-Newton iterations.
+    ty is left unchanged, as in anneal().
+
+    Returns (energy, tx, ty, tz, r)
+    """
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    tx, ty, tz, r = start
+
+    # Candidate 0 is the start solution itself
+    ctx = tx + rng.uniform(-radius, radius, candidates)
+    ctz = tz + rng.uniform(-radius, radius, candidates)
+    cr = r + rng.uniform(-angle_radius, angle_radius, candidates)
+    ctx[0], ctz[0], cr[0] = tx, tz, r
+
+    energies = observation_set.energy_batch(ctx, ty, ctz, cr)
+    best = np.argmin(energies)
+    energy, tx, tz, r = energies[best], ctx[best], ctz[best], cr[best]
+
+    for i in range(iterations):
+        e, J = observation_set.residuals(tx, tz, r)
+        step = np.linalg.lstsq(J, -e, rcond=None)[0]
+
+        # Step halving, as the behind penalty is not part of the model
+        accepted = False
+        for h in range(4):
+            can_energy = observation_set.energy(tx+step[0], ty, tz+step[1], r+step[2])
+            if can_energy < energy:
+                accepted = True
+                break
+            step *= 0.5
+
+        if not accepted:
+            break
+
+        tx += step[0]
+        tz += step[1]
+        r += step[2]
+        converged = energy - can_energy < 1e-9
+        energy = can_energy
+        if converged:
+            break
+
+    return (energy, float(tx), ty, float(tz), float(r) % 360)
+
+
+class IncrementalSolver:
+
+    """
+    Keeps a solution up-to-date while observations come in one at a time.
+    Each new observation triggers a refine() warm-started from the previous
+    best solution, instead of a full annealing run. Without a start solution
+    a single annealing run is done once observations of at least three
+    landmarks are available.
+    """
+
+    def __init__(self, ground_truth, start=None, radius=5.0, angle_radius=2.0, seed=None, K=50000, WO=2000):
+        self.observation_set = ObservationSet(ground_truth, [])
+        self.solution = None if start is None else tuple(start)
+        self.energy = None
+        self.radius = radius
+        self.angle_radius = angle_radius
+        self.seed = seed
+        self.K = K
+        self.WO = WO
+        self.rng = np.random.default_rng(seed)
+
+    def add(self, observation):
+        """
+        Add an observation and update the solution. Returns (energy, tx, ty, tz, r),
+        or None if there are not enough (known) observations yet for a solution.
+        """
+
+        if not self.observation_set.add(observation):
+            print('WARNING: observation of unknown landmark "%s", ignoring' % observation['lm'])
+            # A start solution has no energy until there are observations to measure it with
+            return None if self.energy is None else (self.energy,) + self.solution
+
+        if self.solution is None:
+            if self.observation_set.landmark_count() < 3:
+                return None
+            result = anneal(self.observation_set, self.seed, self.K, self.WO)
+        else:
+            result = refine(self.observation_set, self.solution, self.radius, self.angle_radius, rng=self.rng)
+
+        self.energy = result[0]
+        self.solution = result[1:]
+
+        return result
+
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Time/space index on a state archive (see statearchive.py), to answer
+# "which aircraft were in this bbox between 14:00 and 14:30" and "the track
+# of this icao24 yesterday" by reading only the rows involved, instead of
+# scanning the full recording.
+#
+# Rows are grouped in time buckets of bucket_seconds (on snapshot time).
+# Within a bucket two orderings of the rows are stored, each as a sorted
+# key column plus the matching row numbers:
+#
+#   grid_keys.bin, grid_rows.bin    key bucket * GRID_CELLS + cell, with a
+#                                   global lat/lon grid of cell_size degrees
+#                                   numbered row by row (as in gridindex.py)
+#   track_keys.bin, track_rows.bin  key bucket * 2^24 + icao24
+#
+# Rows with the same key are in archive order, so the rows of one grid row
+# of cells, or of one aircraft, within a bucket form a single contiguous
+# range found by binary search on the (memory-mapped) keys. Rows without a
+# position are only in the track index.
+#
+# The index lives in an index/ subdirectory of the archive, as raw
+# little-endian int64 files plus meta.json. As the archive is append-only,
+# update() only re-sorts the last indexed bucket and the new rows. Rows the
+# index doesn't cover yet are scanned directly, so queries also see the
+# latest snapshots of an archive that is still being recorded.
+import os, json, math
+import numpy as np
+
+from statearchive import StateArchive, columns_to_states
+
+INDEX_VERSION = 1
+
+BUCKET_SECONDS = 600
+CELL_SIZE = 0.5
+
+TRACK_KEY_BITS = 24
+
+INDEX_COLUMNS = ['grid_keys', 'grid_rows', 'track_keys', 'track_rows']
+
+
+def index_directory(archive_directory):
+    return os.path.join(archive_directory, 'index')
+
+def grid_shape(cell_size):
+    """Rows and columns of the global grid"""
+    return int(math.ceil(180 / cell_size)), int(math.ceil(360 / cell_size))
+
+def grid_row_col(lat, lon, cell_size):
+    rows, cols = grid_shape(cell_size)
+    row = np.clip(np.floor((np.asarray(lat) + 90) / cell_size).astype(np.int64), 0, rows - 1)
+    col = np.clip(np.floor((np.asarray(lon) + 180) / cell_size).astype(np.int64), 0, cols - 1)
+    return row, col
+
+def _map(fname, count):
+    if count == 0:
+        return np.zeros(0, dtype='<i8')
+    return np.memmap(fname, dtype='<i8', mode='r', shape=(count,))
+
+def _ranges(keys, lo, hi):
+    """Concatenated positions of all entries with lo[i] <= key < hi[i]"""
+    start = np.searchsorted(keys, lo, side='left')
+    end = np.searchsorted(keys, hi, side='left')
+    counts = end - start
+    if counts.sum() == 0:
+        return np.zeros(0, dtype=np.int64)
+    # Positions start[i] .. end[i]-1 for each range, without a python loop
+    offsets = np.repeat(start - np.concatenate(([0], np.cumsum(counts)[:-1])), counts)
+    return np.arange(counts.sum(), dtype=np.int64) + offsets
+
+
+class ArchiveIndex:
+
+    """
+    Index on the StateArchive archive. Call update() to (incrementally)
+    build the index files, after which bbox() and track() answer queries
+    with row numbers into the archive.
+    """
+
+    def __init__(self, archive, bucket_seconds=BUCKET_SECONDS, cell_size=CELL_SIZE):
+        self.archive = archive
+        self.directory = index_directory(archive.directory)
+        self.bucket_seconds = bucket_seconds
+        self.cell_size = cell_size
+        self.grid_cells = grid_shape(cell_size)[0] * grid_shape(cell_size)[1]
+
+        # Number of rows examined by the last query
+        self.candidates = 0
+
+        self._load()
+
+    def _load(self):
+        self.rows = self.snapshots = 0
+        counts = dict((name, 0) for name in INDEX_COLUMNS)
+
+        fname = os.path.join(self.directory, 'meta.json')
+        if os.path.isfile(fname):
+            meta = json.load(open(fname, 'rt'))
+            if meta['version'] == INDEX_VERSION and meta['bucket_seconds'] == self.bucket_seconds \
+                    and meta['cell_size'] == self.cell_size and meta['rows'] <= self.archive.rows \
+                    and all(os.path.isfile(self._fname(name)) and os.path.getsize(self._fname(name)) == 8 * meta['entries'][name]
+                            for name in INDEX_COLUMNS):
+                self.rows = meta['rows']
+                self.snapshots = meta['snapshots']
+                counts = meta['entries']
+
+        for name in INDEX_COLUMNS:
+            setattr(self, name, _map(self._fname(name), counts[name]))
+
+    def _fname(self, name):
+        return os.path.join(self.directory, name + '.bin')
+
+    def up_to_date(self):
+        return self.rows == self.archive.rows
+
+    def _bucket(self, time):
+        return np.asarray(time, dtype=np.int64) // self.bucket_seconds
+
+    def _keys(self, rows, times):
+        """Grid and track keys (with the matching rows) of a range of rows"""
+        a = self.archive
+        buckets = self._bucket(times)
+
+        lat, lon = a.lat[rows], a.lon[rows]
+        positioned = np.isfinite(lat) & np.isfinite(lon)
+        row, col = grid_row_col(lat[positioned], lon[positioned], self.cell_size)
+        grid_keys = buckets[positioned] * self.grid_cells + row * grid_shape(self.cell_size)[1] + col
+        order = np.argsort(grid_keys, kind='stable')
+        grid = grid_keys[order], rows[positioned][order]
+
+        track_keys = (buckets << TRACK_KEY_BITS) + a.icao24[rows].astype(np.int64)
+        order = np.argsort(track_keys, kind='stable')
+        track = track_keys[order], rows[order]
+
+        return grid, track
+
+    def update(self, verbose=False):
+        """Index the rows added to the archive since the last update"""
+        a = self.archive
+        if self.up_to_date():
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Redo the last indexed bucket, as it may have been incomplete
+        first = grid = track = 0
+        if self.snapshots > 0:
+            bucket = int(self._bucket(a.snapshot_time[self.snapshots - 1]))
+            first = int(np.searchsorted(a.snapshot_time, bucket * self.bucket_seconds, side='left'))
+            grid = int(np.searchsorted(self.grid_keys, bucket * self.grid_cells))
+            track = int(np.searchsorted(self.track_keys, bucket << TRACK_KEY_BITS))
+        entries = dict(grid_keys=grid, grid_rows=grid, track_keys=track, track_rows=track)
+
+        # Drop the memory maps before truncating the files, and invalidate the
+        # index until all files are written
+        for name in INDEX_COLUMNS:
+            setattr(self, name, None)
+        fname = os.path.join(self.directory, 'meta.json')
+        if os.path.isfile(fname):
+            os.unlink(fname)
+
+        files = {}
+        for name in INDEX_COLUMNS:
+            f = open(self._fname(name), 'r+b' if os.path.isfile(self._fname(name)) else 'w+b')
+            f.truncate(8 * entries[name])
+            f.seek(0, os.SEEK_END)
+            files[name] = f
+
+        # One bucket at a time, the buckets are in key order
+        buckets = self._bucket(a.snapshot_time[first:])
+        bounds = first + np.concatenate(([0], np.nonzero(np.diff(buckets))[0] + 1, [len(buckets)]))
+        for s0, s1 in zip(bounds[:-1], bounds[1:]):
+            r0, r1 = int(a.snapshot_start[s0]), int(a.snapshot_end[s1 - 1])
+            rows = np.arange(r0, r1, dtype=np.int64)
+            times = np.repeat(a.snapshot_time[s0:s1], a.snapshot_end[s0:s1] - a.snapshot_start[s0:s1])
+            (grid_keys, grid_rows), (track_keys, track_rows) = self._keys(rows, times)
+            for name, values in [('grid_keys', grid_keys), ('grid_rows', grid_rows),
+                                 ('track_keys', track_keys), ('track_rows', track_rows)]:
+                files[name].write(values.astype('<i8').tobytes())
+                entries[name] += len(values)
+            if verbose:
+                print('Indexed snapshots %d-%d (%d rows)' % (s0, s1 - 1, r1 - r0))
+
+        for f in files.values():
+            f.close()
+
+        meta = dict(
+            version=INDEX_VERSION,
+            bucket_seconds=self.bucket_seconds,
+            cell_size=self.cell_size,
+            rows=int(a.rows),
+            snapshots=len(a),
+            entries=entries
+        )
+        json.dump(meta, open(fname, 'wt'), indent=4)
+
+        self._load()
+
+    def _buckets(self, start, end):
+        """Indexed buckets overlapping the time window (inclusive, None for unbounded)"""
+        a = self.archive
+        if self.snapshots == 0:
+            return np.zeros(0, dtype=np.int64)
+        first = int(self._bucket(a.snapshot_time[0] if start is None else max(start, a.snapshot_time[0])))
+        last = int(self._bucket(a.snapshot_time[self.snapshots - 1] if end is None else min(end, a.snapshot_time[self.snapshots - 1])))
+        return np.arange(first, last + 1, dtype=np.int64)
+
+    def _filter_time(self, rows, start, end):
+        times = self.archive.snapshot_time[self.archive.row_snapshots(rows)]
+        keep = np.ones(len(rows), dtype=bool)
+        if start is not None:
+            keep &= times >= start
+        if end is not None:
+            keep &= times <= end
+        return rows[keep]
+
+    def _unindexed(self, start, end):
+        """Rows added to the archive after the last update, within the time window"""
+        a = self.archive
+        if self.rows == a.rows:
+            return np.zeros(0, dtype=np.int64)
+        return self._filter_time(np.arange(self.rows, a.rows, dtype=np.int64), start, end)
+
+    def bbox(self, lamin, lamax, lomin, lomax, start=None, end=None):
+        """
+        Rows (in archive order) with a position within the bbox (bounds inclusive),
+        in snapshots with start <= time <= end
+        """
+        a = self.archive
+        buckets = self._buckets(start, end)
+        (r0, r1), (c0, c1) = grid_row_col([lamin, lamax], [lomin, lomax], self.cell_size)
+        grid_rows = np.arange(r0, r1 + 1, dtype=np.int64)
+
+        # One key range per bucket and grid row
+        base = (buckets[:, None] * self.grid_cells + grid_rows[None, :] * grid_shape(self.cell_size)[1]).ravel()
+        positions = _ranges(self.grid_keys, base + c0, base + c1 + 1)
+        rows = np.concatenate((self.grid_rows[positions], self._unindexed(start, end)))
+        self.candidates = len(rows)
+
+        lat, lon = a.lat[rows], a.lon[rows]
+        rows = rows[(lat >= lamin) & (lat <= lamax) & (lon >= lomin) & (lon <= lomax)]
+        return np.sort(self._filter_time(rows, start, end))
+
+    def track(self, icao24, start=None, end=None):
+        """Rows (in archive order) of aircraft icao24 (an integer), in snapshots with start <= time <= end"""
+        a = self.archive
+        keys = self._buckets(start, end) << TRACK_KEY_BITS
+        positions = _ranges(self.track_keys, keys + icao24, keys + icao24 + 1)
+        rows = self._unindexed(start, end)
+        rows = np.concatenate((self.track_rows[positions], rows[a.icao24[rows] == icao24]))
+        self.candidates = len(rows)
+
+        return self._filter_time(rows, start, end)
+
+    def responses(self, rows):
+        """
+        The given rows (in archive order) as a list of OpenSky "all state vectors"
+        responses, i.e. { "time": ..., "states": [...] }, one per snapshot
+        """
+        a = self.archive
+        snapshots = a.row_snapshots(rows)
+        states = columns_to_states(a.gather(rows))
+        bounds = np.concatenate(([0], np.nonzero(np.diff(snapshots))[0] + 1, [len(rows)]))
+        return [dict(time=int(a.snapshot_time[snapshots[b0]]), states=states[b0:b1])
+                for b0, b1 in zip(bounds[:-1], bounds[1:]) if b1 > b0]
+
+
+def open_index(directory, update=True, bucket_seconds=BUCKET_SECONDS, cell_size=CELL_SIZE):
+    """ArchiveIndex on the archive in directory, brought up to date if update is set"""
+    index = ArchiveIndex(StateArchive(directory), bucket_seconds, cell_size)
+    if update:
+        index.update()
+    return index
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Benchmark of the calibration (landmark alignment) solvers on synthetic scenes.
+#
+# Each scene is generated from a seed: N landmarks at realistic distances from
+# the observer, a known transformation rot(R) followed by T(tx,ty,tz) from the
+# sky coordinate system to the SK world coordinate system, and M head-pose
+# observations of the landmarks, with noise on the viewing direction.
+# Every solver is run on every scene, reporting wall time, iterations,
+# final RMS energy and the error against the known transformation. A solver
+# that ends in a worse local minimum than the best one found for the scene is
+# marked as not converged.
+#
+# Solvers:
+#   anneal       alignment.anneal(), a single chain (as calib-fd.py)
+#   multistart   alignment.multi_start(), --chains chains in a process pool
+#   incremental  alignment.IncrementalSolver, observations added one at a time
+#   fast2d       calib.solve_fast() on the XZ projection of the scene
+#
+# The iteration count is the number of annealing iterations (summed over chains),
+# observations added, or Gauss-Newton iterations, respectively. As the energy
+# only uses the XZ plane, ty is not observable and is not part of the error.
+# For fast2d the Jacobian of calib.residuals() is also checked against finite
+# differences at the solution (outside of the timing).
+import os, sys, time, argparse
+from math import radians, sin, cos, atan2, hypot
+import numpy as np
+from alignment import rot_y, angle_difference, anneal, multi_start, ObservationSet, IncrementalSolver
+import calib
+
+SOLVERS = ['anneal', 'multistart', 'incremental', 'fast2d']
+
+def make_scene(seed, landmarks=6, observations=50, noise=1.0, distance_range=(50.0, 1500.0),
+        translation_range=500.0, head_range=5.0):
+    """
+    Generate a synthetic scene. Landmarks are placed at distances within distance_range
+    (meters) from the sky origin, observations are made from head positions within
+    head_range meters of the SK origin, with gaussian noise of noise degrees on the
+    yaw and pitch of the viewing direction.
+
+    Returns (ground_truth, observations, transform), with transform (tx, ty, tz, r)
+    """
+
+    rng = np.random.default_rng(seed)
+
+    ground_truth = {}
+    for i in range(landmarks):
+        d = rng.uniform(distance_range[0], distance_range[1])
+        a = rng.uniform(0, 2*np.pi)
+        height = rng.uniform(5, 150)
+        ground_truth['L%d' % i] = (d*sin(a), height, d*cos(a))
+
+    transform = (
+        rng.uniform(-translation_range, translation_range),
+        rng.uniform(-2, 2),
+        rng.uniform(-translation_range, translation_range),
+        rng.uniform(0, 360)
+    )
+    tx, ty, tz, r = transform
+
+    names = list(ground_truth.keys())
+    obs = []
+    for i in range(observations):
+        # Every landmark is observed at least once
+        name = names[i] if i < len(names) else names[rng.integers(len(names))]
+        p = rot_y(ground_truth[name], r)
+        p = (p[0] + tx, p[1] + ty, p[2] + tz)
+
+        head = (rng.uniform(-head_range, head_range), rng.uniform(-0.5, 0.5), rng.uniform(-head_range, head_range))
+        v = (p[0]-head[0], p[1]-head[1], p[2]-head[2])
+
+        yaw = atan2(v[0], v[2]) + radians(rng.normal(0, noise))
+        pitch = atan2(v[1], hypot(v[0], v[2])) + radians(rng.normal(0, noise))
+        direction = (cos(pitch)*sin(yaw), sin(pitch), cos(pitch)*cos(yaw))
+
+        obs.append(dict(lm=name, head_pos=list(head), head_ori=list(direction)))
+
+    return ground_truth, obs, transform
+
+def arrays_2d(ground_truth, observations):
+    """calib.observation_arrays() of the XZ projection of the scene"""
+    OBS2D = [((ob['head_pos'][0], ob['head_pos'][2]), ob['lm'], (ob['head_ori'][0], ob['head_ori'][2]))
+        for ob in observations]
+    GT2D = { name: (p[0], p[2]) for name, p in ground_truth.items() }
+    return calib.observation_arrays(OBS2D, GT2D)
+
+def solve_fast2d(ground_truth, observations):
+    """
+    Run calib.solve_fast() on the XZ projection of the scene. That solver maps
+    the observations onto the ground truth, so the result is inverted to get
+    the transformation in the same convention as the alignment solvers.
+
+    Returns (tx, ty, tz, r, iterations)
+    """
+
+    tx2, tz2, r, iterations = calib.solve_fast(*arrays_2d(ground_truth, observations))
+
+    # q = rot(o, r) + t2  <=>  o = rot_y(q, r) - rot_y(t2, r)
+    t = rot_y((tx2, 0, tz2), r)
+    return (-t[0], 0.0, -t[2], r, iterations)
+
+def check_fast2d(ground_truth, observations, solution):
+    """Check the Jacobian of calib.residuals() at a fast2d solution against finite differences"""
+    tx, ty, tz, r = solution
+    # Back to the convention of calib.solve_fast(), see solve_fast2d()
+    t = rot_y((tx, 0, tz), -r)
+    jacobian_error = calib.check_jacobian(-t[0], -t[2], r, *arrays_2d(ground_truth, observations))
+    assert jacobian_error < 1e-6, 'Jacobian differs from finite differences by %g' % jacobian_error
+
+def transform_error(ground_truth, solution, transform):
+    """Return (position error of the origin, angle error, maximum landmark
+    position error), all in the XZ plane, in meters and degrees"""
+
+    landmark_error = 0.0
+    for p in ground_truth.values():
+        a = rot_y(p, solution[3])
+        b = rot_y(p, transform[3])
+        e = hypot((a[0] + solution[0]) - (b[0] + transform[0]), (a[2] + solution[2]) - (b[2] + transform[2]))
+        landmark_error = max(landmark_error, e)
+
+    return (hypot(solution[0]-transform[0], solution[2]-transform[2]),
+        angle_difference(solution[3], transform[3]), landmark_error)
+
+def run_solver(solver, ground_truth, observations, seed, options):
+    """Returns (tx, ty, tz, r, iterations)"""
+
+    if solver == 'anneal':
+        observation_set = ObservationSet(ground_truth, observations)
+        energy, tx, ty, tz, r = anneal(observation_set, seed, options.iterations, options.wo)
+        return (tx, ty, tz, r, options.iterations)
+
+    elif solver == 'multistart':
+        observation_set = ObservationSet(ground_truth, observations)
+        results = multi_start(observation_set, options.chains, seed, options.processes, options.iterations, options.wo)
+        s, energy, tx, ty, tz, r = results[0]
+        return (tx, ty, tz, r, options.chains*options.iterations)
+
+    elif solver == 'incremental':
+        solver = IncrementalSolver(ground_truth, seed=seed, K=options.iterations, WO=options.wo)
+        for ob in observations:
+            solver.add(ob)
+        return solver.solution + (len(observations),)
+
+    elif solver == 'fast2d':
+        return solve_fast2d(ground_truth, observations)
+
+    assert False, solver
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark of the calibration solvers on synthetic scenes')
+    parser.add_argument('--scenes', type=int, default=5,
+        help='Number of scenes (default: %(default)d)')
+    parser.add_argument('--seed', type=int, default=1,
+        help='Seed of the first scene, scene i uses seed+i (default: %(default)d)')
+    parser.add_argument('-N', '--landmarks', type=int, default=6,
+        help='Number of landmarks per scene (default: %(default)d)')
+    parser.add_argument('-M', '--observations', type=int, default=50,
+        help='Number of observations per scene (default: %(default)d)')
+    parser.add_argument('--noise', type=float, default=1.0,
+        help='Standard deviation of the viewing direction noise in degrees (default: %(default)s)')
+    parser.add_argument('--distance-range', type=float, nargs=2, default=[50.0, 1500.0], metavar=('MIN', 'MAX'),
+        help='Range of landmark distances in meters (default: %(default)s)')
+    parser.add_argument('--solvers', nargs='+', choices=SOLVERS, default=SOLVERS,
+        help='Solvers to run (default: all)')
+    parser.add_argument('-K', '--iterations', type=int, default=50000,
+        help='Annealing iterations per chain (default: %(default)d)')
+    parser.add_argument('--wo', type=int, default=2000,
+        help='Restart from best solution after this many iterations without improvement (default: %(default)d)')
+    parser.add_argument('--chains', type=int, default=4,
+        help='Number of chains for the multistart solver (default: %(default)d)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+        help='Number of processes for the multistart solver (default: %(default)d)')
+    parser.add_argument('--energy-tolerance', type=float, default=0.01,
+        help='Solutions with an RMS more than this fraction above the best solution found ' +
+             'for the scene (by any solver) are marked as not converged (default: %(default)s)')
+    options = parser.parse_args()
+
+    results = { solver: [] for solver in options.solvers }
+
+    for i in range(options.scenes):
+        seed = options.seed + i
+        ground_truth, observations, transform = make_scene(seed, options.landmarks, options.observations,
+            options.noise, options.distance_range)
+        observation_set = ObservationSet(ground_truth, observations)
+
+        print('Scene %d (seed %d): %d landmarks, %d observations, tx=%.3f, tz=%.3f, r=%.3f, ground truth RMS %.3f' % \
+            (i, seed, options.landmarks, options.observations, transform[0], transform[2], transform[3],
+            observation_set.energy(*transform)))
+        print('  %-12s %10s %10s %10s %10s %10s %12s' % \
+            ('solver', 'time (ms)', 'iters', 'RMS', 'pos (m)', 'r (deg)', 'landmark (m)'))
+
+        scene_results = []
+        for solver in options.solvers:
+            t0 = time.perf_counter()
+            tx, ty, tz, r, iterations = run_solver(solver, ground_truth, observations, seed, options)
+            t = time.perf_counter() - t0
+            if solver == 'fast2d':
+                check_fast2d(ground_truth, observations, (tx, ty, tz, r))
+
+            energy = observation_set.energy(tx, ty, tz, r)
+            scene_results.append((t, iterations, energy) + transform_error(ground_truth, (tx, ty, tz, r), transform))
+
+        best_energy = min(res[2] for res in scene_results)
+
+        for solver, (t, iterations, energy, pos_error, angle_error, landmark_error) in zip(options.solvers, scene_results):
+            converged = energy <= best_energy * (1 + options.energy_tolerance)
+            print('  %-12s %10.1f %10d %10.3f %10.3f %10.3f %12.3f%s' % \
+                (solver, t*1000, iterations, energy, pos_error, angle_error, landmark_error,
+                '' if converged else '  NOT CONVERGED'))
+            results[solver].append((t, energy, pos_error, angle_error, landmark_error, converged))
+        sys.stdout.flush()
+
+        print()
+
+    print('Summary over %d scenes' % options.scenes)
+    print('  %-12s %10s %10s %10s %14s %10s' % ('solver', 'converged', 'time (ms)', 'max time', 'med. pos (m)', 'med. r'))
+    for solver in options.solvers:
+        res = np.array(results[solver])
+        print('  %-12s %7d/%-3d %10.1f %10.1f %14.3f %10.3f' % \
+            (solver, int(res[:,5].sum()), len(res), 1000*res[:,0].mean(), 1000*res[:,0].max(),
+            np.median(res[:,2]), np.median(res[:,3])))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Benchmark of the batch plane extrapolation in extrapolation.py, for 10k-100k
+# planes spread over Europe, compared to a per-plane translation of the code
+# in PlaneData.cs (which also serves as a check of the results).
+import time, math, argparse
+import numpy as np
+from webmercator import epsg4326_to_epsg3857, RADIUS_METERS
+from extrapolation import MapProjection, PlaneBatch, HEAD_HEIGHT
+
+def rot_x(degrees):
+    a = math.radians(degrees)
+    c, s = math.cos(a), math.sin(a)
+    # Row-vector convention, as System.Numerics.Matrix4x4 used by StereoKit
+    return np.array([[1,0,0,0], [0,c,s,0], [0,-s,c,0], [0,0,0,1]])
+
+def rot_y(degrees):
+    a = math.radians(degrees)
+    c, s = math.cos(a), math.sin(a)
+    return np.array([[c,0,-s,0], [0,1,0,0], [s,0,c,0], [0,0,0,1]])
+
+def translate(x, y, z):
+    M = np.identity(4)
+    M[3,:3] = (x, y, z)
+    return M
+
+def process_and_update(state, map, observer, t):
+    """Per-plane reference: ProcessDataUpdate() followed by Update(t), returns
+    (computed_map_position, computed_sky_position, observer_distance)"""
+
+    time_position, lon, lat, baro, geo, velocity, heading, vertical_rate = state
+    obs_lat, obs_lon, floor_altitude = observer
+
+    speed_km_s = velocity / 1000.0
+    h = heading * math.pi / 180
+    delta = np.array([math.sin(h) * speed_km_s, math.cos(h) * speed_km_s, vertical_rate / 1000.0])
+
+    xx, yy = epsg4326_to_epsg3857(lon, lat)
+    x = ((xx - map.min_x) / map.x_extent - 0.5) * map.width
+    y = ((yy - map.min_y) / map.y_extent - 0.5) * map.height
+    map_position = np.array([x, y, geo / 1000.0])
+
+    M = rot_x(-lat) @ rot_y(lon - obs_lon) @ rot_x(obs_lat) @ translate(0, 0, -(RADIUS_METERS + floor_altitude + HEAD_HEIGHT))
+    sky_position = (np.array([0, 0, RADIUS_METERS + baro, 1]) @ M)[:3]
+    observer_distance = np.linalg.norm(sky_position) / 1000
+
+    t_diff = t - time_position
+    return (map_position + t_diff * delta, sky_position + t_diff * delta * 1000, observer_distance)
+
+def random_states(n, rng, t):
+    return dict(
+        time_position=t - rng.integers(0, 20, n),
+        lat=rng.uniform(35, 70, n),
+        lon=rng.uniform(-10, 40, n),
+        baro_altitude=rng.uniform(0, 12000, n),
+        geo_altitude=rng.uniform(0, 12000, n),
+        velocity=rng.uniform(50, 280, n),
+        heading=rng.uniform(0, 360, n),
+        vertical_rate=rng.uniform(-15, 15, n),
+        on_ground=np.zeros(n, dtype=bool)
+    )
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark of the batch plane extrapolation')
+    parser.add_argument('-n', '--planes', type=int, nargs='+', default=[10000, 30000, 100000],
+        help='Numbers of planes (default: %(default)s)')
+    parser.add_argument('--frames', type=int, default=100,
+        help='Number of extrapolation time steps timed per run (default: %(default)d)')
+    parser.add_argument('--reference-planes', type=int, default=2000,
+        help='Number of planes to time and check with the per-plane reference code (default: %(default)d)')
+    parser.add_argument('--seed', type=int, default=123456)
+    options = parser.parse_args()
+
+    rng = np.random.default_rng(options.seed)
+    t = 1700000000
+    # Europe-wide map, observer in Amsterdam
+    map = MapProjection([35, 70], [-10, 40])
+    observer = (52.3559, 4.9554, 0.0)
+
+    # Check against the reference
+    n = options.reference_planes
+    states = random_states(n, rng, t)
+    t0 = time.perf_counter()
+    ref = [process_and_update([states[k][i] for k in ['time_position', 'lon', 'lat', 'baro_altitude', 'geo_altitude',
+        'velocity', 'heading', 'vertical_rate']], map, observer, t + 5) for i in range(n)]
+    t_ref = time.perf_counter() - t0
+
+    batch = PlaneBatch(states, map, observer)
+    map_pos, sky_pos = batch.extrapolate(t + 5)
+    map_err = max(np.abs(map_pos[i] - ref[i][0]).max() for i in range(n))
+    sky_err = max(np.abs(sky_pos[i] - ref[i][1]).max() for i in range(n))
+    dist_err = max(abs(batch.observer_distance[i] - ref[i][2]) for i in range(n))
+    print('Per-plane reference: %d planes in %.3f s (%.1f us/plane)' % (n, t_ref, t_ref/n*1e6))
+    print('Max difference with reference: map %.3g km, sky %.3g m, distance %.3g km' % (map_err, sky_err, dist_err))
+
+    batch32 = PlaneBatch(states, MapProjection([35, 70], [-10, 40], np.float32), observer, np.float32)
+    map32, sky32 = batch32.extrapolate(t + 5)
+    print('float32 vs float64: map max %.3g km, sky max %.3g m' % (np.abs(map32 - map_pos).max(), np.abs(sky32 - sky_pos).max()))
+    print()
+
+    print('%8s %8s %16s %16s %14s' % ('planes', 'dtype', 'process (ms)', 'extrapolate (ms)', 'planes/s'))
+    for n in options.planes:
+        states = random_states(n, rng, t)
+        for dtype in [np.float64, np.float32]:
+            m = MapProjection([35, 70], [-10, 40], dtype)
+
+            t0 = time.perf_counter()
+            batch = PlaneBatch(states, m, observer, dtype)
+            t_process = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            for frame in range(options.frames):
+                map_pos, sky_pos = batch.extrapolate(t + frame * 0.1)
+            t_extrapolate = (time.perf_counter() - t0) / options.frames
+
+            print('%8d %8s %16.3f %16.3f %14.3g' % (n, np.dtype(dtype).name, t_process*1000, t_extrapolate*1000, n/t_extrapolate))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Benchmark of the batch observer-local transforms in geodesy.py, plus a
+# report of the error in the sky positions the app computes in float32
+# (PlaneData.ProcessDataUpdate, RecomputeLandmarkPositions, reproduced by
+# extrapolation.sky_positions), per distance from the observer. Errors are
+# given in meters and as the angle between the two directions seen from
+# the observer. The latter is what is visible when a plane or landmark is
+# drawn over the real one, errors along the line of sight don't count.
+import time, math, argparse
+import numpy as np
+import geodesy
+from extrapolation import sky_positions, HEAD_HEIGHT
+from webmercator import RADIUS_METERS
+
+def timed(label, n, func, *args):
+    t0 = time.perf_counter()
+    result = func(*args)
+    t = time.perf_counter() - t0
+    print('%-44s %10.3f s %14.0f points/s' % (label, t, n/t))
+    return result
+
+def scalar_enu(lat, lon, altitude, observer):
+    return [geodesy.geodetic_to_enu(a, o, h, observer) for a, o, h in zip(lat, lon, altitude)]
+
+def angle_between(a, b):
+    """Angle in arcminutes between the vectors (..., 3) a and b, as seen from the origin"""
+    # atan2 of |a x b| and a . b, which unlike arccos of the normalized dot
+    # product stays accurate for tiny angles
+    return np.degrees(np.arctan2(np.linalg.norm(np.cross(a, b), axis=-1), (a * b).sum(axis=-1))) * 60
+
+def points_around(observer, distance, bearing):
+    """lat/lon at distance (meters) and bearing (degrees) from observer, on the sphere"""
+    lat1 = math.radians(observer[0])
+    d = np.asarray(distance) / RADIUS_METERS
+    b = np.radians(bearing)
+    lat = np.arcsin(np.sin(lat1) * np.cos(d) + np.cos(lat1) * np.sin(d) * np.cos(b))
+    lon = np.radians(observer[1]) + np.arctan2(np.sin(b) * np.sin(d) * np.cos(lat1), np.cos(d) - np.sin(lat1) * np.sin(lat))
+    return np.degrees(lat), np.degrees(lon)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark and float32 error report for geodesy.py')
+    parser.add_argument('-n', '--points', type=int, default=2000000,
+        help='Number of points to convert (default: %(default)d)')
+    parser.add_argument('--scalar-points', type=int, default=20000,
+        help='Number of points used for timing the per-point conversion (default: %(default)d)')
+    parser.add_argument('--observer', type=float, nargs=3, default=[52.3676, 4.9041, 10.0], metavar=('LAT', 'LON', 'FLOOR_ALT'),
+        help='Observer position (default: %(default)s)')
+    parser.add_argument('--max-distance', type=float, default=200.0,
+        help='Maximum distance of the random points from the observer in km (default: %(default)s)')
+    parser.add_argument('--max-altitude', type=float, default=12000.0,
+        help='Maximum altitude of the random points in meters (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=123456)
+    options = parser.parse_args()
+
+    rng = np.random.default_rng(options.seed)
+    N = options.points
+    # Uniform in distance rather than area, so there are enough points close by
+    distance = rng.uniform(0, options.max_distance * 1000, N)
+    lat, lon = points_around(options.observer, distance, rng.uniform(0, 360, N))
+    altitude = rng.uniform(0, options.max_altitude, N)
+
+    # The app's sky origin is at the observer's head, use the same for the ENU frame
+    obs_lat, obs_lon, floor_altitude = options.observer
+    origin = (obs_lat, obs_lon, floor_altitude + HEAD_HEIGHT)
+
+    print('%d points within %.0f km of %.6f, %.6f, altitude 0 to %.0f m' % (N, options.max_distance, obs_lat, obs_lon, options.max_altitude))
+    print()
+
+    #
+    # Timing
+    #
+
+    lat32, lon32, alt32 = lat.astype(np.float32), lon.astype(np.float32), altitude.astype(np.float32)
+    observer32 = [np.float32(v) for v in options.observer]
+
+    M = min(options.scalar_points, N)
+    timed('geodetic_to_enu (per point, %d)' % M, M, scalar_enu, lat[:M], lon[:M], altitude[:M], origin)
+    timed('geodetic_to_enu (wgs84)', N, geodesy.geodetic_to_enu, lat, lon, altitude, origin)
+    timed('geodetic_to_enu (sphere)', N, geodesy.geodetic_to_enu, lat, lon, altitude, origin, 'sphere')
+    timed('geodetic_to_stereokit (wgs84)', N, geodesy.geodetic_to_stereokit, lat, lon, altitude, origin)
+    timed('sky_positions (app math, float64)', N, sky_positions, lat, lon, altitude, options.observer)
+    timed('sky_positions (app math, float32)', N, sky_positions, lat32, lon32, alt32, observer32, np.float32)
+    print()
+
+    #
+    # Errors, against the float64 sphere positions for the float32 inputs (so the
+    # float32 math error is measured separately from the float32 input rounding)
+    #
+
+    app32 = sky_positions(lat32, lon32, alt32, observer32, np.float32).astype(np.float64)
+    sphere_in32 = geodesy.geodetic_to_enu(lat32, lon32, alt32, [float(v) for v in observer32[:2]] + [float(observer32[2]) + HEAD_HEIGHT], 'sphere')
+    sphere = geodesy.geodetic_to_enu(lat, lon, altitude, origin, 'sphere')
+    wgs84 = geodesy.geodetic_to_enu(lat, lon, altitude, origin)
+
+    pairs = [
+        ('float32 math', app32, sphere_in32),
+        ('float32 input', sphere_in32, sphere),
+        ('app total', app32, sphere),
+        ('sphere vs wgs84', sphere, wgs84),
+    ]
+    errors = [(name, np.linalg.norm(a - b, axis=-1), angle_between(a, b)) for name, a, b in pairs]
+
+    print('Errors per distance from the observer: max in meters / max angle in arcminutes')
+    print('%-13s %8s' % ('distance(km)', 'points') + ''.join(' %20s' % name for name, e, angle in errors))
+    edges = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+    edges = [e for e in edges if e < options.max_distance] + [options.max_distance]
+    for d0, d1 in zip(edges[:-1], edges[1:]):
+        sel = (distance >= d0 * 1000) & (distance < d1 * 1000)
+        if not sel.any():
+            continue
+        line = '%5g - %-5g %8d' % (d0, d1, np.count_nonzero(sel))
+        for name, e, angle in errors:
+            line += ' %9.3f / %8.4f' % (e[sel].max(), angle[sel].max())
+        print(line)
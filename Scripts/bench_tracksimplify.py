@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Reduction in the number of track line points drawn per frame, when the
+# track histories of a recording (see record_opensky.py) are simplified with
+# tracksimplify.py, for a range of tolerances and both methods. Tracks are
+# built as the app does, and sampled at evenly spaced snapshots: the number of
+# points is the total of all tracks, i.e. the LinePoints allocated per frame
+# with map_show_track_lines enabled.
+import time, argparse
+import numpy as np
+from statearchive import StateArchive
+from extrapolation import MapProjection
+from tracksimplify import TrackStore, simplify, max_deviation, METHODS
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Track simplification point count reduction on a state archive')
+    parser.add_argument('archive',
+        help='State archive (see record_opensky.py)')
+    parser.add_argument('-t', '--tolerance', type=float, nargs='+', default=[0.01, 0.05, 0.1, 0.25, 0.5],
+        help='Tolerances in map km (default: %(default)s)')
+    parser.add_argument('--max-points', type=int,
+        help='Sliding window: maximum number of simplified points per track (default: no limit)')
+    parser.add_argument('--max-age', type=float,
+        help='Sliding window: seconds of track history kept (default: all)')
+    parser.add_argument('--samples', type=int, default=10,
+        help='Number of snapshots at which the tracks are simplified (default: %(default)d)')
+    parser.add_argument('--lat-range', type=float, nargs=2,
+        help='Latitude range of the map (default: extent of the archive)')
+    parser.add_argument('--lon-range', type=float, nargs=2,
+        help='Longitude range of the map (default: extent of the archive)')
+    options = parser.parse_args()
+
+    archive = StateArchive(options.archive)
+    assert len(archive) > 0, 'Archive %s is empty' % options.archive
+
+    lat = archive.lat[np.isfinite(archive.lat)]
+    lon = archive.lon[np.isfinite(archive.lon)]
+    lat_range = options.lat_range or (lat.min(), lat.max())
+    lon_range = options.lon_range or (lon.min(), lon.max())
+    map = MapProjection(lat_range, lon_range)
+    print('Map lat %.4f to %.4f, lon %.4f to %.4f, %.1f x %.1f km' % (lat_range[0], lat_range[1],
+        lon_range[0], lon_range[1], map.width, map.height))
+
+    samples = set(np.linspace(0, len(archive) - 1, min(options.samples, len(archive))).round().astype(int))
+    configurations = [(m, t) for m in METHODS for t in options.tolerance]
+    raw_points = 0
+    windowed_points = 0
+    points = { c: 0 for c in configurations }
+    deviation = { c: 0.0 for c in configurations }
+    seconds = { c: 0.0 for c in configurations }
+    longest = 0
+
+    store = TrackStore(options.max_age)
+    for i in range(len(archive)):
+        store.add(archive.snapshot(i))
+        if i not in samples:
+            continue
+
+        for track in store.tracks.values():
+            n = len(track)
+            if n < 2:
+                continue
+            raw_points += n
+            windowed_points += min(n, options.max_points or n)
+            longest = max(longest, n)
+            p = track.map_points(map)
+
+            for c in configurations:
+                method, tolerance = c
+                t0 = time.perf_counter()
+                keep = simplify(p, tolerance, method)
+                seconds[c] += time.perf_counter() - t0
+                deviation[c] = max(deviation[c], max_deviation(p, keep))
+                count = np.count_nonzero(keep)
+                points[c] += min(count, options.max_points or count)
+
+    print('%d snapshots, %d sampled, longest track %d points' % (len(archive), len(samples), longest))
+    print('Track points per frame (average over samples): %.1f' % (raw_points / len(samples)), end='')
+    if options.max_points is not None:
+        print(', %.1f with a window of %d points' % (windowed_points / len(samples), options.max_points))
+    else:
+        print()
+    print()
+
+    print('%16s %10s %12s %10s %14s %12s' % ('method', 'tol (km)', 'points', 'reduction', 'max dev (km)', 'us/point'))
+    for c in configurations:
+        method, tolerance = c
+        print('%16s %10.3f %12.1f %9.1f%% %14.4f %12.2f' % (method, tolerance, points[c] / len(samples),
+            100.0 * (1 - points[c] / max(raw_points, 1)), deviation[c], seconds[c] / max(raw_points, 1) * 1e6))
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Benchmark of the batch Web Mercator / tile functions in webmercator.py, plus
+# a report of the error made by the float32 computations (as done in the app,
+# see OSMTiles.cs and Projection.cs) compared to float64, per zoom level.
+import time, argparse
+import numpy as np
+import webmercator as wm
+
+def timed(label, n, func, *args):
+    t0 = time.perf_counter()
+    result = func(*args)
+    t = time.perf_counter() - t0
+    print('%-44s %10.3f s %14.0f points/s' % (label, t, n/t))
+    return result
+
+def scalar_tiles(lat, lon, zoom):
+    return [wm.coordinate_to_tile(a, o, zoom) for a, o in zip(lat, lon)]
+
+def scalar_epsg3857(lat, lon):
+    return [wm.epsg4326_to_epsg3857(o, a) for a, o in zip(lat, lon)]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark and float32 error report for webmercator.py')
+    parser.add_argument('-n', '--points', type=int, default=4000000,
+        help='Number of points to convert (default: %(default)d)')
+    parser.add_argument('--scalar-points', type=int, default=200000,
+        help='Number of points used for timing the scalar functions (default: %(default)d)')
+    parser.add_argument('--lat-range', type=float, nargs=2, default=[50.513427, 53.748711],
+        help='Latitude range of random points (default: %(default)s, i.e. the netherlands map)')
+    parser.add_argument('--lon-range', type=float, nargs=2, default=[2.812500, 7.734375],
+        help='Longitude range of random points (default: %(default)s)')
+    parser.add_argument('--max-zoom', type=int, default=19)
+    parser.add_argument('--seed', type=int, default=123456)
+    options = parser.parse_args()
+
+    rng = np.random.default_rng(options.seed)
+    N = options.points
+    lat = rng.uniform(options.lat_range[0], options.lat_range[1], N)
+    lon = rng.uniform(options.lon_range[0], options.lon_range[1], N)
+    lat32 = lat.astype(np.float32)
+    lon32 = lon.astype(np.float32)
+
+    print('%d points, lat %.6f to %.6f, lon %.6f to %.6f' % (N, lat.min(), lat.max(), lon.min(), lon.max()))
+    print()
+
+    #
+    # Timing
+    #
+
+    M = min(options.scalar_points, N)
+    timed('coordinate_to_tile (scalar, %d)' % M, M, scalar_tiles, lat[:M], lon[:M], 12)
+    xtile, ytile = timed('coordinates_to_tiles (float64)', N, wm.coordinates_to_tiles, lat, lon, 12)
+    timed('coordinates_to_tiles (float32)', N, wm.coordinates_to_tiles, lat32, lon32, 12, np.float32)
+    zooms = rng.integers(0, options.max_zoom+1, N)
+    timed('coordinates_to_tiles (float64, mixed zoom)', N, wm.coordinates_to_tiles, lat, lon, zooms)
+    timed('tiles_nw_corners (float64)', N, wm.tiles_nw_corners, xtile, ytile, 12)
+    timed('tiles_nw_corners (float32)', N, wm.tiles_nw_corners, xtile, ytile, 12, np.float32)
+    timed('epsg4326_to_epsg3857 (scalar, %d)' % M, M, scalar_epsg3857, lat[:M], lon[:M])
+    timed('epsg4326_to_epsg3857_batch (float64)', N, wm.epsg4326_to_epsg3857_batch, lon, lat)
+    timed('epsg4326_to_epsg3857_batch (float32)', N, wm.epsg4326_to_epsg3857_batch, lon32, lat32, np.float32)
+    print()
+
+    #
+    # Precision. The float32 input coordinates are used for both computations,
+    # so only the error caused by doing the math in float32 is measured
+    #
+
+    x64, y64 = wm.epsg4326_to_epsg3857_batch(lon32, lat32)
+    x32, y32 = wm.epsg4326_to_epsg3857_batch(lon32, lat32, np.float32)
+    err3857 = np.hypot(x32 - x64, y32 - y64)
+    print('EPSG:3857 float32 error: max %.3f m, mean %.3f m, 99th percentile %.3f m' %
+        (err3857.max(), err3857.mean(), np.percentile(err3857, 99)))
+
+    # Tile corners at zoom 12, for the tiles of the points
+    clat64, clon64 = wm.tiles_nw_corners(xtile, ytile, 12)
+    clat32, clon32 = wm.tiles_nw_corners(xtile, ytile, 12, np.float32)
+    cx64, cy64 = wm.epsg4326_to_epsg3857_batch(clon64, clat64)
+    cx32, cy32 = wm.epsg4326_to_epsg3857_batch(clon32.astype(np.float64), clat32.astype(np.float64))
+    errcorner = np.hypot(cx32 - cx64, cy32 - cy64)
+    print('Tile NW corner (zoom 12) float32 error: max %.3f m, mean %.3f m' % (errcorner.max(), errcorner.mean()))
+
+    # Error due to the float32 *input* coordinates alone
+    xin, yin = wm.epsg4326_to_epsg3857_batch(lon, lat)
+    errin = np.hypot(x64 - xin, y64 - yin)
+    print('Error from float32 lat/lon storage alone: max %.3f m' % errin.max())
+    print()
+
+    center_lat = 0.5 * (options.lat_range[0] + options.lat_range[1])
+
+    print('zoom  pixel(m)  tile mismatch  max tile pos err(px)  max EPSG:3857 err(px)')
+    for zoom in range(0, options.max_zoom+1):
+        px64, py64 = wm.coordinates_to_tile_positions(lat32, lon32, zoom)
+        px32, py32 = wm.coordinates_to_tile_positions(lat32, lon32, zoom, np.float32)
+
+        mismatch = np.count_nonzero((px64.astype(np.int64) != px32.astype(np.int64)) |
+                                    (py64.astype(np.int64) != py32.astype(np.int64)))
+        pos_err = np.hypot(px32 - px64, py32 - py64).max() * wm.TILE_SIZE
+
+        # Pixel size in EPSG:3857 units, i.e. not scaled by latitude
+        psize = wm.pixel_size(zoom)
+
+        print('%4d  %8.3f  %6d (%5.2f%%)  %20.4f  %21.4f' %
+            (zoom, wm.pixel_size(zoom, center_lat), mismatch, 100.0*mismatch/N, pos_err, err3857.max()/psize))
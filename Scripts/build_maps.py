@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Batch version of make_osm_map.py: builds the map images for all maps in the
+# predefined MAPS table of make_osm_map.py, or for the tile_server maps in the
+# map_sets of configuration JSON files, several maps in parallel.
+#
+# A map is skipped when its .png.json already matches the requested extent
+# (i.e. the tile extent computed from it), zoom and pyramid levels, and the
+# image files exist with the expected sizes. So refreshing a whole library
+# of maps only builds the maps that were added or changed.
+#
+# Maps are fetched from the tile servers of their configuration (the OSM tile
+# servers for the MAPS table), with a tile cache per tile server id as in
+# prewarm_tiles.py. The fetchers of all tile servers share their per-host
+# connections and request limits, so the limit holds over all maps together.
+# The .png.json records the tile server urls, a map is built again when its
+# tile server changes.
+import sys, os, re, json, time, argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+from PIL import Image
+from make_osm_map import MAPS, PYRAMID_LEVELS, TILE_SIZE, build_map, map_metadata, level_fname
+from osmtiles import TileFetcher, OSM_TILE_SERVERS, MAX_RETRIES
+from tilecache import TileCache, DEFAULT_CACHE_DIR, server_cache_fname
+from webmercator import actual_map_extent
+from texture import texture_metadata, FORMATS as TEXTURE_FORMATS
+
+def output_name_for(id):
+    """File name (without extension) for a map id, e.g. 'SF Bay Area' -> 'SF_Bay_Area'"""
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', id).strip('_')
+
+def config_maps(fname):
+    """
+    Yields (name, lat_range, lon_range, zoom, tile server id, urls) for the tile_server
+    maps in a configuration file. Maps using an unknown tile server are skipped, as in the app
+    """
+    config = json.load(open(fname, 'rt'))
+    for map_set in config.get('map_sets', []):
+        servers = { ts['id']: ts['urls'] for ts in map_set.get('tile_servers', []) }
+        for item in map_set['items']:
+            source = item.get('image_source', {})
+            if source.get('type') != 'tile_server':
+                continue
+            if source.get('id') not in servers:
+                print('WARNING: %s: [%s] map "%s" uses unknown tile server "%s", skipped' % (fname,
+                    map_set['id'], item['id'], source.get('id')))
+                continue
+            yield output_name_for(item['id']), item['lat_range'], item['lon_range'], item['zoom'], \
+                source['id'], servers[source['id']]
+
+def expected_metadata(name, lat_range, lon_range, zoom, pyramid, texture=None, urls=OSM_TILE_SERVERS):
+    (mini, maxi, minj, maxj), extent = actual_map_extent(lat_range, lon_range, zoom, np.float64)
+    size = ((maxi - mini + 1) * TILE_SIZE, (maxj - minj + 1) * TILE_SIZE)
+    level_sizes = [(size[0] // f, size[1] // f) for f in PYRAMID_LEVELS] if pyramid else None
+    texture_entry = texture_metadata(name+'.tex', size, texture) if texture is not None else None
+    return map_metadata(name, extent, zoom, level_sizes, texture_entry, urls), size
+
+def up_to_date(output_name, lat_range, lon_range, zoom, pyramid, texture=None, urls=OSM_TILE_SERVERS):
+    """True if the map image(s), texture and .png.json of output_name match the requested map"""
+    name = os.path.basename(output_name)
+    expected, size = expected_metadata(name, lat_range, lon_range, zoom, pyramid, texture, urls)
+    try:
+        with open(output_name + '.png.json', 'rt') as f:
+            current = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    if current.get('zoom') != zoom or current.get('image_source') != expected['image_source'] or \
+            current.get('levels') != expected.get('levels') or current.get('texture') != expected.get('texture'):
+        return False
+    # Maps built before the urls were recorded came from the OSM tile servers
+    if current.get('tile_urls', OSM_TILE_SERVERS) != expected['tile_urls']:
+        return False
+    for key in ('lat_range', 'lon_range'):
+        if not np.allclose(current.get(key, [0, 0]), expected[key], rtol=0, atol=1e-9):
+            return False
+
+    # Image files present, with the right size (only the header is read)
+    sizes = [(1, size)]
+    if pyramid:
+        sizes = [(level['downsample'], (level['width'], level['height'])) for level in expected['levels']]
+    for factor, s in sizes:
+        try:
+            with Image.open(os.path.join(os.path.dirname(output_name), level_fname(name, factor))) as img:
+                if img.size != s:
+                    return False
+        except OSError:
+            return False
+
+    if texture is not None:
+        last = expected['texture']['levels'][-1]
+        try:
+            if os.path.getsize(output_name + '.tex') != last['offset'] + last['size']:
+                return False
+        except OSError:
+            return False
+
+    return True
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Build several OSM map images at once, skipping maps that are up-to-date')
+    parser.add_argument('configs', nargs='*', metavar='config',
+        help='Configuration JSON files, the tile_server maps in their map_sets are built (default: the maps in make_osm_map.py)')
+    parser.add_argument('--maps', nargs='+', metavar='NAME',
+        help='Only build the maps with these names')
+    parser.add_argument('-o', '--output-dir', default='.',
+        help='Directory for the map images (default: current directory)')
+    parser.add_argument('-p', '--parallel', type=int, default=2,
+        help='Number of maps built in parallel (default: %(default)d)')
+    parser.add_argument('-j', '--workers', type=int, default=4,
+        help='Number of tiles to fetch concurrently per map (default: %(default)d)')
+    parser.add_argument('--per-host', type=int, default=2,
+        help='Maximum number of concurrent requests per tile server host, over all maps (default: %(default)d)')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+        help='Directory of the tile cache files, one per tile server id (default: %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=2048,
+        help='Maximum size in MB of each tile cache file, least recently used tiles are evicted (default: %(default)d)')
+    parser.add_argument('--no-cache', action='store_true',
+        help='Always retrieve tiles from the tile servers')
+    parser.add_argument('--retries', type=int, default=MAX_RETRIES,
+        help='Number of retries of a failed tile request, with exponential backoff (default: %(default)d)')
+    parser.add_argument('--no-adaptive', action='store_true',
+        help='Keep the number of requests per host at --per-host, instead of lowering it while a host is throttling')
+    parser.add_argument('--metrics', metavar='FILE',
+        help='Write tile request metrics (latency percentiles per host, retries, status codes) to this JSON file')
+    parser.add_argument('--stream', action='store_true',
+        help='Assemble and write the output images one row of tiles at a time, for very large maps')
+    parser.add_argument('--pyramid', action='store_true',
+        help='Also write 2x, 4x and 8x downsampled versions of the map images')
+    parser.add_argument('--texture', choices=sorted(TEXTURE_FORMATS),
+        help='Also write the map images as power-of-two padded texture data with mip levels, in this format')
+    parser.add_argument('-f', '--force', action='store_true',
+        help='Build all maps, also the ones that are up-to-date')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+        help='Only show which maps would be built')
+    options = parser.parse_args()
+
+    maps = []
+    if options.configs:
+        for fname in options.configs:
+            try:
+                maps.extend(config_maps(fname))
+            except (ValueError, KeyError) as e:
+                print('%s: invalid configuration (%s)' % (fname, e))
+                sys.exit(-1)
+    else:
+        maps = [(name, m['lat_range'], m['lon_range'], m['zoom'], 'osm', OSM_TILE_SERVERS) for name, m in MAPS.items()]
+
+    if options.maps:
+        unknown = set(options.maps) - set(m[0] for m in maps)
+        assert not unknown, 'Unknown map(s) %s' % ', '.join(sorted(unknown))
+        maps = [m for m in maps if m[0] in options.maps]
+
+    names = [m[0] for m in maps]
+    duplicates = set(n for n in names if names.count(n) > 1)
+    assert not duplicates, 'Duplicate map name(s) %s' % ', '.join(sorted(duplicates))
+
+    os.makedirs(options.output_dir, exist_ok=True)
+
+    todo = []
+    for name, lat_range, lon_range, zoom, server_id, urls in maps:
+        output_name = os.path.join(options.output_dir, name)
+        if not options.force and up_to_date(output_name, lat_range, lon_range, zoom, options.pyramid, options.texture, urls):
+            print('%-20s up-to-date' % name)
+        else:
+            print('%-20s to be built (zoom %d, tile server %s)' % (name, zoom, server_id))
+            todo.append((name, lat_range, lon_range, zoom, server_id, urls, output_name))
+
+    if options.dry_run or len(todo) == 0:
+        print('%d of %d maps to be built' % (len(todo), len(maps)))
+        sys.exit(0)
+
+    # A cache per tile server id, a fetcher per tile server (id and urls), all
+    # fetchers sharing the per-host limits of the first one
+    caches = {}
+    fetchers = {}
+    fetcher = None
+    for name, lat_range, lon_range, zoom, server_id, urls, output_name in todo:
+        if (server_id, tuple(urls)) in fetchers:
+            continue
+        cache = None
+        if not options.no_cache:
+            if server_id not in caches:
+                caches[server_id] = TileCache(server_cache_fname(server_id, options.cache_dir), options.cache_size*1024*1024)
+            cache = caches[server_id]
+        if fetcher is None:
+            fetcher = TileFetcher(urls, workers=options.workers, max_per_host=options.per_host, cache=cache,
+                retries=options.retries, adaptive=not options.no_adaptive)
+            fetchers[(server_id, tuple(urls))] = fetcher
+        else:
+            fetchers[(server_id, tuple(urls))] = fetcher.sibling(urls, cache)
+
+    def build(name, lat_range, lon_range, zoom, server_id, urls, output_name):
+        t0 = time.time()
+        build_map(lat_range, lon_range, zoom, output_name, fetchers[(server_id, tuple(urls))],
+            options.stream, options.pyramid, options.texture, verbose=False)
+        return time.time() - t0
+
+    t0 = time.time()
+    failed = []
+    with ThreadPoolExecutor(max_workers=options.parallel) as pool:
+        futures = { pool.submit(build, *job): job[0] for job in todo }
+        for f in as_completed(futures):
+            name = futures[f]
+            try:
+                print('%-20s built in %.1f s' % (name, f.result()))
+            except Exception as e:
+                print('%-20s FAILED: %s' % (name, e or type(e).__name__))
+                failed.append(name)
+            sys.stdout.flush()
+
+    fetcher.close()
+    print('%d maps built in %.1f s' % (len(todo) - len(failed), time.time() - t0))
+    print(fetcher.metrics.report())
+    if options.metrics is not None:
+        fetcher.metrics.write_json(options.metrics)
+    for cache in caches.values():
+        print(cache.report())
+        cache.close()
+
+    if failed:
+        sys.exit(-1)
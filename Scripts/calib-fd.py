@@ -1,48 +1,9 @@
 #!/usr/bin/env python
-from math import sqrt, degrees, radians, sin, cos, exp
-from random import random, randint, seed
+import os, sys, json, time, argparse
+from random import randrange
+from alignment import line_point_distance_xz, rot_y, anneal, multi_start, chain_spread, \
+    load_observations, load_ground_truth, ObservationSet, IncrementalSolver
 
-#seed(123456)
-
-def line_point_distance_xz(p, q, t):
-    """Return closest distance between 3D point t
-    and the line between points p and q *in the XZ plane*"""
-    
-    x1 = p[0]
-    y1 = p[1]
-    z1 = p[2]
-    
-    x2 = q[0]
-    y2 = q[1]
-    z2 = q[2]
-    
-    x0 = t[0]
-    y0 = t[1]
-    z0 = t[2]
-    
-    num = abs((x2-x1)*(z1-z0) - (x1-x0)*(z2-z1))    
-    den = sqrt((x2-x1)**2 + (z2-z1)**2)
-    return num/den
-    
-def behind_xz(p, q, t):
-    """Return if point t is behind the observer at p (who is viewing from p to q).
-    Ignores Y"""
-    v = (q[0]-p[0], q[1]-p[1], q[2]-p[2])
-    w = (t[0]-p[0], t[1]-p[1], t[2]-p[2])
-    return v[0]*w[0] + v[2]*w[2] < 0
-    
-    
-def rot_y(p, angle_degrees):
-    """Positive rotation = CCW"""
-    a = radians(angle_degrees)
-    cos_a = cos(a)
-    sin_a = sin(a)
-    
-    qx = cos_a*p[0] + sin_a*p[2]
-    qz = -sin_a*p[0] + cos_a*p[2]
-
-    return (qx, p[1], qz)
-    
 if False:
     print(line_point_distance_xz((0,0,0), (1,0,0), (0.5,0,0)))
     print(line_point_distance_xz((0,0,0), (1,0,0), (0.5,0,1)))
@@ -58,50 +19,50 @@ if False:
     print(rot_y((0.88,0,0.88), -45))
     
     
-def compute_energy(tx, ty, tz, r):
-    """Returns RMS in meters"""
-    
-    e2 = 0.0
-    n = 0    
-        
-    for ref_name, ref_position in GROUND_TRUTH.items():
-        #print(ref_name)
-        
-        r2 = rot_y(ref_position, r)
-        r2 = (r2[0] + tx, r2[1] + ty, r2[2] + tz)
-        
-        for observation in OBSERVATIONS:            
-            if observation['lm'] != ref_name:
-                # XXX yuck
-                continue            
-            ob_origin = observation['head_pos']
-            ob_direction = observation['head_ori']
-            ob2 = (ob_origin[0] + ob_direction[0], ob_origin[1] + ob_direction[1], ob_origin[2] + ob_direction[2])
-            dist = line_point_distance_xz(ob_origin, ob2, r2)
-            
-            # Penalize solution when point is behind, as seen along viewing direction
-            if behind_xz(ob_origin, ob2, r2):
-                dist += 1000
-                
-            #max_dist = max(max_dist, dist)
-            #print(observation['lm'], dist)
-            e2 += dist*dist
-            
-        n += 1
-            
-        if n == 0:
-            print('WARNING: no observations for "%s"' % ref_name)
-                    
-        #print(max_dist)
-        
-    #return max_dist
-    return sqrt(e2/n)
-    
-def rand_unit():
-    return (random()-0.5)*2
+def follow(f, poll_interval=0.1):
+    """Yield complete lines from f, waiting for new lines to get appended
+    (like tail -f). Stops at end-of-file when reading from stdin."""
+    line = ''
+    while True:
+        chunk = f.readline()
+        if chunk == '':
+            if f is sys.stdin:
+                return
+            time.sleep(poll_interval)
+            continue
+        line += chunk
+        if line.endswith('\n'):
+            yield line
+            line = ''
     
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--observations', metavar='FILE.jsonl',
+        help='Load observations from a JSONL file, one {"lm", "head_pos", "head_ori"} object per line, instead of the built-in ones')
+    parser.add_argument('--ground-truth', metavar='FILE.json',
+        help='Load the landmark reference points from a file made by make_ground_truth.py, instead of the built-in ones')
+    parser.add_argument('--follow', metavar='FILE.jsonl',
+        help='Incremental mode: read observations as they get appended to FILE.jsonl (or - for stdin), ' +
+             'updating the solution after each one')
+    parser.add_argument('--start', type=float, nargs=4, metavar=('TX', 'TY', 'TZ', 'R'),
+        help='Start solution for incremental mode (default: anneal once the first observations are available)')
+    parser.add_argument('--radius', type=float, default=5.0,
+        help='Incremental mode search radius for tx, tz in meters (default: %(default)s)')
+    parser.add_argument('--angle-radius', type=float, default=2.0,
+        help='Incremental mode search radius for r in degrees (default: %(default)s)')
+    parser.add_argument('--chains', type=int, default=1,
+        help='Number of independent annealing chains to run, the best solution is used (default: %(default)d)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+        help='Number of processes to run chains in (default: %(default)d)')
+    parser.add_argument('--seed', type=int, default=None,
+        help='Random seed of the first chain, chain i uses seed+i (default: random)')
+    parser.add_argument('-K', '--iterations', type=int, default=50000,
+        help='Annealing iterations per chain (default: %(default)d)')
+    parser.add_argument('--wo', type=int, default=2000,
+        help='Restart from best solution after this many iterations without improvement (default: %(default)d)')
+    options = parser.parse_args()
+
     # Ground truth (in coord system to align to)
     # Point coordinates
     # SK world coordinate system, i.e. +Y up
@@ -128,95 +89,84 @@ if __name__ == '__main__':
         {"lm":"SS","head_pos":[-0.193687, 0.547925, -6.495636],"head_ori":[0.534311, -0.042488, -0.844219]}
     ]
     
+    if options.ground_truth is not None:
+        GROUND_TRUTH = load_ground_truth(options.ground_truth)
+        print('Loaded %d reference points from %s' % (len(GROUND_TRUTH), options.ground_truth))
+
+    if options.observations is not None:
+        OBSERVATIONS = load_observations(options.observations)
+        print('Loaded %d observations from %s' % (len(OBSERVATIONS), options.observations))
+    
+    seed = options.seed
+    if seed is None:
+        seed = randrange(1 << 31)
+    
+    if options.follow is not None:
+        # Incremental mode, every new observation gives an updated solution,
+        # warm-started from the previous one
+        solver = IncrementalSolver(GROUND_TRUTH, options.start, options.radius, options.angle_radius,
+            seed, options.iterations, options.wo)
+        
+        f = sys.stdin if options.follow == '-' else open(options.follow, 'rt')
+        count = 0
+        
+        try:
+            for line in follow(f):
+                line = line.strip()
+                if line == '' or line.startswith('#'):
+                    continue
+                observation = json.loads(line)
+                count += 1
+                
+                t0 = time.perf_counter()
+                result = solver.add(observation)
+                t = time.perf_counter() - t0
+                
+                if result is None:
+                    print('[%d] %s: not enough observations yet' % (count, observation['lm']))
+                else:
+                    print('[%d] %s: Energy %8.3f | tx=%.6f, ty=%.6f, tz=%.6f, r=%.6f (%.3f ms)' % \
+                        ((count, observation['lm']) + result + (t*1000,)))
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+        
+        if solver.energy is not None:
+            print('Best: tx %.6f, ty %.6f, tz %.6f, r %.6f (energy %.6f)' % \
+                (solver.solution + (solver.energy,)))
+        sys.exit(0)
+    
+    observation_set = ObservationSet(GROUND_TRUTH, OBSERVATIONS)
+    
     # Compute the transformation rot(R) followed by T(tx,ty,tz)
     # that maps the sky coordinate system (in which the ground truth
     # points are defined) onto the observation coordinate system
     
-    tx = 0.0
-    ty = 0.0
-    tz = 0.0
-    r = 0.0
-        
-    best_tx = tx
-    best_ty = ty
-    best_tz = tz
-    best_r = r
-    best_energy = compute_energy(tx, ty, tz, r)
-    print('[initial] Energy %.6f | tx=%.6f, ty=%.6f, tz=%.6f, r=%.6f' % \
-        (best_energy, best_tx, best_ty, best_tz, best_r))
-    
-    K = 50000
-    WO = 2000
-    without_improvement = 0
-    
-    for k in range(0, K):
+    t0 = time.perf_counter()
+    
+    if options.chains == 1:
+        print('Seed %d' % seed)
+        best_energy, best_tx, best_ty, best_tz, best_r = \
+            anneal(observation_set, seed, options.iterations, options.wo, verbose=True)
+    else:
+        print('Running %d chains in %d processes, seeds %d-%d' % \
+            (options.chains, min(options.processes, options.chains), seed, seed+options.chains-1))
+        results = multi_start(observation_set, options.chains, seed, 
+            options.processes, options.iterations, options.wo)
         
-        T = 1 - (k+1)/K
-        #print('Iter %d, T = %.6f' % (k, T))
+        for s, energy, tx, ty, tz, r in results:
+            print('[seed %d] Energy %8.3f | tx=%.6f, ty=%.6f, tz=%6f, r=%.6f' % (s, energy, tx, ty, tz, r))
         
-        # Pick neighbour
-        can_tx = tx
-        can_ty = ty
-        can_tz = tz
-        can_r = r
+        spread = chain_spread(results)
+        print('Energy min %.6f, median %.6f, max %.6f' % \
+            (spread['energy_min'], spread['energy_median'], spread['energy_max']))
+        print('Std.dev. tx %.3f m, tz %.3f m, r %.3f degrees' % \
+            (spread['tx_std'], spread['tz_std'], spread['r_std']))
+        print('%.0f%% of chains agree with the best solution (within 1 m, 1 degree)' % \
+            (100*spread['agreement']))
         
-        idx = randint(0, 2)
-        if idx == 0:
-            #print('Mutating tx')            
-            can_tx = tx + rand_unit()*2000*T
-        # NOTE: ty never mutated
-        elif idx == 1:
-            #print('Mutating tz')
-            can_tz = tz + rand_unit()*2000*T
-        elif idx == 2:
-            #print('Mutating r')
-            can_r = (r + rand_unit()*360*T) % 360
-        #elif idx == 3:
-        #    # Negate all values
-        #    can_tx = -tx
-        #    can_tz = -tz
-        #    can_r = -r
-            
-        energy = compute_energy(can_tx, can_ty, can_tz, can_r)
+        seed, best_energy, best_tx, best_ty, best_tz, best_r = results[0]
         
-        #print('[%05d] Energy %8.3f (candidate, idx %d) | can_tx=%.6f, can_ty=%.6f, can_tz=%6f, can_r=%.6f' % \
-        #    (k, energy, idx, can_tx, can_ty, can_tz, can_r))
-            
-        if energy < best_energy:
-            print('[%05d] Energy %8.3f (new best)         | tx=%.6f, ty=%.6f, tz=%6f, r=%.6f' % \
-                (k, energy, can_tx, can_ty, can_tz, can_r))
-            best_energy = energy
-            best_tx = can_tx
-            best_ty = can_ty
-            best_tz = can_tz
-            best_r = can_r
-            without_improvement = 0
-            tx = can_tx
-            ty = can_ty
-            tz = can_tz
-            r = can_r
-        elif T > 0:
-            without_improvement += 1
-            if without_improvement == WO:
-                # Restart with last best solution
-                print('[%05d] %d steps without improvement, restarting' % (k, WO))
-                tx = best_tx
-                ty = best_ty
-                tz = best_tz
-                r = best_r
-                without_improvement = 0
-                continue
-                
-            #print(energy, best_energy, T)
-            p = exp(-(energy-best_energy)/T)
-            if random() <= p:
-                #print('Transitioning to less optimal solution (p=%.6f)' % p)
-                tx = can_tx
-                ty = can_ty
-                tz = can_tz
-                r = can_r
-                
     print('Best: tx %.6f, ty %.6f, tz %.6f, r %.6f (energy %.6f)' % \
         (best_tx, best_ty, best_tz, best_r, best_energy))
-        
-    
+    print('Wall time %.3f s' % (time.perf_counter() - t0))
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
+import sys, time, argparse
 from math import sqrt, degrees, radians, sin, cos, exp
 from random import random, randint, seed
+import numpy as np
 
 #seed(123456)
 
@@ -67,11 +69,134 @@ def compute_energy(tx, ty, r):
         
     return sqrt(e2/n)
     
+def observation_arrays(observations, ground_truth):
+    """Return observations as arrays of origins, directions and
+    corresponding ground truth points, each of shape (M, 2)"""
+    origins = np.array([ob[0] for ob in observations], dtype=np.float64)
+    points = np.array([ground_truth[ob[1]] for ob in observations], dtype=np.float64)
+    directions = np.array([ob[2] for ob in observations], dtype=np.float64)
+    return origins, directions, points
+    
+def compute_energy_batch(tx, ty, r, origins, directions, points):
+    """Vectorized compute_energy(): returns the RMS for each of the
+    K candidate transforms in arrays tx, ty, r (degrees)"""
+    
+    tx = np.asarray(tx, dtype=np.float64)[..., None]
+    ty = np.asarray(ty, dtype=np.float64)[..., None]
+    a = np.radians(np.asarray(r, dtype=np.float64))[..., None]
+    cos_a = np.cos(a)
+    sin_a = np.sin(a)
+    
+    # Rotated + translated origins, and rotated directions, shape (K, M)
+    ox = cos_a*origins[:,0] - sin_a*origins[:,1] + tx
+    oy = sin_a*origins[:,0] + cos_a*origins[:,1] + ty
+    dx = cos_a*directions[:,0] - sin_a*directions[:,1]
+    dy = sin_a*directions[:,0] + cos_a*directions[:,1]
+    
+    num = np.abs(dx*(oy-points[:,1]) - (ox-points[:,0])*dy)
+    den = np.hypot(directions[:,0], directions[:,1])
+    dist = num / den
+    
+    return np.sqrt(np.mean(dist*dist, axis=-1))
+    
+def residuals(tx, ty, r, origins, directions, points):
+    """Signed line-point distances for a single transform, plus
+    their Jacobian w.r.t. (tx, ty, r), with r in degrees"""
+    
+    a = radians(r)
+    cos_a = cos(a)
+    sin_a = sin(a)
+    
+    ox = cos_a*origins[:,0] - sin_a*origins[:,1] + tx
+    oy = sin_a*origins[:,0] + cos_a*origins[:,1] + ty
+    dx = cos_a*directions[:,0] - sin_a*directions[:,1]
+    dy = sin_a*directions[:,0] + cos_a*directions[:,1]
+    den = np.hypot(directions[:,0], directions[:,1])
+    
+    e = (dx*(oy-points[:,1]) - (ox-points[:,0])*dy) / den
+    
+    J = np.empty((len(e), 3))
+    J[:,0] = -dy / den
+    J[:,1] = dx / den
+    # Derivative of the rotated origin and direction w.r.t. the angle
+    J[:,2] = (dx*(points[:,0]-tx) + dy*(points[:,1]-ty)) / den * radians(1)
+    
+    return e, J
+    
+def check_jacobian(tx, ty, r, origins, directions, points, h=1e-6):
+    """Largest difference between the Jacobian of residuals() and a
+    central finite-difference approximation of it"""
+    
+    e, J = residuals(tx, ty, r, origins, directions, points)
+    x = np.array([tx, ty, r], dtype=np.float64)
+    diff = 0.0
+    for k in range(3):
+        step = np.zeros(3)
+        step[k] = h
+        e1 = residuals(*(x + step), origins, directions, points)[0]
+        e0 = residuals(*(x - step), origins, directions, points)[0]
+        diff = max(diff, np.abs((e1 - e0) / (2*h) - J[:,k]).max())
+    return diff
+    
+def solve_fast(origins, directions, points, angle_step=0.5, max_iterations=50, tolerance=1e-10):
+    """
+    Fast alternative to annealing. For a fixed rotation the best
+    translation follows from a linear least-squares problem, so first
+    all rotations in steps of angle_step degrees are scored in one batch,
+    each with its optimal translation. The best candidate is then refined
+    with Gauss-Newton iterations over (tx, ty, r).
+    
+    Returns (tx, ty, r, iterations)
+    """
+    
+    # Coarse search. The signed distance is linear in the translation:
+    # e = c + b . t, with b the rotated direction normal
+    r = np.arange(0, 360, angle_step)
+    a = np.radians(r)[:,None]
+    dx = np.cos(a)*directions[:,0] - np.sin(a)*directions[:,1]
+    dy = np.sin(a)*directions[:,0] + np.cos(a)*directions[:,1]
+    den = np.hypot(directions[:,0], directions[:,1])
+    
+    bx = -dy / den
+    by = dx / den
+    cross_do = directions[:,0]*origins[:,1] - directions[:,1]*origins[:,0]
+    c = (cross_do - (dx*points[:,1] - dy*points[:,0])) / den
+    
+    # Normal equations, one 2x2 system per candidate rotation
+    A = np.empty((len(r), 2, 2))
+    A[:,0,0] = (bx*bx).sum(axis=1)
+    A[:,0,1] = A[:,1,0] = (bx*by).sum(axis=1)
+    A[:,1,1] = (by*by).sum(axis=1)
+    rhs = -np.stack(((c*bx).sum(axis=1), (c*by).sum(axis=1)), axis=1)
+    t = np.einsum('kij,kj->ki', np.linalg.pinv(A), rhs)
+    
+    energies = compute_energy_batch(t[:,0], t[:,1], r, origins, directions, points)
+    best = np.argmin(energies)
+    tx, ty, r = t[best,0], t[best,1], r[best]
+    
+    # Gauss-Newton refinement
+    iterations = 0
+    for iterations in range(1, max_iterations+1):
+        e, J = residuals(tx, ty, r, origins, directions, points)
+        step = np.linalg.lstsq(J, -e, rcond=None)[0]
+        tx += step[0]
+        ty += step[1]
+        r += step[2]
+        if np.dot(step, step) < tolerance:
+            break
+    
+    return tx, ty, r % 360, iterations
+    
 def rand_unit():
     return (random()-0.5)*2
     
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--solver', choices=['anneal', 'fast'], default='anneal',
+        help='anneal = simulated annealing, fast = batch rotation search + Gauss-Newton refinement (default: %(default)s)')
+    options = parser.parse_args()
+
     # Ground truth (in coord system to align to)
     # Point coordinates
     GROUND_TRUTH = {
@@ -107,6 +232,18 @@ if __name__ == '__main__':
     # that maps the sky coordinate system (in which the ground truth
     # points are defined) onto the observation coordinate system
     
+    t0 = time.perf_counter()
+    
+    if options.solver == 'fast':
+        origins, directions, points = observation_arrays(OBSERVATIONS, GROUND_TRUTH)
+        tx, ty, r, iterations = solve_fast(origins, directions, points)
+        t = time.perf_counter() - t0
+        # Report the same RMS energy as for annealing
+        print('Best: tx %.6f, ty %.6f, r %.6f (energy %.6f)' % \
+            (tx, ty, r, compute_energy(tx, ty, r)))
+        print('%d Gauss-Newton iterations, %.3f ms' % (iterations, t*1000))
+        sys.exit(0)
+    
     tx = 0.0
     ty = 0.0
     r = 0.0
@@ -174,5 +311,6 @@ if __name__ == '__main__':
                 
     print('Best: tx %.6f, ty %.6f, r %.6f (energy %.6f)' % \
         (best_tx, best_ty, best_r, best_energy))
+    print('%d annealing iterations, %.3f ms' % (K, (time.perf_counter()-t0)*1000))
         
     
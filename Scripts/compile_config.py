@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Configuration "compiler": validates a configuration JSON file (map_sets,
+# observer_sets, landmark_sets, see the README) the way the app parses it,
+# and writes a minified copy with the derived geometry precomputed in float64.
+#
+# The app computes all of this in float32 on every load: the tile range and
+# actual extent of tile_server maps (OSMTiles.ComputeActualMapExtent), the
+# map size and EPSG:3857 extent (OSMMap), the union query extent of a map set
+# (ParseMapSet), and the map and sky positions of observers and landmarks
+# (Observer.update_map_position, RecomputeLandmarkPositions).
+#
+# The compiled file keeps all original fields, so the current app loads it as
+# before. The precomputed values are in extra fields that it ignores:
+#
+#   map item        "compiled": { "lat_range", "lon_range" (actual extent),
+#                       "tiles": [min_i, max_i, min_j, max_j] (tile_server maps),
+#                       "center": [lat, lon], "size_km": [width, height],
+#                       "x_range", "y_range" (EPSG:3857 meters, as OSMMap) }
+#   map set         "query_extent": [min_lat, max_lat, min_lon, max_lon]
+#   observer        "epsg3857": [x, y]
+#   landmark        "epsg3857": [x, y], "sky_positions": { "<observer set>/<observer>":
+#                       [x, y, z] } (meters, Z-up, for the observers in the same file)
+#
+# A map position (km relative to the map center) then only takes
+# ((x - x_range[0]) / (x_range[1] - x_range[0]) - 0.5) * size_km[0], same for y.
+import sys, os, json, argparse
+import numpy as np
+from webmercator import actual_map_extent, epsg4326_to_epsg3857_batch, TILE_SIZE
+from extrapolation import MapProjection, sky_positions, HEAD_HEIGHT
+
+COMPILED_VERSION = 1
+
+# Largest texture dimension supported on the device (D3D11 feature level 11)
+MAX_TEXTURE_SIZE = 16384
+
+# Web Mercator is only defined up to this latitude
+MAX_LATITUDE = 85.0511
+
+# Tile server types known to TileServerConfiguration
+TILE_SERVER_TYPES = ['osm']
+
+
+class Problems:
+
+    """Errors (the app would skip the item or set) and warnings, with their location in the file"""
+
+    def __init__(self):
+        self.errors = []
+        self.warnings = []
+
+    def error(self, where, message):
+        self.errors.append('%s: %s' % (where, message))
+
+    def warning(self, where, message):
+        self.warnings.append('%s: %s' % (where, message))
+
+
+def is_number(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+def check_range(item, key, limit, where, problems):
+    """Checks a [min, max] lat_range/lon_range, returns it or None"""
+    r = item.get(key)
+    if r is None:
+        problems.error(where, "missing '%s'" % key)
+        return None
+    if not isinstance(r, list) or len(r) != 2 or not all(is_number(v) for v in r):
+        problems.error(where, "'%s' should be a list of two numbers" % key)
+        return None
+    if not r[0] < r[1]:
+        problems.error(where, "'%s' should be [min, max], got %s" % (key, r))
+        return None
+    if r[0] < -limit or r[1] > limit:
+        problems.error(where, "'%s' %s outside of [-%g, %g]" % (key, r, limit, limit))
+        return None
+    return r
+
+def check_number(item, key, where, problems, default=None, limit=None):
+    """Checks a numeric field, the app reads a missing one as 0"""
+    v = item.get(key)
+    if v is None:
+        if default is None:
+            problems.error(where, "missing '%s'" % key)
+        return default
+    if not is_number(v):
+        problems.error(where, "'%s' should be a number, got %r" % (key, v))
+        return None
+    if limit is not None and abs(v) > limit:
+        problems.error(where, "'%s' %g outside of [-%g, %g]" % (key, v, limit, limit))
+        return None
+    return v
+
+def check_set(s, kind, index, problems):
+    """Checks the id and items of a map/observer/landmark set, returns (id, where) or (None, where)"""
+    where = '%s[%d]' % (kind, index)
+    id = s.get('id') if isinstance(s, dict) else None
+    if not isinstance(id, str) or id == '':
+        problems.error(where, "missing or empty 'id', set is ignored")
+        return None, where
+    where = '%s "%s"' % (kind, id)
+    if id == '<default>':
+        problems.error(where, "id '<default>' is reserved for the built-in set")
+        return None, where
+    items = s.get('items')
+    if not isinstance(items, list) or len(items) == 0:
+        problems.error(where, 'no items, set is ignored')
+        return None, where
+    ids = [item.get('id') for item in items if isinstance(item, dict)]
+    for dup in sorted(set(i for i in ids if ids.count(i) > 1 and isinstance(i, str))):
+        problems.warning(where, 'duplicate item id "%s", only the last one is used' % dup)
+    return id, where
+
+def round_list(values):
+    return [float(v) for v in values]
+
+
+def compile_map(item, tile_servers, config_dir, where, problems):
+    """Returns the compiled entry of a map item, or None"""
+    lat_range = check_range(item, 'lat_range', MAX_LATITUDE, where, problems)
+    lon_range = check_range(item, 'lon_range', 180.0, where, problems)
+    source = item.get('image_source')
+    if not isinstance(source, dict) or source.get('type') not in ('url', 'tile_server'):
+        problems.error(where, "'image_source' should have type 'url' or 'tile_server'")
+        return None
+    if lat_range is None or lon_range is None:
+        return None
+
+    compiled = {}
+
+    if source['type'] == 'url':
+        url = source.get('url')
+        if not isinstance(url, str) or url == '':
+            problems.error(where, "missing image_source 'url'")
+            return None
+        if not url.startswith('http://') and not url.startswith('https://') and config_dir is not None:
+            # A map image built by make_osm_map.py next to the configuration, check its extent
+            meta_fname = os.path.join(config_dir, url.lstrip('/') + '.json')
+            if os.path.isfile(meta_fname):
+                meta = json.load(open(meta_fname, 'rt'))
+                if not (np.allclose(meta.get('lat_range', [0, 0]), lat_range, rtol=0, atol=1e-9) and
+                        np.allclose(meta.get('lon_range', [0, 0]), lon_range, rtol=0, atol=1e-9)):
+                    problems.error(where, 'lat_range/lon_range do not match the extent of the image in %s' % meta_fname)
+        extent = lat_range + lon_range
+
+    else:
+        zoom = item.get('zoom')
+        if not isinstance(zoom, int) or isinstance(zoom, bool) or not 0 <= zoom <= 22:
+            problems.error(where, "tile_server map needs an integer 'zoom' (0-22), map is ignored")
+            return None
+        if source.get('id') not in tile_servers:
+            problems.error(where, 'unknown tile server id "%s", map is ignored' % source.get('id'))
+            return None
+
+        (min_i, max_i, min_j, max_j), (min_lat, max_lat, min_lon, max_lon) = \
+            actual_map_extent(lat_range, lon_range, zoom, np.float64)
+        tiles32, extent32 = actual_map_extent(lat_range, lon_range, zoom, np.float32)
+        if tiles32 != (min_i, max_i, min_j, max_j):
+            problems.warning(where, 'tile range %s differs from the float32 one %s computed by the app, '
+                'as the range ends on a tile boundary' % ([min_i, max_i, min_j, max_j], list(tiles32)))
+
+        width = (max_i - min_i + 1) * TILE_SIZE
+        height = (max_j - min_j + 1) * TILE_SIZE
+        if width > MAX_TEXTURE_SIZE or height > MAX_TEXTURE_SIZE:
+            problems.error(where, 'map image of %d x %d pixels is larger than the maximum texture size %d, '
+                'use a lower zoom level' % (width, height, MAX_TEXTURE_SIZE))
+            return None
+
+        compiled['tiles'] = [min_i, max_i, min_j, max_j]
+        extent = [min_lat, max_lat, min_lon, max_lon]
+
+    map = MapProjection(extent[:2], extent[2:])
+    compiled.update(
+        lat_range=round_list(extent[:2]),
+        lon_range=round_list(extent[2:]),
+        center=round_list([map.center_lat, map.center_lon]),
+        size_km=round_list([map.width, map.height]),
+        x_range=round_list([map.min_x, map.max_x]),
+        y_range=round_list([map.min_y, map.max_y])
+    )
+    return compiled
+
+
+def compile_map_set(map_set, index, config_dir, problems):
+    id, where = check_set(map_set, 'map_sets', index, problems)
+    if id is None:
+        return None
+
+    map_set = dict(map_set)
+    tile_servers = {}
+    for ts_index, ts in enumerate(map_set.get('tile_servers', [])):
+        ts_where = '%s tile_servers[%d]' % (where, ts_index)
+        if not isinstance(ts, dict):
+            problems.error(ts_where, 'not an object, tile server is ignored')
+            continue
+        if not isinstance(ts.get('id'), str):
+            problems.error(ts_where, "missing 'id'")
+            continue
+        if ts.get('type') not in TILE_SERVER_TYPES:
+            problems.warning(ts_where, "unknown type '%s'" % ts.get('type'))
+        urls = ts.get('urls')
+        if not isinstance(urls, list) or len(urls) == 0:
+            problems.error(ts_where, "missing 'urls'")
+            continue
+        for url in urls:
+            if not isinstance(url, str):
+                problems.error(ts_where, 'url %s is not a string' % json.dumps(url))
+            elif not all(k in url for k in ('{zoom}', '{x}', '{y}')):
+                problems.error(ts_where, 'url %s should contain {zoom}, {x} and {y}' % url)
+        tile_servers[ts['id']] = urls
+
+    items = []
+    extents = []
+    for item_index, item in enumerate(map_set['items']):
+        if not isinstance(item, dict):
+            problems.error('%s items[%d]' % (where, item_index), 'not an object, map is ignored')
+            continue
+        if not isinstance(item.get('id'), str):
+            # The app ignores the whole map set in this case
+            problems.error(where, "map without 'id', map set is ignored")
+            return None
+        compiled = compile_map(item, tile_servers, config_dir, '%s map "%s"' % (where, item['id']), problems)
+        if compiled is None:
+            continue
+        item = dict(item, compiled=compiled)
+        items.append(item)
+        extents.append(compiled['lat_range'] + compiled['lon_range'])
+
+    if len(items) == 0:
+        problems.error(where, 'no usable maps')
+        return None
+
+    extents = np.array(extents)
+    map_set['items'] = items
+    map_set['query_extent'] = round_list([extents[:, 0].min(), extents[:, 1].max(), extents[:, 2].min(), extents[:, 3].max()])
+    return map_set
+
+
+def compile_points(point_set, kind, index, fields, problems):
+    """Observer and landmark sets: checks the items, adds their EPSG:3857 position"""
+    id, where = check_set(point_set, kind, index, problems)
+    if id is None:
+        return None
+
+    point_set = dict(point_set)
+    items = []
+    for item_index, item in enumerate(point_set['items']):
+        if not isinstance(item, dict):
+            problems.error('%s items[%d]' % (where, item_index), 'not an object, item is ignored')
+            continue
+        if not isinstance(item.get('id'), str):
+            problems.error(where, "item without 'id', item is ignored")
+            continue
+        item_where = '%s item "%s"' % (where, item['id'])
+        lat = check_number(item, 'lat', item_where, problems, limit=MAX_LATITUDE)
+        lon = check_number(item, 'lon', item_where, problems, limit=180.0)
+        values = [check_number(item, key, item_where, problems, default) for key, default in fields]
+        if lat is None or lon is None or None in values:
+            continue
+        x, y = epsg4326_to_epsg3857_batch(lon, lat)
+        items.append(dict(item, epsg3857=round_list([x, y])))
+
+    if len(items) == 0:
+        problems.error(where, 'no usable items')
+        return None
+    point_set['items'] = items
+    return point_set
+
+
+def compile_config(config, config_dir=None):
+    """
+    Returns (compiled configuration, Problems). config_dir is the directory of
+    the configuration file, used to check map images referenced by relative url.
+    """
+    problems = Problems()
+    compiled = dict(config)
+    compiled['compiled_version'] = COMPILED_VERSION
+
+    if 'map_sets' in config:
+        map_sets = [compile_map_set(s, i, config_dir, problems) for i, s in enumerate(config['map_sets'])]
+        compiled['map_sets'] = [s for s in map_sets if s is not None]
+
+    if 'observer_sets' in config:
+        for s in config['observer_sets']:
+            items = s.get('items') if isinstance(s, dict) else None
+            for item in items if isinstance(items, list) else []:
+                if isinstance(item, dict) and 'alt' in item and 'floor_altitude' not in item:
+                    problems.error('observer_sets "%s" item "%s"' % (s.get('id'), item.get('id')),
+                        "the observer altitude field is 'floor_altitude', not 'alt'")
+        observer_sets = [compile_points(s, 'observer_sets', i, [('floor_altitude', None)], problems)
+            for i, s in enumerate(config['observer_sets'])]
+        compiled['observer_sets'] = [s for s in observer_sets if s is not None]
+
+    if 'landmark_sets' in config:
+        landmark_sets = [compile_points(s, 'landmark_sets', i, [('topalt', None), ('botalt', 0.0)], problems)
+            for i, s in enumerate(config['landmark_sets'])]
+        compiled['landmark_sets'] = [s for s in landmark_sets if s is not None]
+
+        for s in compiled['landmark_sets']:
+            for item in s['items']:
+                if item['topalt'] < item.get('botalt', 0.0):
+                    problems.warning('landmark_sets "%s" item "%s"' % (s['id'], item['id']), "'topalt' is below 'botalt'")
+
+        # Sky positions of the landmarks for each observer in this file. As in
+        # RecomputeLandmarkPositions() these are relative to the floor (the head
+        # height is not included, unlike for planes)
+        observers = [('%s/%s' % (s['id'], o['id']), (o['lat'], o['lon'], o['floor_altitude'] - HEAD_HEIGHT))
+            for s in compiled.get('observer_sets', []) for o in s['items']]
+        for s in compiled['landmark_sets']:
+            lat = [item['lat'] for item in s['items']]
+            lon = [item['lon'] for item in s['items']]
+            alt = [item['topalt'] for item in s['items']]
+            positions = { name: sky_positions(lat, lon, alt, observer) for name, observer in observers }
+            for idx, item in enumerate(s['items']):
+                if observers:
+                    item['sky_positions'] = { name: round_list(p[idx]) for name, p in positions.items() }
+
+    if not any(k in config for k in ('map_sets', 'observer_sets', 'landmark_sets', 'discord_webhook')):
+        problems.error('configuration', 'no map_sets, observer_sets, landmark_sets or discord_webhook section')
+
+    return compiled, problems
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Validate a configuration file and write it with precomputed geometry')
+    parser.add_argument('config',
+        help='Configuration JSON file')
+    parser.add_argument('-o', '--output',
+        help='Compiled (minified) configuration file to write (default: only validate)')
+    parser.add_argument('--indent', type=int,
+        help='Indent the output instead of minifying it')
+    parser.add_argument('-W', '--warnings-as-errors', action='store_true',
+        help='Fail on warnings as well')
+    options = parser.parse_args()
+
+    try:
+        config = json.load(open(options.config, 'rt'))
+    except ValueError as e:
+        print('%s: invalid JSON (%s)' % (options.config, e))
+        sys.exit(-1)
+
+    if not isinstance(config, dict):
+        print('%s: configuration should be a JSON object' % options.config)
+        sys.exit(-1)
+
+    compiled, problems = compile_config(config, os.path.dirname(os.path.abspath(options.config)))
+
+    for w in problems.warnings:
+        print('warning: %s' % w)
+    for e in problems.errors:
+        print('error: %s' % e)
+
+    for s in compiled.get('map_sets', []):
+        for item in s['items']:
+            c = item['compiled']
+            line = '[%s] %s: %.1f x %.1f km' % (s['id'], item['id'], c['size_km'][0], c['size_km'][1])
+            if 'tiles' in c:
+                t = c['tiles']
+                line += ', zoom %d, tiles i = %d-%d, j = %d-%d' % (item['zoom'], t[0], t[1], t[2], t[3])
+            print(line)
+    for key in ('observer_sets', 'landmark_sets'):
+        for s in compiled.get(key, []):
+            print('[%s] %d %s' % (s['id'], len(s['items']), key[:-5] + 's'))
+
+    if problems.errors or (options.warnings_as_errors and problems.warnings):
+        print('%s: %d errors, %d warnings, not compiled' % (options.config, len(problems.errors), len(problems.warnings)))
+        sys.exit(-1)
+
+    if options.output is not None:
+        with open(options.output, 'wt') as f:
+            if options.indent is not None:
+                json.dump(compiled, f, indent=options.indent)
+            else:
+                json.dump(compiled, f, separators=(',', ':'))
+        print('Wrote %s (%d bytes, source %d bytes)' % (options.output, os.path.getsize(options.output),
+            os.path.getsize(options.config)))
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Evaluation of the Kalman filter track predictor in tracking.py against the
+# linear extrapolation of PlaneData (as PlaneBatch in extrapolation.py), by
+# replaying recorded state vectors (see record_opensky.py) or synthetic traffic
+# (see fake_opensky.py).
+#
+# For every state vector with a new time_position each method predicts the
+# plane's position at that time, from the earlier updates only, and the
+# prediction error is measured in the observer's sky coordinate system
+# (meters, +Z up). This is the error visible in the sky view when the update
+# arrives. Besides the linear extrapolation of the last state ("linear") and
+# the Kalman filter ("kalman") the extrapolation of the displacement between
+# the last two positions ("two-point") is included, as suggested in the FAQ.
+#
+# The cost of processing the updates and of predicting the positions of
+# all planes is timed per snapshot.
+import time, argparse
+import numpy as np
+from statearchive import StateArchive, states_to_columns
+from extrapolation import MapProjection, PlaneBatch, sky_positions, MISSING_SECONDS
+from fake_opensky import SyntheticTraffic
+from tracking import KalmanTracker
+
+METHODS = ['linear', 'two-point', 'kalman']
+
+# Planes turning faster than this (degrees/s) between updates count as turning
+TURNING_RATE = 0.5
+
+# Updates implying a higher speed (m/s) than this since the previous update are
+# track discontinuities (e.g. synthetic planes wrapping around), not scored
+MAX_SPEED = 400.0
+
+def archive_snapshots(archive):
+    for i in range(len(archive)):
+        yield int(archive.snapshot_time[i]), archive.snapshot(i)
+
+def synthetic_snapshots(planes, lat_range, lon_range, duration, interval, seed):
+    traffic = SyntheticTraffic(planes, lat_range, lon_range, seed)
+    for t in range(traffic.start, traffic.start + duration, interval):
+        yield t, states_to_columns(traffic.states(t))
+
+
+class Evaluation:
+
+    """Replays snapshots through all methods, collecting the prediction errors"""
+
+    def __init__(self, map, observer):
+        self.map = map
+        self.observer = observer
+        self.tracker = KalmanTracker()
+        # Last two updates of each plane, for the linear and two-point methods
+        self.slots = {}
+        self.last = {}
+        self.previous_position = np.zeros((0, 3))
+        self.previous_time = np.zeros(0)
+        self.errors = { m: [] for m in METHODS }
+        self.vertical_errors = { m: [] for m in METHODS }
+        self.horizons = []
+        self.turning = []
+        self.update_seconds = { 'linear': 0.0, 'kalman': 0.0 }
+        self.predict_seconds = { 'linear': 0.0, 'kalman': 0.0 }
+        self.updates = 0
+        self.predictions = 0
+        self.discontinuities = 0
+
+    def _slots(self, keys):
+        idx = np.array([self.slots.setdefault(k, len(self.slots)) for k in keys], dtype=np.int64)
+        n = len(self.slots)
+        if n > len(self.previous_time):
+            grow = n - len(self.previous_time) + 1024
+            self.previous_position = np.concatenate((self.previous_position, np.full((grow, 3), np.nan)))
+            self.previous_time = np.concatenate((self.previous_time, np.full(grow, -np.inf)))
+            for name, values in self.last.items():
+                fill = -np.inf if name == 'time_position' else np.nan
+                self.last[name] = np.concatenate((values, np.full(grow, fill)))
+        return idx
+
+    def process(self, columns):
+        # Usable updates: airborne, with position, velocity, heading and altitude
+        valid = ((columns['time_position'] > 0) & (columns['on_ground'] == 0) &
+            np.isfinite(columns['lat']) & np.isfinite(columns['lon']) &
+            np.isfinite(columns['velocity']) & np.isfinite(columns['heading']) &
+            np.isfinite(columns['baro_altitude']))
+        s = { name: np.asarray(values)[valid] for name, values in columns.items() }
+        s['vertical_rate'] = np.nan_to_num(s['vertical_rate'].astype(np.float64))
+        # Both altitudes set to baro_altitude, only the sky position is used
+        s['geo_altitude'] = s['baro_altitude']
+
+        keys = s['icao24'].tolist()
+        idx = self._slots(keys)
+        if not self.last:
+            n = len(self.previous_time)
+            self.last = { name: np.full(n, np.nan) for name in s if name not in ('icao24', 'callsign') }
+            self.last['time_position'] = np.full(n, -np.inf)
+
+        # Only updates with a new time_position, as in PlaneData.ProcessDataUpdate()
+        t = s['time_position'].astype(np.float64)
+        new = t > self.last['time_position'][idx]
+        s = { name: values[new] for name, values in s.items() }
+        idx, t = idx[new], t[new]
+        keys = s['icao24'].tolist()
+        if len(idx) == 0:
+            return
+
+        measured = sky_positions(s['lat'], s['lon'], s['baro_altitude'], self.observer)
+        dt = t - self.last['time_position'][idx]
+        tracked = dt <= MISSING_SECONDS
+
+        # Predictions, for planes with a recent earlier update
+        if np.any(tracked):
+            ti, tt = idx[tracked], t[tracked]
+            last = { name: values[ti] for name, values in self.last.items() }
+
+            t0 = time.perf_counter()
+            batch = PlaneBatch(last, self.map, self.observer)
+            linear = batch.sky_position + (tt - batch.time_position)[:,None] * batch.delta * 1000
+            self.predict_seconds['linear'] += time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            lat, lon, altitude = self.tracker.predict([keys[i] for i in np.nonzero(tracked)[0]], tt)
+            kalman = sky_positions(lat, lon, altitude, self.observer)
+            self.predict_seconds['kalman'] += time.perf_counter() - t0
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                p1, t1 = batch.sky_position, last['time_position']
+                p0, t0_ = self.previous_position[ti], self.previous_time[ti]
+                velocity = (p1 - p0) / (t1 - t0_)[:,None]
+                # Without a usable earlier update fall back to the linear extrapolation
+                usable = (t1 - t0_ <= MISSING_SECONDS) & np.all(np.isfinite(velocity), axis=1)
+                two_point = np.where(usable[:,None], p1 + (tt - t1)[:,None] * velocity, linear)
+
+            target = measured[tracked]
+            jump = np.hypot(*(target - p1)[:,:2].T) > MAX_SPEED * (tt - t1) + 1000.0
+            scored = ~jump
+            for name, p in (('linear', linear), ('two-point', two_point), ('kalman', kalman)):
+                d = (p - target)[scored]
+                self.errors[name].append(np.hypot(d[:,0], d[:,1]))
+                self.vertical_errors[name].append(np.abs(d[:,2]))
+            self.horizons.append((tt - t1)[scored])
+            with np.errstate(invalid='ignore', divide='ignore'):
+                turn = np.abs((s['heading'][tracked] - last['heading'] + 180) % 360 - 180) / (tt - t1)
+            self.turning.append((turn > TURNING_RATE)[scored])
+            self.predictions += len(ti)
+            self.discontinuities += np.count_nonzero(jump)
+
+        # Updates
+        t0 = time.perf_counter()
+        PlaneBatch(s, self.map, self.observer)
+        self.update_seconds['linear'] += time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        self.tracker.update(keys, t, s['lat'], s['lon'], s['velocity'], s['heading'],
+            s['baro_altitude'], s['vertical_rate'])
+        self.update_seconds['kalman'] += time.perf_counter() - t0
+
+        self.previous_position[idx] = np.where(self.last['time_position'][idx,None] > -np.inf,
+            sky_positions(self.last['lat'][idx], self.last['lon'][idx], self.last['baro_altitude'][idx], self.observer),
+            np.nan)
+        self.previous_time[idx] = self.last['time_position'][idx]
+        if np.any(tracked):
+            # No two-point extrapolation across a discontinuity
+            self.previous_time[ti[jump]] = -np.inf
+        for name in self.last:
+            self.last[name][idx] = s[name]
+        self.updates += len(idx)
+
+    def report(self, snapshots):
+        horizons = np.concatenate(self.horizons)
+        turning = np.concatenate(self.turning)
+        errors = { m: np.concatenate(e) for m, e in self.errors.items() }
+        vertical = { m: np.concatenate(e) for m, e in self.vertical_errors.items() }
+
+        print('%d snapshots, %d updates, %d predictions scored (%d turning), %d discontinuities, %d Kalman track (re)starts' % (
+            snapshots, self.updates, len(horizons), np.count_nonzero(turning), self.discontinuities, self.tracker.resets))
+        print('Prediction horizon: median %.1f s, max %.1f s' % (np.median(horizons), horizons.max()))
+        print()
+
+        def table(title, selection):
+            n = np.count_nonzero(selection)
+            print('%s (%d predictions)' % (title, n))
+            if n == 0:
+                print()
+                return
+            print('%10s %10s %10s %10s %10s %10s %14s' % ('method', 'mean (m)', 'p50 (m)', 'p95 (m)', 'p99 (m)', 'max (m)', 'vert p95 (m)'))
+            for m in METHODS:
+                e = errors[m][selection]
+                p50, p95, p99 = np.percentile(e, [50, 95, 99])
+                print('%10s %10.1f %10.1f %10.1f %10.1f %10.1f %14.1f' % (m, e.mean(), p50, p95, p99, e.max(),
+                    np.percentile(vertical[m][selection], 95)))
+            print()
+
+        table('All planes', np.ones(len(horizons), dtype=bool))
+        table('Turning planes', turning)
+        table('Straight planes', ~turning)
+        for h0, h1 in [(0, 10), (10, 30), (30, MISSING_SECONDS)]:
+            table('Horizon %d-%d s' % (h0, h1), (horizons > h0) & (horizons <= h1))
+
+        print('Cost per snapshot (us per plane)')
+        print('%10s %12s %12s' % ('method', 'update', 'predict'))
+        for m in ['linear', 'kalman']:
+            print('%10s %12.2f %12.2f' % (m, self.update_seconds[m] / self.updates * 1e6,
+                self.predict_seconds[m] / max(self.predictions, 1) * 1e6))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compare Kalman filter track prediction with linear extrapolation')
+    parser.add_argument('archive', nargs='?',
+        help='State archive to replay (see record_opensky.py)')
+    parser.add_argument('--synthetic', type=int, metavar='PLANES',
+        help='Use synthetic traffic with the given number of planes instead of an archive')
+    parser.add_argument('--duration', type=int, default=1800,
+        help='Duration of the synthetic traffic in seconds (default: %(default)d)')
+    parser.add_argument('--interval', type=int, default=10,
+        help='Seconds between synthetic snapshots (default: %(default)d)')
+    parser.add_argument('--lat-range', type=float, nargs=2, default=[50.513427, 53.748711],
+        help='Latitude range of the synthetic traffic (default: %(default)s)')
+    parser.add_argument('--lon-range', type=float, nargs=2, default=[2.812500, 7.734375],
+        help='Longitude range of the synthetic traffic (default: %(default)s)')
+    parser.add_argument('--observer', type=float, nargs=2, metavar=('LAT', 'LON'),
+        help='Observer position for the sky coordinates (default: center of the traffic)')
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+
+    assert (options.archive is None) != (options.synthetic is None), 'Specify either an archive or --synthetic'
+
+    if options.archive is not None:
+        archive = StateArchive(options.archive)
+        assert len(archive) > 1, 'Archive %s has too few snapshots' % options.archive
+        snapshots = archive_snapshots(archive)
+        count = len(archive)
+        lat, lon = archive.lat[np.isfinite(archive.lat)], archive.lon[np.isfinite(archive.lon)]
+        lat_range, lon_range = (lat.min(), lat.max()), (lon.min(), lon.max())
+    else:
+        snapshots = synthetic_snapshots(options.synthetic, options.lat_range, options.lon_range,
+            options.duration, options.interval, options.seed)
+        count = len(range(0, options.duration, options.interval))
+        lat_range, lon_range = options.lat_range, options.lon_range
+
+    # The map only matters for the cost of the linear method, which includes the map positions as in the app
+    map = MapProjection(lat_range, lon_range)
+    center = (0.5 * (lat_range[0] + lat_range[1]), 0.5 * (lon_range[0] + lon_range[1]))
+    observer = tuple(options.observer or center) + (0.0,)
+    evaluation = Evaluation(map, observer)
+    for t, columns in snapshots:
+        evaluation.process(columns)
+
+    print('Observer at lat %.4f, lon %.4f' % observer[:2])
+    evaluation.report(count)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Batch version of the plane position extrapolation done per plane in
+# PlaneData.cs: all planes are processed at once as NumPy arrays, for offline
+# analysis and server-side prediction of large numbers of planes.
+#
+# PlaneBatch corresponds to PlaneData.ProcessDataUpdate() (positions at the
+# time of the last data update) plus PlaneData.Update() (extrapolation to a
+# later time). MapProjection corresponds to OSMMap.Project(). Computations
+# are in float64 by default, use dtype=numpy.float32 to get the single
+# precision results of the app.
+#
+# Note that, as in ProcessDataUpdate(), the map position uses state vector
+# field 13 (geo_altitude) and the sky position field 7 (baro_altitude), even
+# though the app names them the other way around. Missing altitudes are taken
+# as 0 (the app keeps the last known value, initially 0).
+import math
+import numpy as np
+from webmercator import epsg4326_to_epsg3857_batch, RADIUS_METERS
+
+# Same values as in PlaneData.Update()
+LATE_SECONDS = 60.0
+MISSING_SECONDS = 120.0
+
+# Update states, as PlaneData.UpdateState
+NORMAL, LATE, MISSING = 0, 1, 2
+
+# Assumed head height above the floor, as in ProcessDataUpdate()
+HEAD_HEIGHT = 1.5
+
+# State vector fields used, see statearchive.STATE_COLUMNS
+FIELDS = ['time_position', 'lon', 'lat', 'baro_altitude', 'geo_altitude', 'velocity', 'heading', 'vertical_rate', 'on_ground']
+
+
+class MapProjection:
+
+    """Map extent and WGS84 -> map (kilometers, relative to the map center) projection, as OSMMap"""
+
+    def __init__(self, lat_range, lon_range, dtype=np.float64):
+        dt = self.dtype = np.dtype(dtype)
+        f = dt.type
+        self.min_lat, self.max_lat = f(lat_range[0]), f(lat_range[1])
+        self.min_lon, self.max_lon = f(lon_range[0]), f(lon_range[1])
+        self.center_lat = f(0.5) * (self.min_lat + self.max_lat)
+        self.center_lon = f(0.5) * (self.min_lon + self.max_lon)
+
+        pi = f(math.pi)
+        radius_km = f(RADIUS_METERS) / f(1000)
+        r = radius_km * np.cos(self.center_lat / f(180) * pi)
+        self.width = (self.max_lon - self.min_lon) / f(360) * f(2) * pi * r
+        self.height = f(1) * (self.max_lat - self.min_lat) / f(360) * f(2) * pi * radius_km
+
+        x, y = epsg4326_to_epsg3857_batch([self.min_lon, self.max_lon, self.center_lon, self.center_lon],
+            [self.center_lat, self.center_lat, self.min_lat, self.max_lat], dt)
+        self.min_x, self.max_x, self.min_y, self.max_y = x[0], x[1], y[2], y[3]
+        self.x_extent = self.max_x - self.min_x
+        self.y_extent = self.max_y - self.min_y
+
+    def project(self, lon, lat):
+        """Returns arrays (x, y) in kilometers. Note the lon, lat argument order"""
+        f = self.dtype.type
+        xx, yy = epsg4326_to_epsg3857_batch(lon, lat, self.dtype)
+        x = ((xx - self.min_x) / self.x_extent - f(0.5)) * self.width
+        y = ((yy - self.min_y) / self.y_extent - f(0.5)) * self.height
+        return (x, y)
+
+
+def sky_positions(lat, lon, altitude, observer, dtype=np.float64):
+    """
+    Positions in meters in the observer's sky coordinate system (+X east, +Y north,
+    +Z up, origin at the observer's head), for points at the given lat/lon (degrees)
+    and altitude (meters) on a spherical Earth. observer is (lat, lon, floor_altitude).
+    Same as the matrix M in ProcessDataUpdate(), written out.
+    """
+
+    dt = np.dtype(dtype)
+    f = dt.type
+    obs_lat, obs_lon, floor_altitude = [f(v) for v in observer]
+    to_radians = f(math.pi) / f(180)
+
+    lat = np.asarray(lat, dtype=dt) * to_radians
+    dlon = (np.asarray(lon, dtype=dt) - obs_lon) * to_radians
+    d = f(RADIUS_METERS) + np.asarray(altitude, dtype=dt)
+
+    # Point on the sphere with +Y through the north pole, +Z at the observer's longitude
+    cos_lat = np.cos(lat)
+    px = d * cos_lat * np.sin(dlon)
+    py = d * np.sin(lat)
+    pz = d * cos_lat * np.cos(dlon)
+
+    # Rotate around X by the observer latitude, and translate the observer's head to the origin
+    a = obs_lat * to_radians
+    cos_a = np.cos(a)
+    sin_a = np.sin(a)
+    y = py * cos_a - pz * sin_a
+    z = py * sin_a + pz * cos_a - (f(RADIUS_METERS) + floor_altitude + f(HEAD_HEIGHT))
+
+    return np.stack((px, y, z), axis=-1)
+
+
+class PlaneBatch:
+
+    """
+    Last known states of N planes, as a struct-of-arrays: a dict with arrays for
+    the FIELDS (e.g. a StateArchive.snapshot()), plus the derived map and sky
+    positions at the time of the data (time_position), for a given map and observer.
+    """
+
+    def __init__(self, states, map, observer, dtype=np.float64):
+        dt = self.dtype = np.dtype(dtype)
+        f = dt.type
+
+        self.time_position = np.asarray(states['time_position'], dtype=np.float64)
+        self.lat = np.asarray(states['lat'], dtype=dt)
+        self.lon = np.asarray(states['lon'], dtype=dt)
+        self.heading = np.asarray(states['heading'], dtype=dt)
+        self.velocity = np.asarray(states['velocity'], dtype=dt)
+        self.vertical_rate = np.nan_to_num(np.asarray(states['vertical_rate'], dtype=dt))
+        self.on_ground = np.asarray(states['on_ground'], dtype=bool)
+        # See the note on the altitudes at the top
+        self.map_altitude = np.nan_to_num(np.asarray(states['geo_altitude'], dtype=dt))
+        self.sky_altitude = np.nan_to_num(np.asarray(states['baro_altitude'], dtype=dt))
+
+        # Climb angle in degrees, vertical_rate > 0 (= climb) implies negative X rotation
+        with np.errstate(divide='ignore', invalid='ignore'):
+            climb = -np.arctan(self.vertical_rate / self.velocity) / f(math.pi) * f(180)
+        self.climb_angle = np.where(self.velocity > f(1.0e-6), climb, f(0))
+
+        # Change in x, y, z, in km/s
+        speed_km_s = self.velocity / f(1000)
+        heading_radians = self.heading * f(math.pi) / f(180)
+        self.delta = np.stack((
+            np.sin(heading_radians) * speed_km_s,
+            np.cos(heading_radians) * speed_km_s,
+            self.vertical_rate / f(1000)
+        ), axis=-1)
+
+        self.map_change(map)
+        self.observer_change(observer)
+
+    def __len__(self):
+        return len(self.lat)
+
+    def map_change(self, map):
+        """Recompute the map positions for another map, as PlaneData.MapChange()"""
+        x, y = map.project(self.lon, self.lat)
+        self.map_position = np.stack((x, y, self.map_altitude / self.dtype.type(1000)), axis=-1)
+
+    def observer_change(self, observer):
+        """Recompute the sky positions for another observer, as PlaneData.ObserverChange()"""
+        self.sky_position = sky_positions(self.lat, self.lon, self.sky_altitude, observer, self.dtype)
+        # Distance from the projection center in km
+        self.observer_distance = np.sqrt(np.einsum('ij,ij->i', self.sky_position, self.sky_position)) / self.dtype.type(1000)
+
+    def update_state(self, t):
+        """NORMAL, LATE or MISSING for each plane at time t (seconds since the epoch)"""
+        t_diff = t - self.time_position
+        return np.where(t_diff > MISSING_SECONDS, MISSING, np.where(t_diff > LATE_SECONDS, LATE, NORMAL))
+
+    def extrapolate(self, t):
+        """
+        Extrapolated positions at time t (seconds since the epoch), as PlaneData.Update().
+        Returns (computed_map_position, computed_sky_position), arrays of shape (N, 3)
+        in kilometers and meters respectively. Note that, unlike the app, planes that
+        are MISSING are extrapolated as well, use update_state() to filter them.
+        """
+        f = self.dtype.type
+        t_diff = (t - self.time_position).astype(self.dtype)[:,None]
+        step = t_diff * self.delta
+        return (self.map_position + step, self.sky_position + step * f(1000))
+
+    def extrapolate_altitudes(self, t):
+        """Returns (computed_barometric_altitude, computed_geometric_altitude) at time t,
+        named as in the app (see the note at the top)"""
+        t_diff = (t - self.time_position).astype(self.dtype)
+        return (self.map_altitude + t_diff * self.vertical_rate, self.sky_altitude + t_diff * self.vertical_rate)
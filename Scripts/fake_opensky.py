@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Local stand-in for the OpenSky Network REST API, serving /api/states/all
+# (with the optional lamin/lamax/lomin/lomax bounding box), for testing and
+# offline use of record_opensky.py and other scripts.
+#
+# By default the traffic is synthetic: a fixed set of planes (determined by
+# the seed) making repeated flights along straight lines or constant-rate
+# turns, starting within an area.
+# With --replay the snapshots of a recorded state archive are served instead,
+# in (optionally sped up) real time, looping at the end.
+import sys, time, json, math, argparse
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+from statearchive import StateArchive
+
+# Meters per degree of latitude, as used for the local flat approximation
+METERS_PER_DEGREE = 6378136.98 * math.pi / 180.0
+
+# Duration of a synthetic flight, after which the plane starts a new one elsewhere
+FLIGHT_SECONDS = 1200
+
+class SyntheticTraffic:
+
+    """
+    count planes in the given lat/lon area. Planes fly at constant speed and
+    altitude rate, about a third of them in constant-rate turns. Each plane
+    starts a new flight every FLIGHT_SECONDS, from a different position and
+    heading. Planes outside of the area are not reported.
+    """
+
+    def __init__(self, count, lat_range, lon_range, seed=0):
+        rng = np.random.default_rng(seed)
+        self.lat_range = lat_range
+        self.lon_range = lon_range
+
+        self.icao24 = ['%06x' % v for v in rng.choice(1 << 24, count, replace=False)]
+        self.callsign = ['%s%d' % (''.join(rng.choice(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'), 3)), rng.integers(10, 9999))
+            for i in range(count)]
+        # Start positions of the first flight, as fractions of the area
+        self.u0 = rng.random((2, count))
+        self.offset = rng.integers(0, FLIGHT_SECONDS, count)
+        self.heading0 = rng.uniform(0, 360, count)
+        self.velocity = rng.uniform(60, 260, count)
+        self.altitude0 = rng.uniform(300, 12000, count)
+        self.vertical_rate = np.where(rng.random(count) < 0.3, rng.uniform(-10, 10, count), 0.0)
+        # Turn rate in degrees/s
+        self.turn_rate = np.where(rng.random(count) < 0.35, rng.uniform(-3, 3, count), 0.0)
+        self.on_ground = rng.random(count) < 0.05
+        self.velocity[self.on_ground] = rng.uniform(0, 15, np.count_nonzero(self.on_ground))
+        self.altitude0[self.on_ground] = 0.0
+        self.vertical_rate[self.on_ground] = 0.0
+        self.seed = seed
+        self.start = int(time.time())
+
+    def states(self, t):
+        # Some updates have missing values, as in the real data. Same values for the same t
+        rng = np.random.default_rng([self.seed, t])
+        count = len(self.icao24)
+        missing_time = rng.random(count) < 0.02
+        missing_geo = rng.random(count) < 0.1
+        # Positions are at time_position, which lags the response time
+        lag = rng.integers(0, 5, count)
+        flight, dt = np.divmod(t - lag - self.start + self.offset, FLIGHT_SECONDS)
+
+        # Each flight starts elsewhere (low-discrepancy steps, no random state needed)
+        u = np.mod(self.u0 + flight * np.array([[0.618034], [0.414214]]), 1.0)
+        lat0 = self.lat_range[0] + u[0] * (self.lat_range[1] - self.lat_range[0])
+        lon0 = self.lon_range[0] + u[1] * (self.lon_range[1] - self.lon_range[0])
+        h0 = np.radians(self.heading0 + flight * 137.5)
+        w = np.radians(self.turn_rate)
+        h = h0 + w * dt
+        v = self.velocity
+
+        # Displacement in meters east (x) and north (y), heading clockwise from north
+        turning = w != 0
+        safe_w = np.where(turning, w, 1.0)
+        x = np.where(turning, v / safe_w * (np.cos(h0) - np.cos(h)), v * np.sin(h0) * dt)
+        y = np.where(turning, v / safe_w * (np.sin(h) - np.sin(h0)), v * np.cos(h0) * dt)
+
+        lat = lat0 + y / METERS_PER_DEGREE
+        # Longitude scale at the mean latitude along the path, so tracks match the headings
+        lon = lon0 + x / (METERS_PER_DEGREE * np.cos(np.radians(0.5 * (lat0 + lat))))
+        inside = ((lat >= self.lat_range[0]) & (lat <= self.lat_range[1]) &
+            (lon >= self.lon_range[0]) & (lon <= self.lon_range[1]))
+
+        altitude = self.altitude0 + self.vertical_rate * dt
+        # Level off at the altitude limits
+        vertical_rate = np.where((altitude > 0) & (altitude < 13000), self.vertical_rate, 0.0)
+        altitude = np.clip(altitude, 0, 13000)
+        heading = np.mod(np.degrees(h), 360)
+
+        states = []
+        for i in np.nonzero(inside)[0]:
+            states.append([
+                self.icao24[i], '%-8s' % self.callsign[i], 'Nowhere',
+                None if missing_time[i] else int(t - lag[i]), int(t),
+                round(float(lon[i]), 4), round(float(lat[i]), 4),
+                None if self.on_ground[i] else round(float(altitude[i]), 2),
+                bool(self.on_ground[i]), round(float(v[i]), 2), round(float(heading[i]), 2),
+                None if self.on_ground[i] else round(float(vertical_rate[i]), 2),
+                None,
+                None if (self.on_ground[i] or missing_geo[i]) else round(float(altitude[i]) + 40.0, 2),
+                None, False, 0
+            ])
+        return states
+
+class ArchiveReplay:
+
+    """Serves the snapshots of a state archive, speed times faster than real time"""
+
+    def __init__(self, directory, speed=1.0):
+        self.archive = StateArchive(directory)
+        assert len(self.archive) > 0, 'Archive %s is empty' % directory
+        self.speed = speed
+        self.start = time.time()
+
+    def snapshot(self, t):
+        a = self.archive
+        first = a.snapshot_time[0]
+        duration = a.snapshot_time[-1] - first + 1
+        archive_time = first + ((t - self.start) * self.speed) % duration
+        i = max(a.snapshot_index(archive_time), 0)
+        return int(a.snapshot_time[i]), a.states(i)
+
+def in_bbox(state, bbox):
+    lamin, lamax, lomin, lomax = bbox
+    lon, lat = state[5], state[6]
+    if lon is None or lat is None:
+        return False
+    return lamin <= lat <= lamax and lomin <= lon <= lomax
+
+def make_handler(source, resolution):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/api/states/all':
+                self.send_error(404)
+                return
+
+            query = parse_qs(url.query)
+            try:
+                bbox = [float(query[k][0]) if k in query else d for k, d in
+                    [('lamin', -90.0), ('lamax', 90.0), ('lomin', -180.0), ('lomax', 180.0)]]
+            except ValueError:
+                self.send_error(400)
+                return
+
+            now = time.time()
+            if isinstance(source, ArchiveReplay):
+                t, states = source.snapshot(now)
+            else:
+                # The API only provides new data every resolution seconds
+                t = int(now) - int(now) % resolution
+                states = source.states(t)
+
+            states = [s for s in states if in_bbox(s, bbox)]
+            body = json.dumps(dict(time=t, states=states)).encode('utf8')
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Local stand-in for the OpenSky Network states API')
+    parser.add_argument('--port', type=int, default=8800,
+        help='Port to listen on (default: %(default)d)')
+    parser.add_argument('--planes', type=int, default=400,
+        help='Number of synthetic planes (default: %(default)d)')
+    parser.add_argument('--lat-range', type=float, nargs=2, default=[50.513427, 53.748711],
+        help='Latitude range of the synthetic traffic (default: %(default)s, i.e. the netherlands map)')
+    parser.add_argument('--lon-range', type=float, nargs=2, default=[2.812500, 7.734375],
+        help='Longitude range of the synthetic traffic (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--resolution', type=int, default=10,
+        help='Time resolution of the synthetic data in seconds, as for anonymous API access (default: %(default)d)')
+    parser.add_argument('--replay', metavar='ARCHIVE',
+        help='Serve the snapshots from a state archive recorded with record_opensky.py')
+    parser.add_argument('--speed', type=float, default=1.0,
+        help='Replay speed factor (default: %(default)s)')
+    options = parser.parse_args()
+
+    if options.replay is not None:
+        source = ArchiveReplay(options.replay, options.speed)
+        print('Replaying %d snapshots from %s' % (len(source.archive), options.replay))
+    else:
+        source = SyntheticTraffic(options.planes, options.lat_range, options.lon_range, options.seed)
+        print('Serving %d synthetic planes' % options.planes)
+
+    server = ThreadingHTTPServer(('', options.port), make_handler(source, options.resolution))
+    print('Listening on http://localhost:%d/api/states/all' % options.port)
+    sys.stdout.flush()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
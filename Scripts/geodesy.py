@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Batch conversion of WGS84 lat/lon/altitude to observer-local coordinates,
+# in float64, for arrays of points at once.
+#
+# The app computes the sky positions of planes (PlaneData.ProcessDataUpdate)
+# and landmarks (RecomputeLandmarkPositions) in float32, with a chain of
+# rotations on a spherical Earth of radius Projection.RADIUS_METERS. Here the
+# points are converted to Earth-centered Earth-fixed (ECEF) coordinates and
+# from there to the local East-North-Up (ENU) frame of the observer, either
+# on the WGS84 ellipsoid or (model 'sphere') on the app's sphere, which gives
+# the same result as the app's math (see extrapolation.sky_positions, which
+# follows the app step by step).
+#
+# Axes:
+#
+#   ENU         +X east, +Y north, +Z up, i.e. the app's sky coordinate system
+#               ("Z-up", as landmark.sky_position)
+#   StereoKit   +X east, +Y up, -Z north, i.e. ENU rotated as ROT_90_X in the
+#               app, the (Y-up) system the alignment reference points and the
+#               calibration ground truth (calib-fd.py) are in
+#
+# The observer is (lat, lon, altitude) of the origin. Altitudes of points and
+# observer should be relative to the same surface (the app uses meters above
+# sea level throughout), so the offset between it and the ellipsoid mostly
+# cancels out over the distances involved.
+import math
+import numpy as np
+from webmercator import RADIUS_METERS
+
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_E2 = WGS84_F * (2 - WGS84_F)
+
+# Model name -> (semi-major axis, first eccentricity squared)
+MODELS = {
+    'wgs84': (WGS84_A, WGS84_E2),
+    'sphere': (RADIUS_METERS, 0.0),
+}
+
+
+def geodetic_to_ecef(lat, lon, altitude, model='wgs84'):
+    """ECEF coordinates (..., 3) in meters of points at lat/lon (degrees) and altitude (meters)"""
+    a, e2 = MODELS[model]
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    altitude = np.asarray(altitude, dtype=np.float64)
+
+    sin_lat = np.sin(lat)
+    cos_lat = np.cos(lat)
+    # Prime vertical radius of curvature
+    n = a / np.sqrt(1 - e2 * sin_lat * sin_lat)
+
+    x = (n + altitude) * cos_lat * np.cos(lon)
+    y = (n + altitude) * cos_lat * np.sin(lon)
+    z = (n * (1 - e2) + altitude) * sin_lat
+    return np.stack(np.broadcast_arrays(x, y, z), axis=-1)
+
+def enu_rotation(lat, lon):
+    """Rotation matrix (rows east, north, up) from ECEF to the ENU frame at lat/lon (degrees)"""
+    lat = math.radians(lat)
+    lon = math.radians(lon)
+    sin_lat, cos_lat = math.sin(lat), math.cos(lat)
+    sin_lon, cos_lon = math.sin(lon), math.cos(lon)
+    return np.array([
+        [-sin_lon,              cos_lon,            0.0],
+        [-sin_lat * cos_lon,    -sin_lat * sin_lon, cos_lat],
+        [cos_lat * cos_lon,     cos_lat * sin_lon,  sin_lat],
+    ])
+
+def geodetic_to_enu(lat, lon, altitude, observer, model='wgs84'):
+    """
+    Positions (..., 3) in meters in the ENU frame of observer (lat, lon, altitude),
+    for points at the given lat/lon (degrees) and altitude (meters)
+    """
+    obs_lat, obs_lon, obs_altitude = [float(v) for v in observer]
+    origin = geodetic_to_ecef(obs_lat, obs_lon, obs_altitude, model)
+    d = geodetic_to_ecef(lat, lon, altitude, model) - origin
+    return d @ enu_rotation(obs_lat, obs_lon).T
+
+def enu_to_stereokit(enu):
+    """ENU positions (..., 3) to StereoKit axes (east, up, -north)"""
+    enu = np.asarray(enu, dtype=np.float64)
+    return np.stack((enu[..., 0], enu[..., 2], -enu[..., 1]), axis=-1)
+
+def stereokit_to_enu(p):
+    p = np.asarray(p, dtype=np.float64)
+    return np.stack((p[..., 0], -p[..., 2], p[..., 1]), axis=-1)
+
+def geodetic_to_stereokit(lat, lon, altitude, observer, model='wgs84'):
+    """As geodetic_to_enu(), in StereoKit axes"""
+    return enu_to_stereokit(geodetic_to_enu(lat, lon, altitude, observer, model))
+
+def enu_to_horizontal(enu):
+    """Azimuth (degrees clockwise from north), elevation (degrees) and distance (meters) of ENU positions"""
+    enu = np.asarray(enu, dtype=np.float64)
+    e, n, u = enu[..., 0], enu[..., 1], enu[..., 2]
+    horizontal = np.hypot(e, n)
+    azimuth = np.degrees(np.arctan2(e, n)) % 360
+    elevation = np.degrees(np.arctan2(u, horizontal))
+    return azimuth, elevation, np.hypot(horizontal, u)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Uniform lat/lon grid spatial index, for answering bounding box queries
+# (as the lamin/lamax/lomin/lomax parameters of the OpenSky API) on a set
+# of points without testing every point.
+import math
+import numpy as np
+
+class GridIndex:
+
+    """
+    Index on arrays of lat/lon points (degrees), with square cells of cell_size
+    degrees. The point indices are sorted on cell, with the cells numbered row
+    by row, so the cells of one grid row overlapping a query bbox form a single
+    contiguous range of points.
+    """
+
+    def __init__(self, lat, lon, cell_size=0.5):
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.cell_size = cell_size
+
+        valid = np.isfinite(self.lat) & np.isfinite(self.lon)
+        points = np.nonzero(valid)[0]
+
+        if len(points) == 0:
+            self.lat0 = self.lon0 = 0.0
+            self.rows = self.cols = 1
+        else:
+            self.lat0 = math.floor(self.lat[points].min() / cell_size) * cell_size
+            self.lon0 = math.floor(self.lon[points].min() / cell_size) * cell_size
+            self.rows = int((self.lat[points].max() - self.lat0) // cell_size) + 1
+            self.cols = int((self.lon[points].max() - self.lon0) // cell_size) + 1
+
+        cells = self._cell(self.lat[points], self.lon[points])
+        order = np.argsort(cells, kind='stable')
+        self.points = points[order]
+        self.cells = cells[order]
+
+    def _row_col(self, lat, lon):
+        row = np.floor((lat - self.lat0) / self.cell_size).astype(np.int64)
+        col = np.floor((lon - self.lon0) / self.cell_size).astype(np.int64)
+        return row, col
+
+    def _cell(self, lat, lon):
+        row, col = self._row_col(lat, lon)
+        return row * self.cols + col
+
+    def __len__(self):
+        return len(self.points)
+
+    def query(self, lamin, lamax, lomin, lomax):
+        """Return the indices (sorted) of the points within the bbox, bounds inclusive"""
+
+        (r0, r1), (c0, c1) = self._row_col(np.array([lamin, lamax]), np.array([lomin, lomax]))
+        r0, r1 = max(r0, 0), min(r1, self.rows - 1)
+        c0, c1 = max(c0, 0), min(c1, self.cols - 1)
+        if r0 > r1 or c0 > c1:
+            return np.zeros(0, dtype=np.int64)
+
+        rows = np.arange(r0, r1 + 1)
+        starts = np.searchsorted(self.cells, rows * self.cols + c0, side='left')
+        ends = np.searchsorted(self.cells, rows * self.cols + c1, side='right')
+        candidates = np.concatenate([self.points[s:e] for s, e in zip(starts, ends)])
+
+        # Only points in the border cells can be outside of the bbox
+        lat = self.lat[candidates]
+        lon = self.lon[candidates]
+        inside = (lat >= lamin) & (lat <= lamax) & (lon >= lomin) & (lon <= lomax)
+        return np.sort(candidates[inside])
@@ -1,29 +1,78 @@
 #!/usr/bin/env python
 # This uses https://pypi.org/project/qrcode/
-import sys, os, json, gzip
+import sys, os, json, argparse
 from PIL import ImageDraw
 import qrcode
+from qrpayload import make_qrcodes, decode_parts, error_correction_name, compress
 
-if len(sys.argv) < 3:
-    print('Usage: %s file.json qrimage.png' % sys.argv[0])
-    sys.exit(-1)
+def label(img, s):
+    """Label image"""
+    draw = ImageDraw.Draw(img)
+    sz = draw.textsize(s)
+    x = img.size[0]/2 - sz[0]/2
+    y = img.size[0] - 24
+    draw.text((x,y), s, fill='black')
+    del draw
 
-data = json.load(open(sys.argv[1],'rt'))
-# Dump back to strip unnecessary whitespace
-js = json.dumps(data).encode('utf8')
-#cs = gzip.compress(s, 9)
+def write_qrcodes(js, image_file, label_text, compressed=False, min_error_correction='L', max_version=25):
+    """
+    Write QR code(s) for the JSON data js (bytes). Uncompressed data always gives a
+    single image image_file. Compressed data that needs multiple QR codes is written
+    to image_file with -1, -2, ... added before the extension.
+    Returns a list of (file name, QR code text or data, QRCode object or None).
+    """
 
-img = qrcode.make(js)
+    if not compressed:
+        img = qrcode.make(js)
+        label(img, label_text)
+        img.save(image_file)
+        return [(image_file, js, None)]
 
-# Label image
-draw = ImageDraw.Draw(img)
-s = os.path.abspath(sys.argv[1])
-sz = draw.textsize(s)
-x = img.size[0]/2 - sz[0]/2
-y = img.size[0] - 24
-draw.text((x,y), s, fill='black')
-del draw
+    codes = make_qrcodes(js, min_error_correction, max_version)
+    assert decode_parts([part for part, qr in codes]) == js
 
-img.save(sys.argv[2])
+    base, ext = os.path.splitext(image_file)
+    written = []
+    for idx, (part, qr) in enumerate(codes):
+        img = qr.make_image()
+        if len(codes) == 1:
+            fname = image_file
+            label(img, label_text)
+        else:
+            fname = '%s-%d%s' % (base, idx+1, ext)
+            label(img, '%s (%d/%d)' % (label_text, idx+1, len(codes)))
+        img.save(fname)
+        written.append((fname, part, qr))
 
+    return written
 
+def minified_json(fname):
+    data = json.load(open(fname,'rt'))
+    # Dump back to strip unnecessary whitespace
+    return json.dumps(data, separators=(',', ':')).encode('utf8')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(usage='%(prog)s [options] file.json qrimage.png')
+    parser.add_argument('-z', '--compress', action='store_true',
+        help='Store the JSON compressed, using the smallest QR code version and strongest error correction ' +
+             'that fits. If needed the data is split over multiple QR codes qrimage-1.png, qrimage-2.png, ...')
+    parser.add_argument('--max-version', type=int, default=25,
+        help='With --compress, maximum QR code version (i.e. density) of a single code, 1-40 (default: %(default)d)')
+    parser.add_argument('--error-correction', choices=['L', 'M', 'Q', 'H'], default='L',
+        help='With --compress, minimum error correction level (default: %(default)s)')
+    parser.add_argument('json_file', help=argparse.SUPPRESS)
+    parser.add_argument('image_file', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    js = minified_json(options.json_file)
+    s = os.path.abspath(options.json_file)
+
+    written = write_qrcodes(js, options.image_file, s, options.compress, options.error_correction, options.max_version)
+
+    if options.compress:
+        print('%d bytes of JSON, %d bytes compressed, %d QR code(s)' % (len(js), len(compress(js)), len(written)))
+        for fname, part, qr in written:
+            print('%s: %d characters, version %d, error correction %s' % \
+                (fname, len(part), qr.version, error_correction_name(qr)))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Calibration ground truth for calib-fd.py from a configuration file: the
+# positions of the landmarks of a landmark set (their top, at 'topalt')
+# relative to an observer, in meters in StereoKit axes (+X east, +Y up,
+# -Z north), computed in float64 with geodesy.py.
+#
+# As in RecomputeLandmarkPositions() the origin is at the observer's floor
+# altitude (use --head-height to put it at eye level instead). By default
+# the WGS84 ellipsoid is used, with --model sphere the positions are those
+# the app would compute (without its float32 rounding). The difference to
+# the app's float32 positions is printed per landmark.
+#
+# The output file holds the points plus how they were made:
+#
+#   { "config": ..., "landmark_set": ..., "observer": "<set>/<id>",
+#     "origin": [lat, lon, altitude], "model": ..., "head_height": ...,
+#     "points": { "<landmark id>": [x, y, z], ... } }
+#
+# Use it with calib-fd.py --ground-truth <file>.
+import sys, os, json, argparse
+import numpy as np
+from compile_config import compile_config
+from extrapolation import sky_positions, HEAD_HEIGHT
+from geodesy import geodetic_to_enu, enu_to_stereokit, enu_to_horizontal, MODELS
+
+
+def select(sets, kind, id):
+    """The set with the given id, or the only one if id is None"""
+    ids = [s['id'] for s in sets]
+    if id is None:
+        assert len(sets) == 1, 'Configuration has %d %s (%s), select one' % (len(sets), kind, ', '.join(ids))
+        return sets[0]
+    assert id in ids, 'No %s "%s" in the configuration (%s)' % (kind, id, ', '.join(ids))
+    return sets[ids.index(id)]
+
+def find_observer(observer_sets, name):
+    """Observer "<set>/<id>" (or just "<id>" if unique, or None for the only one)"""
+    observers = [(s['id'], o) for s in observer_sets for o in s['items']]
+    names = ['%s/%s' % (s, o['id']) for s, o in observers]
+    if name is None:
+        assert len(observers) == 1, 'Configuration has %d observers (%s), select one' % (len(observers), ', '.join(names))
+        return names[0], observers[0][1]
+    matches = [i for i, n in enumerate(names) if n == name or n.split('/', 1)[1] == name]
+    assert len(matches) == 1, 'Observer "%s" %s (%s)' % (name, 'is ambiguous' if matches else 'not found', ', '.join(names))
+    return names[matches[0]], observers[matches[0]][1]
+
+def app_positions(lat, lon, altitude, observer):
+    """
+    Landmark positions as computed in the app, in float32 on its sphere, in
+    StereoKit axes (floor_altitude - HEAD_HEIGHT compensates for the head height
+    sky_positions() adds, as RecomputeLandmarkPositions() doesn't)
+    """
+    f = np.float32
+    lat32, lon32, alt32 = [np.asarray(v, dtype=f) for v in (lat, lon, altitude)]
+    obs = (f(observer['lat']), f(observer['lon']), f(observer['floor_altitude']) - f(HEAD_HEIGHT))
+    return enu_to_stereokit(sky_positions(lat32, lon32, alt32, obs, np.float32))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Calibration ground truth (landmark positions relative to an observer) from a configuration')
+    parser.add_argument('config',
+        help='Configuration JSON file with landmark_sets and observer_sets')
+    parser.add_argument('-l', '--landmark-set',
+        help='Landmark set id (default: the only one)')
+    parser.add_argument('-O', '--observer',
+        help='Observer, as <set>/<id> or just <id> (default: the only one)')
+    parser.add_argument('--model', choices=sorted(MODELS.keys()), default='wgs84',
+        help='Earth model, sphere is the one used in the app (default: %(default)s)')
+    parser.add_argument('--head-height', type=float, default=0.0,
+        help='Put the origin this many meters above the floor (default: %(default)s, i.e. at the floor)')
+    parser.add_argument('-o', '--output',
+        help='Ground truth JSON file to write')
+    options = parser.parse_args()
+
+    config = json.load(open(options.config, 'rt'))
+    compiled, problems = compile_config(config, os.path.dirname(os.path.abspath(options.config)))
+    for e in problems.errors:
+        print('error: %s' % e)
+    if problems.errors:
+        print('%s: fix the errors first (see compile_config.py)' % options.config)
+        sys.exit(-1)
+
+    landmark_set = select(compiled.get('landmark_sets', []), 'landmark sets', options.landmark_set)
+    observer_name, observer = find_observer(compiled.get('observer_sets', []), options.observer)
+    origin = (observer['lat'], observer['lon'], observer['floor_altitude'] + options.head_height)
+
+    items = landmark_set['items']
+    lat = [item['lat'] for item in items]
+    lon = [item['lon'] for item in items]
+    altitude = [item['topalt'] for item in items]
+
+    enu = geodetic_to_enu(lat, lon, altitude, origin, options.model)
+    points = enu_to_stereokit(enu)
+    azimuth, elevation, distance = enu_to_horizontal(enu)
+
+    # The app's positions, moved to the same origin height
+    app = app_positions(lat, lon, altitude, observer) - np.array([0.0, options.head_height, 0.0])
+    app_error = np.linalg.norm(app - points, axis=-1)
+
+    print('Landmark set "%s", observer %s (lat %.6f, lon %.6f, altitude %.2f m), %s' % (landmark_set['id'],
+        observer_name, origin[0], origin[1], origin[2], options.model))
+    print('%-12s %11s %9s %11s %8s %7s %10s %9s' % ('landmark', 'x', 'y', 'z', 'azimuth', 'elev', 'distance', 'app err'))
+    for idx, item in enumerate(items):
+        x, y, z = points[idx]
+        print('%-12s %11.4f %9.4f %11.4f %8.3f %7.3f %10.2f %8.3fm' % (item['id'], x, y, z,
+            azimuth[idx], elevation[idx], distance[idx], app_error[idx]))
+
+    if options.output is not None:
+        result = {
+            'config': os.path.basename(options.config),
+            'landmark_set': landmark_set['id'],
+            'observer': observer_name,
+            'origin': list(origin),
+            'model': options.model,
+            'head_height': options.head_height,
+            'points': dict((item['id'], [round(float(v), 4) for v in points[idx]]) for idx, item in enumerate(items))
+        }
+        json.dump(result, open(options.output, 'wt'), indent=4)
+        print('Wrote %s' % options.output)
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Traffic density heatmap over recorded state vectors (see record_opensky.py),
+# as a transparent overlay image for a map built with make_osm_map.py: the
+# overlay has the same Web Mercator extent and pixel grid as the map image,
+# and its .png.json the same lat/lon range and zoom.
+#
+# Archives are processed a chunk of snapshots at a time, and positions are
+# binned with numpy.bincount into a raster of the map's size, so memory use
+# only depends on the map (and chunk) size, not on the amount of recorded
+# traffic. Repeated positions (same aircraft and time_position, i.e. no new
+# position report) are counted once.
+#
+# By default each position report is counted in its pixel. With --lines the
+# track between consecutive reports of an aircraft is drawn instead, and each
+# pixel gets the time spent in it (aircraft seconds), which gives a smooth view
+# of routes and holding patterns even for sparse snapshots. With --bands a
+# separate overlay is written per (barometric) altitude band.
+import sys, os, json, argparse
+import numpy as np
+from PIL import Image
+from statearchive import StateArchive, parse_time
+from webmercator import actual_map_extent, coordinates_to_tile_positions, tiles_nw_corners, TILE_SIZE
+from make_osm_map import MAPS, map_metadata
+
+# Maximum number of state vector rows per chunk
+CHUNK_ROWS = 1 << 20
+
+# Maximum number of line samples binned at once
+SAMPLE_BATCH = 1 << 22
+
+# The last report of each aircraft is kept this long (or --max-gap if longer),
+# to recognize repeats of it in later chunks. OpenSky repeats the last known
+# position of an aircraft for up to 300 seconds.
+CARRY_SECONDS = 300
+
+# Color ramp for the normalized (log) density, (value, (r, g, b, a)).
+# Zero density is fully transparent.
+HEAT_COLORS = [
+    (0.0,   (0, 0, 255, 0)),
+    (0.15,  (0, 64, 255, 96)),
+    (0.4,   (0, 200, 255, 160)),
+    (0.65,  (255, 255, 0, 200)),
+    (0.85,  (255, 128, 0, 230)),
+    (1.0,   (255, 0, 0, 255)),
+]
+
+
+class Raster:
+
+    """Pixel grid of a map image, from its zoom level and tile range"""
+
+    def __init__(self, name, zoom, tiles, downsample=1):
+        self.name = name
+        self.zoom = zoom
+        self.min_i, self.max_i, self.min_j, self.max_j = tiles
+        self.downsample = downsample
+        assert TILE_SIZE % downsample == 0
+        self.scale = TILE_SIZE // downsample
+        self.width = (self.max_i - self.min_i + 1) * self.scale
+        self.height = (self.max_j - self.min_j + 1) * self.scale
+
+    @staticmethod
+    def from_map(map_arg, downsample=1):
+        """From a map name in make_osm_map.MAPS, or the .png.json of a map image"""
+        if map_arg in MAPS:
+            m = MAPS[map_arg]
+            tiles, extent = actual_map_extent(m['lat_range'], m['lon_range'], m['zoom'], np.float64)
+            return Raster(map_arg, m['zoom'], tiles, downsample)
+
+        assert os.path.isfile(map_arg), 'Unknown map %s (not a predefined map or .png.json file)' % map_arg
+        m = json.load(open(map_arg, 'rt'))
+        assert 'zoom' in m, '%s has no zoom level, not made by make_osm_map.py?' % map_arg
+        # The extent is tile aligned, so its corners are at whole tile positions
+        x, y = coordinates_to_tile_positions([m['lat_range'][1], m['lat_range'][0]], [m['lon_range'][0], m['lon_range'][1]], m['zoom'])
+        x, y = np.round(x).astype(int), np.round(y).astype(int)
+        assert np.allclose([x, y], coordinates_to_tile_positions([m['lat_range'][1], m['lat_range'][0]],
+            [m['lon_range'][0], m['lon_range'][1]], m['zoom']), atol=1e-6), '%s: extent is not aligned to tiles' % map_arg
+        name = os.path.basename(map_arg)[:-len('.png.json')] if map_arg.endswith('.png.json') else m.get('name', 'map')
+        return Raster(name, m['zoom'], (x[0], x[1] - 1, y[0], y[1] - 1), downsample)
+
+    def extent(self):
+        """(min_lat, max_lat, min_lon, max_lon) of the tile range, as written by make_osm_map.py"""
+        lat, lon = tiles_nw_corners([self.min_i, self.max_i + 1], [self.min_j, self.max_j + 1], self.zoom)
+        return (float(lat[1]), float(lat[0]), float(lon[0]), float(lon[1]))
+
+    def pixels(self, lat, lon):
+        """Fractional pixel positions (x, y) for arrays of lat/lon"""
+        x, y = coordinates_to_tile_positions(lat, lon, self.zoom)
+        return (x - self.min_i) * self.scale, (y - self.min_j) * self.scale
+
+
+class Heatmap:
+
+    """
+    Accumulates density per pixel, in one layer per altitude band (or a single
+    layer without bands). Positions are added in chunks with add_chunk().
+    """
+
+    def __init__(self, raster, bands=None, lines=False, max_gap=60, on_ground=False):
+        self.raster = raster
+        self.bands = bands
+        self.lines = lines
+        self.max_gap = max_gap
+        self.on_ground = on_ground
+        nlayers = 1 if bands is None else len(bands) - 1
+        self.counts = np.zeros((nlayers, raster.height * raster.width))
+
+        # Last report per aircraft carried over to the next chunk, for
+        # deduplication and lines: columns as in add_chunk()
+        self.carry = None
+        self.positions = 0
+        self.skipped = 0
+        self.time_range = None
+
+    def layer(self, altitude):
+        """Layer index per position, -1 for positions outside the bands"""
+        if self.bands is None:
+            return np.zeros(len(altitude), dtype=np.int64)
+        with np.errstate(invalid='ignore'):
+            idx = np.digitize(altitude, self.bands) - 1
+        idx[~np.isfinite(altitude) | (idx >= len(self.bands) - 1)] = -1
+        return idx
+
+    def bin(self, layer, x, y, weights=None):
+        """Add (weighted) counts for fractional pixel positions inside the raster"""
+        r = self.raster
+        ix, iy = np.floor(x).astype(np.int64), np.floor(y).astype(np.int64)
+        inside = (layer >= 0) & (ix >= 0) & (ix < r.width) & (iy >= 0) & (iy < r.height)
+        cell = (layer[inside] * r.height + iy[inside]) * r.width + ix[inside]
+        w = None if weights is None else weights[inside]
+        # Histogram over the occupied cells only, so the temporary arrays scale
+        # with the number of positions instead of the raster size
+        cells, index = np.unique(cell, return_inverse=True)
+        self.counts.reshape(-1)[cells] += np.bincount(index, w, minlength=len(cells))
+
+    def add_chunk(self, columns):
+        """Add the positions in a dict of state columns (statearchive.STATE_COLUMNS)"""
+        keep = (columns['time_position'] > 0) & np.isfinite(columns['lat']) & np.isfinite(columns['lon'])
+        if not self.on_ground:
+            keep &= columns['on_ground'] == 0
+        self.skipped += int(len(keep) - np.count_nonzero(keep))
+
+        icao24 = columns['icao24'][keep]
+        t = columns['time_position'][keep]
+        if len(t) > 0:
+            t0, t1 = int(t.min()), int(t.max())
+            if self.time_range is not None:
+                t0, t1 = min(t0, self.time_range[0]), max(t1, self.time_range[1])
+            self.time_range = [t0, t1]
+        x, y = self.raster.pixels(columns['lat'][keep], columns['lon'][keep])
+        layer = self.layer(columns['baro_altitude'][keep])
+
+        if self.carry is not None:
+            c_icao24, c_t, c_x, c_y, c_layer = self.carry
+            icao24, t, x, y, layer = [np.concatenate(v) for v in
+                zip((c_icao24, c_t, c_x, c_y, c_layer), (icao24, t, x, y, layer))]
+            ncarry = len(c_t)
+        else:
+            ncarry = 0
+
+        # Reports per aircraft in time order, dropping repeats of the same report
+        order = np.lexsort((t, icao24))
+        icao24, t, x, y, layer = icao24[order], t[order], x[order], y[order], layer[order]
+        carried = order < ncarry
+        same = (icao24[1:] == icao24[:-1])
+        repeat = np.concatenate(([False], same & (t[1:] == t[:-1])))
+        new = ~repeat & ~carried
+
+        if self.lines:
+            dt = (t[1:] - t[:-1]).astype(np.float64)
+            segment = same & (dt > 0) & (dt <= self.max_gap) & new[1:]
+            self.add_segments(x[:-1][segment], y[:-1][segment], x[1:][segment], y[1:][segment],
+                layer[1:][segment], dt[segment])
+        else:
+            self.bin(layer[new], x[new], y[new])
+        self.positions += int(np.count_nonzero(new))
+
+        # Carry the last report of each aircraft, if recent
+        last = np.concatenate((icao24[1:] != icao24[:-1], [True])) if len(t) else np.zeros(0, dtype=bool)
+        last &= t >= (t.max() if len(t) else 0) - max(self.max_gap, CARRY_SECONDS)
+        self.carry = (icao24[last], t[last], x[last], y[last], layer[last])
+
+    def add_segments(self, x0, y0, x1, y1, layer, dt):
+        """Bin samples along the segments, about one per pixel, weighted by time"""
+        length = np.hypot(x1 - x0, y1 - y0)
+        n = np.maximum(np.ceil(length), 1).astype(np.int64)
+        # Split into batches of at most SAMPLE_BATCH samples
+        ends = np.cumsum(n)
+        start = 0
+        while start < len(n):
+            stop = max(int(np.searchsorted(ends, (ends[start - 1] if start else 0) + SAMPLE_BATCH, side='right')), start + 1)
+            s = slice(start, stop)
+            counts = n[s]
+            seg = np.repeat(np.arange(stop - start), counts)
+            # Sample at the middle of each of the n pieces of a segment
+            offsets = np.arange(len(seg)) - np.repeat(np.cumsum(counts) - counts, counts)
+            f = (offsets + 0.5) / counts[seg]
+            xs = x0[s][seg] + f * (x1[s] - x0[s])[seg]
+            ys = y0[s][seg] + f * (y1[s] - y0[s])[seg]
+            # The altitude band of the segment is the one at its end
+            self.bin(layer[s][seg], xs, ys, (dt[s] / counts)[seg])
+            start = stop
+
+    def add_archive(self, archive, start=None, end=None, chunk_rows=CHUNK_ROWS, progress=None):
+        """Add the snapshots of a StateArchive between the start and end times, a chunk at a time"""
+        first = 0 if start is None else int(np.searchsorted(archive.snapshot_time, start, side='left'))
+        stop = len(archive) if end is None else int(np.searchsorted(archive.snapshot_time, end, side='right'))
+        i = first
+        while i < stop:
+            # As many snapshots as fit in chunk_rows, but at least one
+            row0 = archive.snapshot_start[i]
+            j = int(np.searchsorted(archive.snapshot_end, row0 + chunk_rows, side='right'))
+            j = min(max(j, i + 1), stop)
+            rows = slice(row0, archive.snapshot_end[j - 1])
+            self.add_chunk({ name: getattr(archive, name)[rows] for name in archive.column_names() })
+            i = j
+            if progress is not None:
+                progress(i - first, stop - first)
+
+    def layers(self):
+        return self.counts.reshape((-1, self.raster.height, self.raster.width))
+
+
+def colorize(counts, vmax):
+    """RGBA image for a density layer, log scaled with vmax mapping to the top of HEAT_COLORS"""
+    v = np.log1p(counts) / np.log1p(vmax) if vmax > 0 else np.zeros_like(counts)
+    v = np.clip(v, 0, 1)
+    stops = [s for s, c in HEAT_COLORS]
+    rgba = np.stack([np.interp(v, stops, [c[k] for s, c in HEAT_COLORS]) for k in range(4)], axis=-1)
+    rgba[counts <= 0] = 0
+    return Image.fromarray(rgba.round().astype(np.uint8), 'RGBA')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Traffic density heatmap overlay for a map, from recorded state vectors')
+    parser.add_argument('map',
+        help='Map to align to: a map name of make_osm_map.py, or the .png.json of a map image')
+    parser.add_argument('archives', nargs='+', metavar='archive',
+        help='State archive(s), see record_opensky.py')
+    parser.add_argument('-o', '--output',
+        help='Output name, <output>.png and <output>.png.json are written (default: <map>-heatmap)')
+    parser.add_argument('--lines', action='store_true',
+        help='Draw the tracks between consecutive position reports, weighted by time, instead of counting positions')
+    parser.add_argument('--max-gap', type=float, default=60,
+        help='With --lines, only connect reports at most this many seconds apart (default: %(default)s)')
+    parser.add_argument('--bands', type=float, nargs='+', metavar='ALT',
+        help='Altitude band edges in meters, e.g. 0 1000 3000 13000, an overlay is written per band (<output>-<index>)')
+    parser.add_argument('--on-ground', action='store_true',
+        help='Include aircraft on the ground')
+    parser.add_argument('--start',
+        help='Only snapshots from this time (unix time or ISO date/time in UTC)')
+    parser.add_argument('--end',
+        help='Only snapshots up to this time (unix time or ISO date/time in UTC)')
+    parser.add_argument('--downsample', type=int, default=1, choices=[1, 2, 4, 8],
+        help='Overlay resolution relative to the map image, e.g. 2 to match its -2 pyramid level (default: %(default)d)')
+    parser.add_argument('--percentile', type=float, default=99.5,
+        help='Density percentile (of the non-empty pixels) shown at full color (default: %(default)s)')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS,
+        help='Maximum number of state vectors processed at once (default: %(default)d)')
+    options = parser.parse_args()
+
+    if options.bands is not None:
+        assert len(options.bands) >= 2 and all(a < b for a, b in zip(options.bands[:-1], options.bands[1:])), \
+            '--bands needs at least two increasing altitudes'
+
+    raster = Raster.from_map(options.map, options.downsample)
+    output = options.output or raster.name + '-heatmap'
+    print('Map %s: zoom %d, tiles i = %d-%d, j = %d-%d, overlay %d x %d pixels' % (raster.name, raster.zoom,
+        raster.min_i, raster.max_i, raster.min_j, raster.max_j, raster.width, raster.height))
+
+    start = None if options.start is None else parse_time(options.start)
+    end = None if options.end is None else parse_time(options.end)
+
+    heatmap = Heatmap(raster, options.bands, options.lines, options.max_gap, options.on_ground)
+    for fname in options.archives:
+        archive = StateArchive(fname)
+        print('%s: %d snapshots, %d states' % (fname, len(archive), archive.rows))
+
+        def progress(done, total):
+            sys.stdout.write('\r%d / %d snapshots' % (done, total))
+            sys.stdout.flush()
+
+        heatmap.add_archive(archive, start, end, options.chunk_rows, progress)
+        print()
+        # Tracks don't continue into another archive
+        heatmap.carry = None
+
+    print('%d positions, %d states skipped (no position%s)' % (heatmap.positions, heatmap.skipped,
+        '' if options.on_ground else ' or on ground'))
+    assert heatmap.positions > 0, 'No positions in the given time range'
+
+    def scale_max(counts):
+        nonzero = counts[counts > 0]
+        return float(np.percentile(nonzero, options.percentile)) if len(nonzero) else 0.0
+
+    layers = heatmap.layers()
+    total = layers.sum(axis=0)
+    units = 'seconds' if options.lines else 'positions'
+    vmax = scale_max(total)
+    print('%g %s on the map, %.3g %s per pixel at percentile %g' % (total.sum(), units, vmax, units, options.percentile))
+
+    outputs = [(output, total, None, vmax)]
+    if options.bands is not None:
+        # The bands use the same scale, so they can be compared
+        band_max = scale_max(layers)
+        outputs += [('%s-%d' % (output, k), layers[k], options.bands[k:k+2], band_max) for k in range(len(layers))]
+
+    extent = raster.extent()
+    for name, counts, band, vmax in outputs:
+        img = colorize(counts, vmax)
+        img.save(name + '.png')
+
+        m = map_metadata(os.path.basename(name), extent, raster.zoom)
+        m['overlay'] = dict(
+            type='heatmap',
+            base=raster.name,
+            units=units,
+            scale='log',
+            max=vmax,
+            downsample=options.downsample,
+            time_range=heatmap.time_range,
+            positions=heatmap.positions
+        )
+        if band is not None:
+            m['overlay']['altitude_range'] = list(band)
+        with open(name + '.png.json', 'wt') as f:
+            f.write(json.dumps(m, sort_keys=True, indent=4))
+        print('Wrote %s.png (%d x %d)' % (name, img.size[0], img.size[1]))
@@ -4,127 +4,131 @@
 # Retrieves tiles from http://[abc].tile.openstreetmap.org
 # All OSM tiles are 256x256 pixels and are stitched to form a single map image.
 # Paul Melis, SURF <paul.melis@surf.nl>
-import sys, json, math
+import os, sys, json, math, argparse
 from io import BytesIO
 from PIL import Image, ImageDraw, ImageFont
-import requests
+from osmtiles import TileFetcher, OSM_TILE_SERVERS, MAX_RETRIES
+from tilecache import TileCache, DEFAULT_CACHE_FILE
+from pngstream import StreamingPNGWriter
+from texture import write_texture, FORMATS as TEXTURE_FORMATS
+import numpy as np
+from webmercator import actual_map_extent
 
-def coordinate_to_tile(lat_deg, lon_deg, zoom):
-    """Return tile number that contains given lat/lon coordinate"""
-    lat_rad = math.radians(lat_deg)
-    n = 2.0 ** zoom
-    xtile = int((lon_deg + 180.0) / 360.0 * n)
-    ytile = int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
-    return (xtile, ytile)
+TILE_SIZE = 256
 
-def tile_nw_corner(xtile, ytile, zoom):
-    """
-    Convert tile number and zoom to lat/lon coordinate of NW-corner of tile
-
-    Use the function with xtile+1 and/or ytile+1 to get the other corners. 
-    With xtile+0.5 & ytile+0.5 it will return the center of the tile.
-    """
-    n = 2.0 ** zoom
-    lon_deg = xtile / n * 360.0 - 180.0
-    lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * ytile / n)))
-    lat_deg = math.degrees(lat_rad)
-    return (lat_deg, lon_deg)
+# Downsampling factors of the levels written with --pyramid. Each level
+# is computed from the previous one, so these need to be successive powers of 2.
+PYRAMID_LEVELS = [1, 2, 4, 8]
 
+CREDITS = '© OpenStreetMap contributors'
 
-if __name__ == '__main__':
-
-    TILE_SIZE = 256
+def credits_font(image_width):
+    """Return font to use for the OSM credits on an image of the given width"""
+    F = 'arial.ttf'
+    C = CREDITS
+    # Assuming image width translates to 1.5m MR size, aim for credits 10cm wide
+    tw = int(image_width / 15)
+    font_size = 4
+    font = ImageFont.truetype(F, font_size)
+    while font.getsize(C)[0] < tw:
+        font_size += 1
+        font = ImageFont.truetype(F, font_size)
+        
+    font_size = max(font_size, 11)
+    return ImageFont.truetype(F, font_size)
 
-    # XXX should use left-right, bottom-top for range names
-    # XXX write metadata to separate json file
+def draw_credits(img, image_size, font, offset_y=0):
+    """
+    Draw the OSM credits in the lower-right corner of an image of size image_size.
+    img can also be a horizontal strip of that image, starting at row offset_y,
+    in which case only the part of the credits overlapping the strip is drawn.
+    """
+    C = CREDITS
+    draw = ImageDraw.Draw(img)
+    tw, th = font.getsize(C)
+    x = image_size[0] - tw - 10
+    y = image_size[1] - th - 10 - offset_y
+    draw.rectangle((x-5,y-5,x+tw+5,y+th+5), fill=(255,255,255))    
+    draw.text((x,y), C, fill=(128,128,255), font=font)
+    del draw
 
-    # Retrieves tiles based on range that needs to be covered,
-    # and pastes them together into a single image.
-    # Note: the output image will (in almost all cases) cover an area
-    # larger than requested, as tiles are not clipped.
+# Predefined maps, built with `make_osm_map.py <name>` (or all at once with build_maps.py)
+# XXX should use left-right, bottom-top for range names
+MAPS = {
+    'netherlands': dict(
+        lat_range = [50.513427, 53.748711],
+        lon_range = [2.812500, 7.734375],
+        zoom = 10
+    ),
     
-    maps = {
-        'netherlands': dict(
-            lat_range = [50.513427, 53.748711],
-            lon_range = [2.812500, 7.734375],
-            zoom = 10
-        ),
-        
-        'schiphol': dict(
-            lat_range = [51.9, 52.65],
-            lon_range = [4.130859, 5.361328],
-            zoom = 12
-        ),
-        
-        'eindhoven': dict(
-            lat_range = [51.3143, 51.5847],
-            lon_range = [5.1251, 5.6483],
-            zoom = 12 
-        ),
-        
-        'newyork': dict(
-            lat_range = [40.0365822447532, 41.64694618022861],
-            lon_range = [-76.01054785756074, -72.90784573138009],
-            zoom = 10
-        ),
-        
-        'newyork2': dict(        
-            lat_range = [40.4334, 41.2076],
-            lon_range = [-74.6082, -72.9369],        
-            zoom = 12
-        ),
-        
-        'alps': dict(        
-            lon_range = [5.306, 12.239],
-            lat_range = [45.691, 48.473],
-            zoom = 9
-        )
-    }
+    'schiphol': dict(
+        lat_range = [51.9, 52.65],
+        lon_range = [4.130859, 5.361328],
+        zoom = 12
+    ),
     
-    if len(sys.argv) == 2:
-        mapname = sys.argv[1]
-        map = maps[mapname]
-        lat_range = map['lat_range']
-        lon_range = map['lon_range']
-        zoom = map['zoom']
-        output_name = mapname
-        print('Map "%s"' % mapname)
-    elif len(sys.argv) == 7:
-        lat_range = [float(sys.argv[1]), float(sys.argv[2])]
-        lon_range = [float(sys.argv[3]), float(sys.argv[4])]
-        zoom = int(sys.argv[5])
-        output_name = sys.argv[6]
-    else:
-        print('Usage: %s <min-lat> <max-lat> <min-lon> <max-lon> <zoom> <output-name>' % sys.argv[0])
-        print('       %s <map-name>' % sys.argv[0])
-        print()
-        sys.exit(-1)
-        
-    assert lat_range[0] < lat_range[1]
-    assert lon_range[0] < lon_range[1]    
+    'eindhoven': dict(
+        lat_range = [51.3143, 51.5847],
+        lon_range = [5.1251, 5.6483],
+        zoom = 12 
+    ),
+    
+    'newyork': dict(
+        lat_range = [40.0365822447532, 41.64694618022861],
+        lon_range = [-76.01054785756074, -72.90784573138009],
+        zoom = 10
+    ),
+    
+    'newyork2': dict(        
+        lat_range = [40.4334, 41.2076],
+        lon_range = [-74.6082, -72.9369],        
+        zoom = 12
+    ),
+    
+    'alps': dict(        
+        lon_range = [5.306, 12.239],
+        lat_range = [45.691, 48.473],
+        zoom = 9
+    )
+}
 
-    # Determine tiles needed
-    lat = 0.5*(lat_range[0]+lat_range[1])
-    lon = 0.5*(lon_range[0]+lon_range[1])
+def level_fname(output_name, factor):
+    """Output file name for pyramid level with given downsampling factor"""
+    if factor == 1:
+        return output_name + '.png'
+    return '%s-%d.png' % (output_name, factor)
 
-    maxj = coordinate_to_tile(lat_range[0], lon, zoom)[1]
-    minj = coordinate_to_tile(lat_range[1], lon, zoom)[1]
 
-    mini = coordinate_to_tile(lat, lon_range[0], zoom)[0]
-    maxi = coordinate_to_tile(lat, lon_range[1], zoom)[0]
+def build_map(lat_range, lon_range, zoom, output_name, fetcher, stream=False, pyramid=False, texture=None, verbose=True):
+    """
+    Retrieves the tiles covering the given range and pastes them together into
+    a single image <output_name>.png (plus downsampled levels with pyramid),
+    and writes the map metadata to <output_name>.png.json. Returns the metadata.
+    With texture (a texture.FORMATS name) the image is also written as
+    texture data with mip levels to <output_name>.tex.
+    Note: the output image will (in almost all cases) cover an area larger than
+    requested, as tiles are not clipped.
+    """
 
-    print('tile range: i = %d-%d, j = %d-%d' % (mini, maxi, minj, maxj))
+    assert lat_range[0] < lat_range[1]
+    assert lon_range[0] < lon_range[1]
+
+    def log(s):
+        if verbose:
+            sys.stdout.write(s)
+            sys.stdout.flush()
+
+    # Determine tiles needed, and the lat/lon range from the tile extent
+    (mini, maxi, minj, maxj), (minlat, maxlat, minlon, maxlon) = actual_map_extent(lat_range, lon_range, zoom, np.float64)
+    log('tile range: i = %d-%d, j = %d-%d\n' % (mini, maxi, minj, maxj))
 
     nrows = maxj - minj + 1
     ncols = maxi - mini + 1
 
-    # Determine lat/lon range from tile extent
-    maxlat, minlon = tile_nw_corner(mini, minj, zoom)
-    minlat, maxlon = tile_nw_corner(maxi+1, maxj+1, zoom)
     center_lat = 0.5*(minlat + maxlat)
     center_lon = 0.5*(minlon + maxlon)
-    print('map range: ', minlat, minlon, '->', maxlat, maxlon)
-    print('center: ', center_lat, center_lon)
+    log('map range:  %s %s -> %s %s\n' % (minlat, minlon, maxlat, maxlon))
+    log('center:  %s %s\n' % (center_lat, center_lon))
 
     # Compute map size at center (only used to print)
     R = 6378136.98
@@ -132,74 +136,184 @@ if __name__ == '__main__':
     londiff = maxlon - minlon
     map_width = londiff / 360.0 * 2 * math.pi * r 
     map_height = (maxlat - minlat) / 360.0 * 2*math.pi*R
-    print('Map size at center = %.3f x %.3f km' % (map_width/1000, map_height/1000))
+    log('Map size at center = %.3f x %.3f km\n' % (map_width/1000, map_height/1000))
 
-    img = Image.new('RGB', (ncols*TILE_SIZE, nrows*TILE_SIZE))
+    image_size = (ncols*TILE_SIZE, nrows*TILE_SIZE)
+    fname = os.path.basename(output_name)+'.png'
 
-    print('Retrieving %d x %d tiles' % (ncols, nrows))
+    factors = PYRAMID_LEVELS if pyramid else [1]
+    level_sizes = [(image_size[0]//f, image_size[1]//f) for f in factors]
+    level_fnames = [level_fname(output_name, f) for f in factors]
 
-    osm_idx = 0
-    for j in range(minj, maxj+1):
-        for i in range(mini, maxi+1):
-            sys.stdout.write('(%d,%d) ' % (i, j))
-            sys.stdout.flush()
+    log('Retrieving %d x %d tiles\n' % (ncols, nrows))
+
+    fonts = [credits_font(size[0]) for size in level_sizes]
+
+    if stream:
+        # Only a single row of tiles is kept in memory. Each row is
+        # fetched, assembled, and appended to the output image(s).
+        writers = [StreamingPNGWriter(fn, size[0], size[1]) for fn, size in zip(level_fnames, level_sizes)]
+
+        for j in range(minj, maxj+1):
+            strip = Image.new('RGB', (image_size[0], TILE_SIZE))
+
+            tiles = [(i, j) for i in range(mini, maxi+1)]
+            for i, j, data in fetcher.fetch_tiles(zoom, tiles):
+                log('(%d,%d) ' % (i, j))
+
+                tileimg = Image.open(BytesIO(data))
+                strip.paste(tileimg.convert('RGB'), ((i-mini)*TILE_SIZE, 0))
+
+            for idx, f in enumerate(factors):
+                # Downsample before adding the credits, as each level gets its own
+                next_strip = strip.reduce(2) if idx < len(factors)-1 else None
+                draw_credits(strip, level_sizes[idx], fonts[idx], (j-minj)*TILE_SIZE//f)
+                writers[idx].write(strip)
+                strip = next_strip
 
-            url = "http://%s.tile.openstreetmap.org/%d/%d/%d.png" % \
-                (chr(ord('a')+osm_idx), zoom, i, j)
+        log('\nFinishing output image(s) %s ... ' % ', '.join(level_fnames))
 
-            r = requests.get(url)
-            if r.status_code != 200:
-            	print("\nCould not get %s (error %d)" % (url, r.status_code))
-            assert r.status_code == 200
-            data = r.content
+        for writer in writers:
+            writer.close()
+
+        if texture is not None:
+            # Needs the complete image after all, read it back
+            full_img = Image.open(level_fnames[0])
+
+    else:
+        img = Image.new('RGB', image_size)
+
+        # Tiles can complete in any order, each is pasted at its own offset
+        tiles = [(i, j) for j in range(minj, maxj+1) for i in range(mini, maxi+1)]
+        for i, j, data in fetcher.fetch_tiles(zoom, tiles):
+            log('(%d,%d) ' % (i, j))
 
             tileimg = Image.open(BytesIO(data))
             #tileimg.save('tile-%d-%d.png' % (i, j))
             img.paste(tileimg.convert('RGB'), ((i-mini)*TILE_SIZE, (j-minj)*TILE_SIZE))
 
-            osm_idx = (osm_idx+1) % 3
-    
-    draw = ImageDraw.Draw(img)
-    F = 'arial.ttf'
-    C = '© OpenStreetMap contributors'
-    # Assuming image width translates to 1.5m MR size, aim for credits 10cm wide
-    tw = int(img.size[0] / 15)
-    font_size = 4
-    font = ImageFont.truetype(F, font_size)
-    while font.getsize(C)[0] < tw:
-        font_size += 1
-        font = ImageFont.truetype(F, font_size)
-        
-    font_size = max(font_size, 11)
-    font = ImageFont.truetype(F, font_size)
-    
-    tw, th = font.getsize(C)
-    x = img.size[0] - tw - 10
-    y = img.size[1] - th - 10
-    draw.rectangle((x-5,y-5,x+tw+5,y+th+5), fill=(255,255,255))    
-    draw.text((x,y), C, fill=(128,128,255), font=font)
-    del draw
-            
-    fname = output_name+'.png'
+        log('\nWriting output image(s) %s ... ' % ', '.join(level_fnames))
 
-    sys.stdout.write('\nWriting output image %s ... ' % fname)
-    sys.stdout.flush()
+        for idx, f in enumerate(factors):
+            # Each level is downsampled from the previous one
+            next_img = img.reduce(2) if idx < len(factors)-1 else None
+            draw_credits(img, level_sizes[idx], fonts[idx])
+            img.save(level_fnames[idx])
+            if idx == 0:
+                full_img = img
+            img = next_img
 
-    img.save(fname)
-    
+    texture_entry = None
+    if texture is not None:
+        log('\nWriting texture %s.tex (%s) ... ' % (output_name, texture))
+        texture_entry = write_texture(output_name+'.tex', full_img, texture)
+
+    m = map_metadata(os.path.basename(output_name), (minlat, maxlat, minlon, maxlon), zoom,
+        level_sizes if pyramid else None, texture_entry, fetcher.urls)
+
+    with open(output_name+'.png.json', 'wt') as f:
+        f.write(json.dumps(m , sort_keys=True, indent=4))
+
+    log('done\n')
+    return m
+
+def map_metadata(name, extent, zoom, level_sizes=None, texture=None, tile_urls=None):
+    """
+    Contents of the .png.json file of a map, level_sizes as in build_map() with
+    pyramid, texture the entry returned by texture.write_texture(), tile_urls
+    the tile server URL templates the map was built from
+    """
+    minlat, maxlat, minlon, maxlon = extent
     m = dict(
-        name=output_name,
+        name=name,
         lat_range=[minlat, maxlat],
         lon_range=[minlon, maxlon],
         zoom=zoom,
         image_source=dict(
             type='url',
-            url=fname
+            url=name+'.png'
         )
     )
-    
-    with open(output_name+'.png.json', 'wt') as f:
-        f.write(json.dumps(m , sort_keys=True, indent=4))
 
-    sys.stdout.write('done\n')
-    sys.stdout.flush()
+    if level_sizes is not None:
+        # Smallest level first, in the order in which they would be loaded
+        m['levels'] = [dict(downsample=f, width=size[0], height=size[1], url=level_fname(name, f))
+            for f, size in reversed(list(zip(PYRAMID_LEVELS, level_sizes)))]
+
+    if texture is not None:
+        m['texture'] = texture
+
+    if tile_urls is not None:
+        m['tile_urls'] = list(tile_urls)
+
+    return m
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        usage='%(prog)s [options] <min-lat> <max-lat> <min-lon> <max-lon> <zoom> <output-name>\n' +
+              '       %(prog)s [options] <map-name>')
+    parser.add_argument('-j', '--workers', type=int, default=4,
+        help='Number of tiles to fetch concurrently (default: %(default)d, use 1 for serial fetching)')
+    parser.add_argument('--per-host', type=int, default=2,
+        help='Maximum number of concurrent requests per tile server host (default: %(default)d)')
+    parser.add_argument('--cache', default=DEFAULT_CACHE_FILE,
+        help='Tile cache file (default: %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=2048,
+        help='Maximum tile cache size in MB, least recently used tiles are evicted (default: %(default)d)')
+    parser.add_argument('--no-cache', action='store_true',
+        help='Always retrieve tiles from the tile servers')
+    parser.add_argument('--retries', type=int, default=MAX_RETRIES,
+        help='Number of retries of a failed tile request, with exponential backoff (default: %(default)d)')
+    parser.add_argument('--no-adaptive', action='store_true',
+        help='Keep the number of requests per host at --per-host, instead of lowering it while a host is throttling')
+    parser.add_argument('--metrics', metavar='FILE',
+        help='Write tile request metrics (latency percentiles per host, retries, status codes) to this JSON file')
+    parser.add_argument('--stream', action='store_true',
+        help='Assemble and write the output image one row of tiles at a time, for very large maps')
+    parser.add_argument('--pyramid', action='store_true',
+        help='Also write 2x, 4x and 8x downsampled versions of the map image, for progressive loading')
+    parser.add_argument('--texture', choices=sorted(TEXTURE_FORMATS),
+        help='Also write the map image as power-of-two padded texture data with mip levels (<output-name>.tex), ' +
+             'in this format')
+    parser.add_argument('args', nargs='+', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    args = options.args
+
+    if len(args) == 1:
+        mapname = args[0]
+        map = MAPS[mapname]
+        lat_range = map['lat_range']
+        lon_range = map['lon_range']
+        zoom = map['zoom']
+        output_name = mapname
+        print('Map "%s"' % mapname)
+    elif len(args) == 6:
+        lat_range = [float(args[0]), float(args[1])]
+        lon_range = [float(args[2]), float(args[3])]
+        zoom = int(args[4])
+        output_name = args[5]
+    else:
+        parser.print_usage()
+        print()
+        sys.exit(-1)
+
+    cache = None
+    if not options.no_cache:
+        cache = TileCache(options.cache, options.cache_size*1024*1024)
+
+    fetcher = TileFetcher(OSM_TILE_SERVERS, workers=options.workers, max_per_host=options.per_host, cache=cache,
+        retries=options.retries, adaptive=not options.no_adaptive)
+
+    try:
+        build_map(lat_range, lon_range, zoom, output_name, fetcher, options.stream, options.pyramid, options.texture)
+    finally:
+        fetcher.close()
+        if options.metrics is not None:
+            fetcher.metrics.write_json(options.metrics)
+
+    print(fetcher.metrics.report())
+    if cache is not None:
+        print(cache.report())
+        cache.close()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Shared caching proxy for the OpenSky Network states API, for setups with
+# multiple headsets. Instead of each device polling OpenSky with its own
+# extent, the proxy fetches a single (large) region on a fixed cadence and
+# answers /api/states/all?lamin=...&lamax=...&lomin=...&lomax=... requests
+# from the latest snapshot, using a grid spatial index. All clients therefore
+# see the same data, and only a single client's worth of API rate limit is used.
+#
+# Requests that arrive while an upstream fetch is in progress wait for that
+# fetch, instead of starting another one. When the upstream fails the previous
+# snapshot keeps being served.
+#
+# The proxy also records the track of each plane from the snapshots, and serves
+# it as /api/tracks/all?icao24=... (in the format of the OpenSky tracks API),
+# limited to a sliding window and simplified for drawing on the map (see
+# tracksimplify.py). The tolerance, method and number of points can be
+# overridden with tolerance=<map km>, method=... and max_points=... parameters.
+#
+# Use --local to run against fake_opensky.py as upstream, for offline testing.
+#
+# This uses https://pypi.org/project/aiohttp/
+import sys, time, json, math, asyncio, argparse
+import numpy as np
+from aiohttp import web, ClientSession, ClientTimeout, ClientError, BasicAuth
+from gridindex import GridIndex
+from extrapolation import MapProjection
+from statearchive import states_to_columns
+from tracksimplify import TrackStore, METHODS
+
+OPENSKY_API_URL = 'https://opensky-network.org/api'
+
+# Same as OPENSKY_QUERY_INTERVAL in the app
+QUERY_INTERVAL = 8
+
+class Snapshot:
+
+    """A single upstream response, with each state vector serialized to JSON once"""
+
+    def __init__(self, data, cell_size, fetched):
+        self.time = data['time']
+        self.fetched = fetched
+        states = data['states'] or []
+        self.json_states = [json.dumps(s) for s in states]
+        lat = np.array([np.nan if s[6] is None else s[6] for s in states], dtype=np.float64)
+        lon = np.array([np.nan if s[5] is None else s[5] for s in states], dtype=np.float64)
+        self.index = GridIndex(lat, lon, cell_size)
+
+    def response_body(self, bbox):
+        if bbox is None:
+            selected = self.json_states
+        else:
+            selected = [self.json_states[i] for i in self.index.query(*bbox)]
+        return ('{"time": %d, "states": [%s]}' % (self.time, ', '.join(selected))).encode('utf8')
+
+
+class StatesProxy:
+
+    def __init__(self, url, region, interval, cell_size=0.5, auth=None, track_settings=None):
+        self.url = url
+        self.region = region
+        self.interval = interval
+        self.cell_size = cell_size
+        self.auth = auth
+        self.session = None
+        self.snapshot = None
+        self.pending = None
+        self.stats = dict(requests=0, upstream_fetches=0, upstream_errors=0, merged_requests=0, outside_region=0,
+            track_requests=0, track_points=0, track_points_served=0)
+
+        # Tracks, simplified in the km of a map covering the region
+        self.track_settings = dict(tolerance=0.1, method='douglas-peucker', max_points=None, max_age=None)
+        self.track_settings.update(track_settings or {})
+        self.tracks = TrackStore(self.track_settings['max_age'])
+        self.map = MapProjection(region[:2], region[2:])
+
+    async def start(self, app):
+        self.session = ClientSession(timeout=ClientTimeout(total=30), auth=self.auth)
+        self.refresher = asyncio.ensure_future(self.refresh_loop())
+
+    async def stop(self, app):
+        self.refresher.cancel()
+        await self.session.close()
+
+    async def fetch(self):
+        """Fetch the region from upstream, returns the new snapshot (or the previous one on error)"""
+        lamin, lamax, lomin, lomax = self.region
+        url = '%s/states/all?lamin=%f&lamax=%f&lomin=%f&lomax=%f' % (self.url, lamin, lamax, lomin, lomax)
+
+        self.stats['upstream_fetches'] += 1
+        t0 = time.time()
+        try:
+            async with self.session.get(url) as r:
+                if r.status != 200:
+                    raise ClientError('HTTP error %d' % r.status)
+                data = await r.json(content_type=None)
+            previous = self.snapshot
+            self.snapshot = Snapshot(data, self.cell_size, time.time())
+            if previous is None or self.snapshot.time != previous.time:
+                self.tracks.add(states_to_columns(data['states'] or []))
+            print('[%d] %d states, fetched in %.3f s' % (self.snapshot.time, len(self.snapshot.json_states), time.time()-t0))
+        except (ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
+            self.stats['upstream_errors'] += 1
+            print('Upstream error: %s' % (e or type(e).__name__))
+        sys.stdout.flush()
+
+        return self.snapshot
+
+    async def refresh(self):
+        """Start a fetch, or join the one in progress"""
+        if self.pending is None:
+            self.pending = asyncio.ensure_future(self.fetch())
+            self.pending.add_done_callback(lambda f: setattr(self, 'pending', None))
+        else:
+            self.stats['merged_requests'] += 1
+        return await asyncio.shield(self.pending)
+
+    async def refresh_loop(self):
+        while True:
+            t0 = time.time()
+            await self.refresh()
+            await asyncio.sleep(max(0.0, self.interval - (time.time() - t0)))
+
+    async def handle_states(self, request):
+        self.stats['requests'] += 1
+
+        bbox = None
+        q = request.query
+        if any(k in q for k in ('lamin', 'lamax', 'lomin', 'lomax')):
+            try:
+                bbox = (float(q.get('lamin', -90)), float(q.get('lamax', 90)),
+                    float(q.get('lomin', -180)), float(q.get('lomax', 180)))
+            except ValueError:
+                raise web.HTTPBadRequest(text='Invalid bounding box')
+
+        r = self.region
+        if bbox is None or bbox[0] < r[0] or bbox[1] > r[1] or bbox[2] < r[2] or bbox[3] > r[3]:
+            # Only the part within the proxied region can be answered
+            self.stats['outside_region'] += 1
+
+        if self.pending is not None or self.snapshot is None:
+            # Wait for the fetch in progress (or start one, if there is no data yet)
+            s = await self.refresh()
+        else:
+            s = self.snapshot
+        if s is None:
+            raise web.HTTPBadGateway(text='No data from upstream')
+
+        return web.Response(body=s.response_body(bbox), content_type='application/json')
+
+    async def handle_tracks(self, request):
+        self.stats['track_requests'] += 1
+
+        q = request.query
+        try:
+            key = int(q['icao24'], 16)
+            tolerance = float(q.get('tolerance', self.track_settings['tolerance']))
+            max_points = q.get('max_points', self.track_settings['max_points'])
+            max_points = None if max_points is None else int(max_points)
+        except (KeyError, ValueError):
+            raise web.HTTPBadRequest(text='Invalid or missing icao24, tolerance or max_points')
+        method = q.get('method', self.track_settings['method'])
+        if method not in METHODS:
+            raise web.HTTPBadRequest(text='Method should be one of %s' % ', '.join(METHODS))
+
+        track = self.tracks.tracks.get(key)
+        if track is None or len(track) == 0:
+            raise web.HTTPNotFound(text='No track for %06x' % key)
+
+        idx = track.simplified(self.map, tolerance, method, max_points)
+        self.stats['track_points'] += len(track)
+        self.stats['track_points_served'] += len(idx)
+
+        value = lambda v: None if math.isnan(v) else round(v, 2)
+        path = [[track.time[i], track.lat[i], track.lon[i], value(track.altitude[i]), value(track.heading[i]), False]
+            for i in idx]
+        return web.json_response(dict(icao24='%06x' % key, callsign=track.callsign,
+            startTime=track.time[idx[0]], endTime=track.time[idx[-1]], path=path))
+
+    async def handle_stats(self, request):
+        stats = dict(self.stats)
+        if self.snapshot is not None:
+            stats.update(time=self.snapshot.time, states=len(self.snapshot.json_states),
+                age=round(time.time() - self.snapshot.fetched, 3))
+        return web.json_response(stats)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Shared caching proxy for the OpenSky Network states API')
+    parser.add_argument('--port', type=int, default=8900,
+        help='Port to listen on (default: %(default)d)')
+    parser.add_argument('--lat-range', type=float, nargs=2, default=[50.513427, 53.748711],
+        help='Latitude range of the region fetched from upstream, should cover all clients (default: %(default)s)')
+    parser.add_argument('--lon-range', type=float, nargs=2, default=[2.812500, 7.734375],
+        help='Longitude range of the region fetched from upstream (default: %(default)s)')
+    parser.add_argument('--interval', type=float, default=QUERY_INTERVAL,
+        help='Seconds between upstream fetches (default: %(default)s)')
+    parser.add_argument('--cell-size', type=float, default=0.5,
+        help='Cell size of the spatial index in degrees (default: %(default)s)')
+    parser.add_argument('--api-url', default=OPENSKY_API_URL,
+        help='Base URL of the upstream API (default: %(default)s)')
+    parser.add_argument('--local', type=int, nargs='?', const=8800, metavar='PORT',
+        help='Use fake_opensky.py running on localhost as upstream, on the given port (default: 8800)')
+    parser.add_argument('--auth', metavar='USER:PASSWORD',
+        help='OpenSky account, for higher rate limits and time resolution')
+    parser.add_argument('--track-tolerance', type=float, default=0.1,
+        help='Default track simplification tolerance in map km, 0 for none (default: %(default)s)')
+    parser.add_argument('--track-method', choices=METHODS, default='douglas-peucker',
+        help='Default track simplification method (default: %(default)s)')
+    parser.add_argument('--track-max-points', type=int,
+        help='Default maximum number of (simplified) points per track, newest kept (default: no limit)')
+    parser.add_argument('--track-max-age', type=float,
+        help='Seconds of track history kept (default: all, until the plane lands)')
+    options = parser.parse_args()
+
+    api_url = options.api_url
+    if options.local is not None:
+        api_url = 'http://localhost:%d/api' % options.local
+
+    auth = None
+    if options.auth is not None:
+        auth = BasicAuth(*options.auth.split(':', 1))
+
+    region = (options.lat_range[0], options.lat_range[1], options.lon_range[0], options.lon_range[1])
+    track_settings = dict(tolerance=options.track_tolerance, method=options.track_method,
+        max_points=options.track_max_points, max_age=options.track_max_age)
+    proxy = StatesProxy(api_url, region, options.interval, options.cell_size, auth, track_settings)
+
+    app = web.Application()
+    app.router.add_get('/api/states/all', proxy.handle_states)
+    app.router.add_get('/api/tracks/all', proxy.handle_tracks)
+    app.router.add_get('/stats', proxy.handle_stats)
+    app.on_startup.append(proxy.start)
+    app.on_cleanup.append(proxy.stop)
+
+    print('Proxying %s, lat %.6f to %.6f, lon %.6f to %.6f, every %.1f s' % ((api_url,) + region + (options.interval,)))
+    print('Listening on http://localhost:%d/api/states/all' % options.port)
+    web.run_app(app, port=options.port, print=None)
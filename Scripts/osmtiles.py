@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Concurrent retrieval of OSM slippy-map tiles, as used by make_osm_map.py
+# Tiles are fetched by a bounded pool of worker threads. Each tile server host
+# gets its own keep-alive session, and the number of requests in flight to a
+# single host is limited, to stay within tile usage policies
+# (https://operations.osmfoundation.org/policies/tiles/).
+# Optionally, tiles are kept in a TileCache (see tilecache.py) and only
+# revalidated with the server once they expire.
+#
+# Failed requests (429, 5xx, timeouts, connection errors) are retried with
+# exponential backoff, honouring Retry-After. The per-host limit is the
+# maximum of an AIMD (additive increase, multiplicative decrease) controller:
+# the number of requests in flight to a host is halved when the host starts
+# throttling or failing, and grows again by one at a time while its latency
+# is back near its baseline. All requests are recorded in a TileMetrics.
+import copy, json, time, random, threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+import numpy as np
+import requests
+
+OSM_TILE_SERVERS = [
+    'http://a.tile.openstreetmap.org/{zoom}/{x}/{y}.png',
+    'http://b.tile.openstreetmap.org/{zoom}/{x}/{y}.png',
+    'http://c.tile.openstreetmap.org/{zoom}/{x}/{y}.png',
+]
+
+USER_AGENT = 'DutchSkies-make_osm_map/1.0 (+https://github.com/paulmelis/dutch-skies)'
+
+# Retries of a tile request after the first attempt
+MAX_RETRIES = 4
+
+# Backoff before retry n is a random time (full jitter) up to
+# min(BACKOFF_BASE * 2^n, BACKOFF_MAX) seconds, but at least the server's Retry-After
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+
+# Responses that are worth retrying, other errors fail immediately
+RETRY_STATUS = set([429, 500, 502, 503, 504])
+
+# AIMD: the limit is multiplied by this on throttling/errors, at most
+# once per DECREASE_INTERVAL seconds (the requests already in flight
+# will report the same condition), and not increased again during that time
+DECREASE_FACTOR = 0.5
+DECREASE_INTERVAL = 2.0
+
+# The limit is only increased while the smoothed latency is at most
+# this factor above the lowest smoothed latency seen for the host
+RECOVERY_FACTOR = 1.5
+LATENCY_SMOOTHING = 0.2
+
+def tile_url(template, zoom, x, y):
+    """Fill in a tile server URL template, in the same {zoom}/{x}/{y}
+    format as used by the tile_servers section of a configuration"""
+    return template.replace('{zoom}', str(zoom)).replace('{x}', str(x)).replace('{y}', str(y))
+
+
+def backoff_seconds(attempt, retry_after=None):
+    """Wait before retry attempt (0-based), at least the Retry-After header value if given"""
+    wait = random.uniform(0, min(BACKOFF_BASE * 2**attempt, BACKOFF_MAX))
+    if retry_after is not None:
+        try:
+            wait = max(wait, min(float(retry_after), BACKOFF_MAX))
+        except ValueError:
+            # HTTP-date form, not used by tile servers in practice
+            pass
+    return wait
+
+
+class AIMDLimiter:
+
+    """
+    Limits the number of concurrent requests to a host, like a semaphore
+    whose number of slots is adjusted from the outcome of each request.
+    The limit stays between 1 and maximum (the tile usage policy limit).
+    """
+
+    def __init__(self, maximum, adaptive=True):
+        self.maximum = maximum
+        self.adaptive = adaptive
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+        self.latency = None
+        self.baseline = None
+        self.last_decrease = None
+        self.decreases = 0
+        self.lowest = self.limit
+
+    def __enter__(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, *args):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def feedback(self, ok, latency=None):
+        """Report the outcome of a request: ok, or throttled/failed (ok = False)"""
+        if not self.adaptive:
+            return
+        with self.condition:
+            now = time.monotonic()
+            if not ok:
+                if self.last_decrease is None or now - self.last_decrease >= DECREASE_INTERVAL:
+                    self.limit = max(1.0, self.limit * DECREASE_FACTOR)
+                    self.last_decrease = now
+                    self.decreases += 1
+                    self.lowest = min(self.lowest, self.limit)
+                return
+
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+            self.baseline = self.latency if self.baseline is None else min(self.baseline, self.latency)
+
+            holding = self.last_decrease is not None and now - self.last_decrease < DECREASE_INTERVAL
+            if self.limit < self.maximum and not holding and self.latency <= RECOVERY_FACTOR * self.baseline:
+                # +1 slot per limit successful requests, i.e. about one per round trip
+                previous = int(self.limit)
+                self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+                if int(self.limit) > previous:
+                    self.condition.notify_all()
+
+
+class TileMetrics:
+
+    """
+    Per-request record of tile retrieval: host, status (None for timeouts and
+    connection errors), latency, bytes and retry number, plus the number of
+    tiles served from the cache. Thread-safe, can be shared between fetchers.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = []
+        self.cache_hits = 0
+        self.failed_tiles = 0
+        self.limiters = {}
+        self.t0 = time.time()
+
+    def record(self, host, url, status, latency, nbytes, retry):
+        with self.lock:
+            self.requests.append((host, url, status, latency, nbytes, retry))
+
+    def cache_hit(self):
+        with self.lock:
+            self.cache_hits += 1
+
+    def tile_failed(self):
+        with self.lock:
+            self.failed_tiles += 1
+
+    def summary(self):
+        """Dict with overall numbers and per host latency percentiles (ms), status counts, etc"""
+        with self.lock:
+            requests = list(self.requests)
+
+        hosts = {}
+        for host in sorted(set(r[0] for r in requests)):
+            rs = [r for r in requests if r[0] == host]
+            latency = np.array([r[3] for r in rs]) * 1000
+            statuses = {}
+            for r in rs:
+                key = 'error' if r[2] is None else str(r[2])
+                statuses[key] = statuses.get(key, 0) + 1
+            h = dict(
+                requests=len(rs),
+                retries=sum(1 for r in rs if r[5] > 0),
+                status=statuses,
+                bytes=sum(r[4] for r in rs),
+                latency_ms=dict(
+                    p50=round(float(np.percentile(latency, 50)), 1),
+                    p95=round(float(np.percentile(latency, 95)), 1),
+                    p99=round(float(np.percentile(latency, 99)), 1),
+                    mean=round(float(latency.mean()), 1),
+                    max=round(float(latency.max()), 1)
+                )
+            )
+            limiter = self.limiters.get(host)
+            if limiter is not None:
+                h['concurrency'] = dict(maximum=limiter.maximum, lowest=int(limiter.lowest),
+                    final=int(limiter.limit), decreases=limiter.decreases)
+            hosts[host] = h
+
+        return dict(
+            seconds=round(time.time() - self.t0, 3),
+            requests=len(requests),
+            retries=sum(1 for r in requests if r[5] > 0),
+            bytes=sum(r[4] for r in requests),
+            cache_hits=self.cache_hits,
+            failed_tiles=self.failed_tiles,
+            hosts=hosts
+        )
+
+    def write_json(self, fname):
+        with open(fname, 'wt') as f:
+            json.dump(self.summary(), f, indent=4, sort_keys=True)
+
+    def report(self):
+        s = self.summary()
+        lines = ['Tile requests: %d, %d retries, %d failed tiles, %.1f MB in %.1f s' % (s['requests'], s['retries'],
+            s['failed_tiles'], s['bytes']/1e6, s['seconds'])]
+        for host, h in s['hosts'].items():
+            l = h['latency_ms']
+            line = '  %s: %d requests, latency p50 %.0f / p95 %.0f / p99 %.0f ms' % (host, h['requests'], l['p50'], l['p95'], l['p99'])
+            c = h.get('concurrency')
+            if c is not None and c['decreases'] > 0:
+                line += ', concurrency lowered %d times (lowest %d of %d)' % (c['decreases'], c['lowest'], c['maximum'])
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+class TileFetcher:
+
+    """
+    Fetches tiles from a list of tile server URL templates.
+
+    Requests are spread round-robin over the templates (like the
+    a/b/c hosts of the OSM servers). At most `workers` requests are
+    in flight in total, and at most `max_per_host` per host (lowered
+    while a host is throttling or failing, with adaptive).
+    """
+
+    def __init__(self, urls=OSM_TILE_SERVERS, workers=4, max_per_host=2, timeout=30, cache=None,
+            retries=MAX_RETRIES, adaptive=True, metrics=None):
+        assert len(urls) > 0
+        assert workers >= 1 and max_per_host >= 1 and retries >= 0
+
+        self.urls = urls
+        self.workers = workers
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.cache = cache
+        self.retries = retries
+        self.metrics = metrics if metrics is not None else TileMetrics()
+
+        self.adaptive = adaptive
+
+        self.sessions = {}
+        self.host_slots = {}
+        self._add_hosts(urls)
+
+    def _add_hosts(self, urls):
+        for url in urls:
+            host = urlsplit(url).netloc
+            if host in self.sessions:
+                continue
+
+            # Connection pool sized to the per-host limit, so every
+            # in-flight request can reuse a kept-alive connection
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.max_per_host)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['User-Agent'] = USER_AGENT
+
+            self.sessions[host] = session
+            self.host_slots[host] = AIMDLimiter(self.max_per_host, self.adaptive)
+            self.metrics.limiters[host] = self.host_slots[host]
+
+    def sibling(self, urls, cache=None):
+        """
+        Fetcher for other tile server urls (with their own cache), sharing this
+        fetcher's connections, per-host limits and metrics. Closing this fetcher
+        also closes the connections of its siblings.
+        """
+        assert len(urls) > 0
+        fetcher = copy.copy(self)
+        fetcher.urls = urls
+        fetcher.cache = cache
+        fetcher._add_hosts(urls)
+        return fetcher
+
+    def fetch(self, zoom, x, y, server_idx=0):
+        """Retrieve a single tile, returns the (PNG) image data"""
+
+        cached = None
+        headers = {}
+        if self.cache is not None:
+            cached = self.cache.lookup(zoom, x, y)
+            if cached is not None:
+                if cached.fresh:
+                    self.metrics.cache_hit()
+                    return cached.data
+                headers = cached.conditional_headers()
+
+        for attempt in range(self.retries + 1):
+            # Retries go to the next server, in case only one of them is in trouble
+            url = tile_url(self.urls[(server_idx + attempt) % len(self.urls)], zoom, x, y)
+            host = urlsplit(url).netloc
+            limiter = self.host_slots[host]
+
+            r = None
+            error = None
+            with limiter:
+                t0 = time.perf_counter()
+                try:
+                    r = self.sessions[host].get(url, headers=headers, timeout=self.timeout)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = e
+                latency = time.perf_counter() - t0
+
+            status = None if r is None else r.status_code
+            self.metrics.record(host, url, status, latency, 0 if r is None else len(r.content), attempt)
+
+            if status == 200 or (status == 304 and cached is not None):
+                limiter.feedback(True, latency)
+                break
+
+            if status is None or status in RETRY_STATUS:
+                limiter.feedback(False)
+                if attempt < self.retries:
+                    time.sleep(backoff_seconds(attempt, None if r is None else r.headers.get('Retry-After')))
+                    continue
+
+            self.metrics.tile_failed()
+            reason = 'error %d' % status if error is None else str(error) or type(error).__name__
+            print("\nCould not get %s (%s, after %d attempts)" % (url, reason, attempt + 1))
+            raise IOError('Could not get tile %d/%d/%d (%s)' % (zoom, x, y, reason))
+
+        if r.status_code == 304:
+            self.cache.refresh(zoom, x, y, cached, r.headers)
+            return cached.data
+
+        if self.cache is not None:
+            self.cache.store(zoom, x, y, r.content, r.headers)
+
+        return r.content
+
+    def fetch_tiles(self, zoom, tiles):
+        """
+        Retrieve all tiles in the list of (x, y) tile numbers.
+
+        Yields (x, y, data) tuples in order of completion, which will
+        in general *not* be the order of the input list.
+        """
+
+        if self.workers == 1:
+            for idx, (x, y) in enumerate(tiles):
+                yield x, y, self.fetch(zoom, x, y, idx)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {}
+            for idx, (x, y) in enumerate(tiles):
+                futures[pool.submit(self.fetch, zoom, x, y, idx)] = (x, y)
+
+            try:
+                for f in as_completed(futures):
+                    x, y = futures[f]
+                    yield x, y, f.result()
+            finally:
+                # Don't leave queued requests behind on error
+                for f in futures:
+                    f.cancel()
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Row-streaming PNG encoder.
+# PIL can only save a PNG from a complete in-memory image. This writer
+# takes the image as a sequence of horizontal strips (e.g. one row of map
+# tiles at a time) and compresses each strip as soon as it is written,
+# so only a single strip needs to be in memory.
+# See https://www.w3.org/TR/png/ for the file format.
+import struct, zlib
+from PIL import Image, ImageChops
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNG color types
+COLOR_TYPES = { 'RGB': 2, 'RGBA': 6 }
+
+# Scanline filter type "Up", i.e. each row is stored as the difference with the
+# row above it. Compresses map imagery well, and can be computed per strip
+# with ImageChops instead of per pixel in Python
+FILTER_UP = 2
+
+# Compressed data is written in IDAT chunks of (at least) this size
+IDAT_SIZE = 1 << 20
+
+def write_chunk(f, chunk_type, data):
+    f.write(struct.pack('>I', len(data)))
+    f.write(chunk_type)
+    f.write(data)
+    f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type))))
+
+
+class StreamingPNGWriter:
+
+    """
+    Writes a width x height PNG image strip by strip, top to bottom.
+    Strips are PIL images of the full image width, of any height.
+    """
+
+    def __init__(self, fname, width, height, mode='RGB', level=6):
+        assert mode in COLOR_TYPES
+
+        self.fname = fname
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.rows_written = 0
+
+        # Last row of the previous strip, needed for filtering the first
+        # row of the next strip. Row "-1" is defined as all zero.
+        self.prev_row = Image.new(mode, (width, 1))
+
+        self.compressor = zlib.compressobj(level)
+        self.pending = []
+        self.pending_size = 0
+
+        self.f = open(fname, 'wb')
+        self.f.write(PNG_SIGNATURE)
+        # Bit depth 8, compression method 0, filter method 0, no interlacing
+        write_chunk(self.f, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, COLOR_TYPES[mode], 0, 0, 0))
+
+    def _add_compressed(self, data, flush=False):
+        if len(data) > 0:
+            self.pending.append(data)
+            self.pending_size += len(data)
+
+        if self.pending_size >= IDAT_SIZE or (flush and self.pending_size > 0):
+            write_chunk(self.f, b'IDAT', b''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def write(self, strip):
+        assert strip.size[0] == self.width
+        assert strip.mode == self.mode
+
+        w, h = strip.size
+        assert self.rows_written + h <= self.height
+
+        # Image of the rows directly above each row of the strip
+        above = Image.new(self.mode, (w, h))
+        above.paste(self.prev_row, (0, 0))
+        if h > 1:
+            above.paste(strip.crop((0, 0, w, h-1)), (0, 1))
+
+        filtered = ImageChops.subtract_modulo(strip, above).tobytes()
+
+        # Prefix each scanline with its filter type byte
+        row_size = w * len(self.mode)
+        scanlines = bytearray((row_size + 1) * h)
+        for r in range(h):
+            o = r * (row_size + 1)
+            scanlines[o] = FILTER_UP
+            scanlines[o+1:o+1+row_size] = filtered[r*row_size:(r+1)*row_size]
+
+        self._add_compressed(self.compressor.compress(scanlines))
+
+        self.prev_row = strip.crop((0, h-1, w, h))
+        self.rows_written += h
+
+    def close(self):
+        assert self.rows_written == self.height, 'Only %d of %d rows written' % (self.rows_written, self.height)
+
+        self._add_compressed(self.compressor.flush(), flush=True)
+        write_chunk(self.f, b'IEND', b'')
+        self.f.close()
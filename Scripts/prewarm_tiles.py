@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Fill the tile cache used by tileserver.py with the tiles of the tile_server
+# maps in a configuration (the map_sets section, see the README). For each map
+# exactly the tile range the app requests is fetched, as computed by
+# OSMTiles.ComputeActualMapExtent() in single precision. Tiles already in the
+# cache are only revalidated once expired.
+#
+# Tiles are cached per tile server id, in <cache-dir>/<id>-tiles.mbtiles, as
+# different tile servers (e.g. OSM and a satellite imagery server) give
+# different tiles for the same zoom/x/y.
+#
+# With -o a copy of the configuration is written with the tile_servers urls
+# pointing to the local tile server, to be loaded on the devices. Tile server
+# <id> then becomes <server-url>/<id>/{zoom}/{x}/{y}.png.
+import sys, json, copy, argparse
+from osmtiles import TileFetcher, TileMetrics, MAX_RETRIES
+from tilecache import TileCache, DEFAULT_CACHE_DIR, server_cache_fname
+from webmercator import actual_map_extent
+
+def tile_server_maps(config, map_set_ids=None):
+    """
+    Yields (map_set_id, map_id, lat_range, lon_range, zoom, server_id, urls) for the
+    tile_server maps. Maps using an unknown tile server are skipped, as in the app
+    """
+    for map_set in config.get('map_sets', []):
+        if map_set_ids and map_set['id'] not in map_set_ids:
+            continue
+        servers = { ts['id']: ts['urls'] for ts in map_set.get('tile_servers', []) }
+        for item in map_set['items']:
+            source = item.get('image_source', {})
+            if source.get('type') != 'tile_server':
+                continue
+            if source.get('id') not in servers:
+                print('WARNING: [%s] map "%s" uses unknown tile server "%s", skipped' % (map_set['id'], item['id'], source.get('id')))
+                continue
+            yield map_set['id'], item['id'], item['lat_range'], item['lon_range'], item['zoom'], source['id'], servers[source['id']]
+
+def local_config(config, server_url):
+    """Copy of config with the urls of all tile servers replaced by the local tile server"""
+    config = copy.deepcopy(config)
+    for map_set in config.get('map_sets', []):
+        for ts in map_set.get('tile_servers', []):
+            ts['urls'] = [server_url.rstrip('/') + '/' + ts['id'] + '/{zoom}/{x}/{y}.png']
+    return config
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Fill the tile cache with the tiles of the maps in a configuration')
+    parser.add_argument('config',
+        help='Configuration JSON file, with map_sets')
+    parser.add_argument('--map-set', nargs='+', metavar='ID',
+        help='Only the map sets with these ids (default: all)')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+        help='Directory of the tile cache files, one per tile server id (default: %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=2048,
+        help='Maximum size in MB of each tile cache file, least recently used tiles are evicted (default: %(default)d)')
+    parser.add_argument('-j', '--workers', type=int, default=4,
+        help='Number of tiles to fetch concurrently (default: %(default)d)')
+    parser.add_argument('--per-host', type=int, default=2,
+        help='Maximum number of concurrent requests per tile server host (default: %(default)d)')
+    parser.add_argument('--retries', type=int, default=MAX_RETRIES,
+        help='Number of retries of a failed tile request, with exponential backoff (default: %(default)d)')
+    parser.add_argument('--no-adaptive', action='store_true',
+        help='Keep the number of requests per host at --per-host, instead of lowering it while a host is throttling')
+    parser.add_argument('--metrics', metavar='FILE',
+        help='Write tile request metrics (latency percentiles per host, retries, status codes) to this JSON file')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+        help='Only show the tile ranges')
+    parser.add_argument('-o', '--output',
+        help='Write a copy of the configuration using the local tile server to this file')
+    parser.add_argument('--server-url', default='http://localhost:8700',
+        help='Base URL of tileserver.py, as reachable from the devices, for -o (default: %(default)s)')
+    options = parser.parse_args()
+
+    try:
+        config = json.load(open(options.config, 'rt'))
+    except ValueError as e:
+        print('%s: invalid JSON (%s)' % (options.config, e))
+        sys.exit(-1)
+
+    maps = list(tile_server_maps(config, options.map_set))
+    if len(maps) == 0:
+        print('No tile_server maps in %s' % options.config)
+
+    caches = {}
+    metrics = TileMetrics()
+    total = 0
+
+    for map_set_id, map_id, lat_range, lon_range, zoom, server_id, urls in maps:
+        (min_i, max_i, min_j, max_j), extent = actual_map_extent(lat_range, lon_range, zoom)
+        tiles = [(i, j) for j in range(min_j, max_j+1) for i in range(min_i, max_i+1)]
+        total += len(tiles)
+        print('[%s] %s: tile server %s, zoom %d, tile range i = %d-%d, j = %d-%d, %d tiles' % (map_set_id, map_id,
+            server_id, zoom, min_i, max_i, min_j, max_j, len(tiles)))
+        if options.dry_run:
+            continue
+
+        cache = caches.get(server_id)
+        if cache is None:
+            cache = caches[server_id] = TileCache(server_cache_fname(server_id, options.cache_dir),
+                options.cache_size*1024*1024)
+        fetcher = TileFetcher(urls, workers=options.workers, max_per_host=options.per_host, cache=cache,
+            retries=options.retries, adaptive=not options.no_adaptive, metrics=metrics)
+        try:
+            for count, (i, j, data) in enumerate(fetcher.fetch_tiles(zoom, tiles), 1):
+                sys.stdout.write('\r%d / %d' % (count, len(tiles)))
+                sys.stdout.flush()
+            print()
+        finally:
+            fetcher.close()
+
+    print('%d tiles in total' % total)
+    if not options.dry_run:
+        print(metrics.report())
+        if options.metrics is not None:
+            metrics.write_json(options.metrics)
+    for cache in caches.values():
+        print(cache.report())
+        cache.close()
+
+    if options.output is not None:
+        with open(options.output, 'wt') as f:
+            json.dump(local_config(config, options.server_url), f, indent=4)
+        print('Wrote %s' % options.output)
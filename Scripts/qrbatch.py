@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Batch version of json2qrcode.py and text2qrcode.py: walks a directory of JSON
+# configuration files and renders a QR code image for each of them, in a
+# process pool. For file <name>.json the image is written as <name>.qr.png
+# (or <name>.qr-1.png, <name>.qr-2.png, ... for multi-part compressed data).
+#
+# A manifest in the output directory records a hash of each file's content
+# plus the options used. Files whose hash matches the manifest and whose
+# output images all still exist are skipped, so after editing a single
+# config only that config's QR code is rendered again.
+#
+# This uses https://pypi.org/project/qrcode/
+import sys, os, json, time, fnmatch, hashlib, argparse
+from concurrent.futures import ProcessPoolExecutor
+import qrcode
+from json2qrcode import write_qrcodes, minified_json, label
+
+MANIFEST = '.qrcodes.json'
+
+# Part of every content hash, change when the rendered output changes
+HASH_VERSION = b'1'
+
+def find_files(directory, patterns, exclude):
+    """Return relative paths of the files in directory matching any of patterns, sorted.
+    Hidden files (such as the manifest) are skipped"""
+    files = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for fn in filenames:
+            if fn.startswith('.'):
+                continue
+            if any(fnmatch.fnmatch(fn, p) for p in patterns) and not any(fnmatch.fnmatch(fn, p) for p in exclude):
+                files.append(os.path.relpath(os.path.join(dirpath, fn), directory))
+    files.sort()
+    return files
+
+def output_fname(output_dir, relpath):
+    return os.path.join(output_dir, os.path.splitext(relpath)[0] + '.qr.png')
+
+def content_hash(fname, settings):
+    h = hashlib.sha256(HASH_VERSION)
+    h.update(json.dumps(settings, sort_keys=True).encode('utf8'))
+    with open(fname, 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+def render(job):
+    """Render the QR code(s) for a single file, returns (relpath, list of written files, error).
+    Runs in a worker process."""
+
+    relpath, fname, image_file, settings = job
+
+    d = os.path.dirname(image_file)
+    if d != '':
+        os.makedirs(d, exist_ok=True)
+
+    try:
+        if settings['url'] is not None:
+            # QR code holding the URL of the hosted file, as text2qrcode.py
+            s = settings['url'].rstrip('/') + '/' + relpath.replace(os.sep, '/')
+            img = qrcode.make(s)
+            label(img, s)
+            img.save(image_file)
+            return relpath, [image_file], None
+
+        try:
+            js = minified_json(fname)
+        except ValueError as e:
+            # Not strict JSON, e.g. a trailing comma (which the app does accept)
+            return relpath, None, 'Invalid JSON: %s' % e
+
+        written = write_qrcodes(js, image_file, relpath, settings['compress'],
+            settings['error_correction'], settings['max_version'])
+        return relpath, [w[0] for w in written], None
+    except Exception as e:
+        # E.g. data too large for a QR code, reported per file so the rest of the batch completes
+        return relpath, None, '%s: %s' % (type(e).__name__, e)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Render QR codes for all JSON configuration files in a directory')
+    parser.add_argument('-o', '--output-dir',
+        help='Directory to write QR code images to, subdirectories are mirrored (default: the input directory)')
+    parser.add_argument('--url', metavar='BASE_URL',
+        help='Encode the URL BASE_URL/<relative path> of each file, instead of the JSON data itself')
+    parser.add_argument('-z', '--compress', action='store_true',
+        help='Store the JSON compressed, possibly over multiple QR codes, see json2qrcode.py')
+    parser.add_argument('--max-version', type=int, default=25,
+        help='With --compress, maximum QR code version of a single code (default: %(default)d)')
+    parser.add_argument('--error-correction', choices=['L', 'M', 'Q', 'H'], default='L',
+        help='With --compress, minimum error correction level (default: %(default)s)')
+    parser.add_argument('--pattern', action='append',
+        help='File name pattern of the files to process, can be given multiple times (default: *.json)')
+    parser.add_argument('--exclude', action='append',
+        help='File name pattern of files to skip, can be given multiple times (default: *.png.json, i.e. map image metadata)')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+        help='Number of worker processes (default: %(default)d)')
+    parser.add_argument('-f', '--force', action='store_true',
+        help='Render all QR codes, even when up-to-date')
+    parser.add_argument('directory')
+    options = parser.parse_args()
+
+    t0 = time.perf_counter()
+
+    output_dir = options.output_dir if options.output_dir is not None else options.directory
+    patterns = options.pattern if options.pattern is not None else ['*.json']
+    exclude = options.exclude if options.exclude is not None else ['*.png.json']
+
+    settings = dict(
+        url=options.url,
+        compress=options.compress,
+        max_version=options.max_version,
+        error_correction=options.error_correction
+    )
+
+    manifest_fname = os.path.join(output_dir, MANIFEST)
+    manifest = {}
+    if os.path.isfile(manifest_fname):
+        manifest = json.load(open(manifest_fname, 'rt'))
+
+    files = find_files(options.directory, patterns, exclude)
+
+    jobs = []
+    hashes = {}
+    for relpath in files:
+        fname = os.path.join(options.directory, relpath)
+        h = content_hash(fname, settings)
+        hashes[relpath] = h
+
+        entry = manifest.get(relpath)
+        if not options.force and entry is not None and entry['hash'] == h and \
+                all(os.path.isfile(os.path.join(output_dir, fn)) for fn in entry['outputs']):
+            continue
+
+        jobs.append((relpath, fname, output_fname(output_dir, relpath), settings))
+
+    print('%d file(s), %d up-to-date, %d to render' % (len(files), len(files)-len(jobs), len(jobs)))
+
+    results = []
+    if len(jobs) == 1 or options.workers == 1:
+        results = [render(job) for job in jobs]
+    elif len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(options.workers, len(jobs))) as pool:
+            results = list(pool.map(render, jobs))
+
+    errors = 0
+    for relpath, outputs, error in results:
+        if error is not None:
+            print('ERROR: %s: %s' % (relpath, error))
+            errors += 1
+            continue
+        # Output file names in the manifest are relative to the output directory
+        outputs = [os.path.relpath(fn, output_dir) for fn in outputs]
+        # Remove parts that are no longer used, e.g. when the number of parts decreased
+        if relpath in manifest:
+            for fn in manifest[relpath]['outputs']:
+                if fn not in outputs and os.path.isfile(os.path.join(output_dir, fn)):
+                    os.remove(os.path.join(output_dir, fn))
+        manifest[relpath] = dict(hash=hashes[relpath], outputs=outputs)
+        print('%s -> %s' % (relpath, ', '.join(outputs)))
+
+    # Remove the outputs of files that no longer exist, and forget them. Files
+    # that still exist but weren't matched by this run's patterns are kept.
+    removed = [relpath for relpath in manifest if not os.path.exists(os.path.join(options.directory, relpath))]
+    for relpath in removed:
+        entry = manifest.pop(relpath)
+        for fn in entry['outputs']:
+            if os.path.isfile(os.path.join(output_dir, fn)):
+                os.remove(os.path.join(output_dir, fn))
+        print('%s removed, deleted %s' % (relpath, ', '.join(entry['outputs'])))
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(manifest_fname, 'wt') as f:
+        f.write(json.dumps(manifest, sort_keys=True, indent=4))
+
+    print('Done in %.3f s' % (time.perf_counter() - t0))
+    if errors > 0:
+        sys.exit(-1)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Compressed (and possibly multi-part) QR code payloads for configuration data.
+# This uses https://pypi.org/project/qrcode/
+#
+# The data is compressed with raw deflate (so it can be decompressed with
+# DeflateStream in .NET) and then encoded with base45 (RFC 9285). The base45
+# alphabet is a subset of the QR alphanumeric character set, which stores 5.5
+# bits per character instead of 8 for byte mode, so about 97% of the
+# compressed size ends up in the QR code, instead of 133% for base64.
+#
+# Each QR code holds a single part, as text of the form
+#
+#   DS1:<index>/<count>:<crc>:<base45 data>
+#
+# with index starting at 1, and crc the CRC-32 (8 uppercase hex digits) of the
+# complete compressed payload, which also identifies the parts that belong
+# together. The base45 data of all parts, decoded and concatenated in order,
+# gives the compressed payload. A payload that fits in a single QR code is
+# simply encoded as part 1/1.
+import zlib
+import qrcode
+from qrcode.exceptions import DataOverflowError
+
+HEADER = 'DS1'
+
+BASE45_CHARSET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ $%*+-./:'
+
+# Error correction levels, from weakest to strongest
+ERROR_CORRECTION_LEVELS = [
+    ('L', qrcode.constants.ERROR_CORRECT_L),
+    ('M', qrcode.constants.ERROR_CORRECT_M),
+    ('Q', qrcode.constants.ERROR_CORRECT_Q),
+    ('H', qrcode.constants.ERROR_CORRECT_H),
+]
+
+MAX_PARTS = 99
+
+def base45_encode(data):
+    s = []
+    for i in range(0, len(data) - 1, 2):
+        n = data[i]*256 + data[i+1]
+        n, c = divmod(n, 45)
+        e, d = divmod(n, 45)
+        s.append(BASE45_CHARSET[c] + BASE45_CHARSET[d] + BASE45_CHARSET[e])
+    if len(data) % 2 == 1:
+        d, c = divmod(data[-1], 45)
+        s.append(BASE45_CHARSET[c] + BASE45_CHARSET[d])
+    return ''.join(s)
+
+def base45_decode(s):
+    values = [BASE45_CHARSET.index(ch) for ch in s]
+    assert len(values) % 3 != 1, 'Invalid base45 length %d' % len(values)
+    data = bytearray()
+    for i in range(0, len(values), 3):
+        v = values[i:i+3]
+        if len(v) == 3:
+            n = v[0] + v[1]*45 + v[2]*2025
+            assert n <= 0xffff
+            data.extend(divmod(n, 256))
+        else:
+            n = v[0] + v[1]*45
+            assert n <= 0xff
+            data.append(n)
+    return bytes(data)
+
+def compress(data):
+    """Raw deflate, i.e. without zlib header and checksum"""
+    c = zlib.compressobj(9, zlib.DEFLATED, -15)
+    return c.compress(data) + c.flush()
+
+def decompress(data):
+    return zlib.decompress(data, -15)
+
+def encode_parts(data, count):
+    """
+    Compress data and return it as a list of part strings, count or fewer (as
+    parts are split on an even number of bytes, and no part is left empty)
+    """
+    compressed = compress(data)
+    crc = zlib.crc32(compressed)
+    # Split on an even number of bytes, so each part is a valid base45 string on its own
+    size = (len(compressed) + count - 1) // count
+    size += size % 2
+    count = (len(compressed) + size - 1) // size
+    parts = []
+    for i in range(count):
+        chunk = compressed[i*size:(i+1)*size]
+        parts.append('%s:%d/%d:%08X:%s' % (HEADER, i+1, count, crc, base45_encode(chunk)))
+    return parts
+
+def decode_parts(parts):
+    """Reassemble and decompress part strings (in any order), returns the original data"""
+    chunks = {}
+    count = crc = None
+    for part in parts:
+        header, position, part_crc, payload = part.split(':', 3)
+        assert header == HEADER, 'Not a %s payload' % HEADER
+        index, part_count = [int(v) for v in position.split('/')]
+        assert count is None or (part_count == count and part_crc == crc), 'Parts of different payloads'
+        count = part_count
+        crc = part_crc
+        chunks[index] = base45_decode(payload)
+
+    missing = [i for i in range(1, count+1) if i not in chunks]
+    assert len(missing) == 0, 'Missing part(s) %s of %d' % (', '.join(map(str, missing)), count)
+
+    compressed = b''.join(chunks[i] for i in range(1, count+1))
+    assert '%08X' % zlib.crc32(compressed) == crc, 'Checksum mismatch'
+    return decompress(compressed)
+
+def fit_qrcode(text, min_error_correction='L', max_version=40):
+    """
+    Return a QRCode object for text using the smallest QR version it fits in,
+    with the strongest error correction level (not below min_error_correction)
+    that still fits in that version. Returns None if text doesn't fit in
+    max_version.
+    """
+
+    names = [name for name, level in ERROR_CORRECTION_LEVELS]
+    best = None
+
+    for name, level in ERROR_CORRECTION_LEVELS[names.index(min_error_correction):]:
+        qr = qrcode.QRCode(error_correction=level)
+        qr.add_data(text)
+        try:
+            qr.make(fit=True)
+        except (DataOverflowError, ValueError):
+            # Depending on the qrcode version, data that doesn't fit in version 40
+            # raises DataOverflowError or ValueError
+            break
+        # A stronger level never gives a smaller version
+        if qr.version > max_version or (best is not None and qr.version > best.version):
+            break
+        best = qr
+
+    return best
+
+def error_correction_name(qr):
+    return [name for name, level in ERROR_CORRECTION_LEVELS if level == qr.error_correction][0]
+
+def make_qrcodes(data, min_error_correction='L', max_version=40):
+    """
+    Compress data and encode it in as few QR codes as possible, each of at
+    most max_version. Returns a list of (part string, QRCode object).
+    """
+
+    for count in range(1, MAX_PARTS+1):
+        parts = encode_parts(data, count)
+        codes = []
+        for part in parts:
+            qr = fit_qrcode(part, min_error_correction, max_version)
+            if qr is None:
+                break
+            codes.append((part, qr))
+        if len(codes) == len(parts):
+            return codes
+
+    assert False, 'Data does not fit in %d QR codes of version %d' % (MAX_PARTS, max_version)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Query a state archive (see record_opensky.py) on area, time window and/or
+# aircraft, using the index of archiveindex.py (which is built or updated
+# first, as needed). The result is printed as a table, or written with
+# --json as a list of OpenSky "all state vectors" responses (one per
+# snapshot), i.e. in the layout PlaneData.ProcessDataUpdate in the app reads.
+#
+# Examples:
+#
+#   query_archive.py rec --bbox 52.2 52.5 4.6 5.0 --start 2024-05-01T14:00 --end 2024-05-01T14:30
+#   query_archive.py rec --icao24 484506 --start 2024-05-01 --end 2024-05-02 --json track.json
+import sys, json, argparse, time
+from datetime import datetime, timezone
+
+from statearchive import StateArchive, parse_time
+from archiveindex import ArchiveIndex, BUCKET_SECONDS, CELL_SIZE
+
+
+def print_table(responses):
+    print('%-19s %-6s %-8s %9s %10s %6s %s' % ('time', 'icao24', 'callsign', 'lat', 'lon', 'alt', 'ground'))
+    for response in responses:
+        t = datetime.fromtimestamp(response['time'], timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        for s in response['states']:
+            print('%-19s %-6s %-8s %9s %10s %6s %s' % (t, s[0], s[1].strip(),
+                '-' if s[6] is None else '%.5f' % s[6],
+                '-' if s[5] is None else '%.5f' % s[5],
+                '-' if s[7] is None else '%.0f' % s[7],
+                'yes' if s[8] else 'no'))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Query recorded state vectors on area, time and aircraft')
+    parser.add_argument('archive',
+        help='State archive, see record_opensky.py')
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('LAMIN', 'LAMAX', 'LOMIN', 'LOMAX'),
+        help='Only states with a position within this area (degrees, bounds inclusive)')
+    parser.add_argument('--icao24',
+        help='Only states of this aircraft (hex address), i.e. its track')
+    parser.add_argument('--start',
+        help='Only snapshots from this time (unix time or ISO date/time in UTC)')
+    parser.add_argument('--end',
+        help='Only snapshots up to this time (unix time or ISO date/time in UTC)')
+    parser.add_argument('--json', metavar='FILE',
+        help='Write the result as a list of OpenSky responses to FILE (- for stdout) instead of printing a table')
+    parser.add_argument('--no-update', action='store_true',
+        help='Don\'t update the index first, rows not indexed yet are scanned')
+    parser.add_argument('--bucket-seconds', type=int, default=BUCKET_SECONDS,
+        help='Time bucket size of the index (default: %(default)d), a different value rebuilds the index')
+    parser.add_argument('--cell-size', type=float, default=CELL_SIZE,
+        help='Grid cell size of the index in degrees (default: %(default)s), a different value rebuilds the index')
+    options = parser.parse_args()
+
+    start = None if options.start is None else parse_time(options.start)
+    end = None if options.end is None else parse_time(options.end)
+
+    # Status output goes to stderr when the result goes to stdout
+    log = sys.stderr if options.json == '-' else sys.stdout
+
+    archive = StateArchive(options.archive)
+    index = ArchiveIndex(archive, options.bucket_seconds, options.cell_size)
+    log.write('%s: %d snapshots, %d states, %d indexed\n' % (options.archive, len(archive), archive.rows, index.rows))
+
+    if not options.no_update and not index.up_to_date():
+        t0 = time.time()
+        index.update()
+        log.write('Index updated in %.1f s\n' % (time.time() - t0))
+
+    if options.bbox is None and options.icao24 is None:
+        sys.exit(0)
+
+    t0 = time.time()
+    if options.icao24 is not None:
+        rows = index.track(int(options.icao24, 16), start, end)
+        if options.bbox is not None:
+            lamin, lamax, lomin, lomax = options.bbox
+            lat, lon = archive.lat[rows], archive.lon[rows]
+            rows = rows[(lat >= lamin) & (lat <= lamax) & (lon >= lomin) & (lon <= lomax)]
+    else:
+        rows = index.bbox(*options.bbox, start=start, end=end)
+    responses = index.responses(rows)
+    log.write('%d states in %d snapshots (%d rows read) in %.3f s\n' % (len(rows), len(responses),
+        index.candidates, time.time() - t0))
+
+    if options.json == '-':
+        json.dump(responses, sys.stdout)
+        sys.stdout.write('\n')
+    elif options.json is not None:
+        json.dump(responses, open(options.json, 'wt'))
+    else:
+        print_table(responses)
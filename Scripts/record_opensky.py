@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Records OpenSky Network state vectors for an area, by polling the same
+# endpoint as the app (see FetchPlaneUpdates() in Application.cs), and stores
+# the snapshots in a columnar state archive, see statearchive.py.
+# Use --local to record from fake_opensky.py instead, e.g. when offline.
+#
+# The API only provides new data every 5-10 seconds, responses with the same
+# time as the previous one are not stored again.
+import sys, time, argparse
+import requests
+from statearchive import StateArchiveWriter, StateArchive
+
+OPENSKY_API_URL = 'https://opensky-network.org/api'
+
+# Same as OPENSKY_QUERY_INTERVAL in the app
+QUERY_INTERVAL = 8
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Record OpenSky Network state vectors to a state archive')
+    parser.add_argument('--lat-range', type=float, nargs=2, default=[50.513427, 53.748711],
+        help='Latitude range to query (default: %(default)s, i.e. the netherlands map)')
+    parser.add_argument('--lon-range', type=float, nargs=2, default=[2.812500, 7.734375],
+        help='Longitude range to query (default: %(default)s)')
+    parser.add_argument('--interval', type=float, default=QUERY_INTERVAL,
+        help='Seconds between queries (default: %(default)s)')
+    parser.add_argument('--count', type=int, default=0,
+        help='Stop after recording this many snapshots (default: run until interrupted)')
+    parser.add_argument('--api-url', default=OPENSKY_API_URL,
+        help='Base URL of the API (default: %(default)s)')
+    parser.add_argument('--local', type=int, nargs='?', const=8800, metavar='PORT',
+        help='Use fake_opensky.py running on localhost, on the given port (default: 8800)')
+    parser.add_argument('--auth', metavar='USER:PASSWORD',
+        help='OpenSky account, for higher rate limits and time resolution')
+    parser.add_argument('archive', help='Archive directory, created if needed, appended to if it exists')
+    options = parser.parse_args()
+
+    api_url = options.api_url
+    if options.local is not None:
+        api_url = 'http://localhost:%d/api' % options.local
+
+    url = '%s/states/all?lamin=%f&lamax=%f&lomin=%f&lomax=%f' % \
+        (api_url, options.lat_range[0], options.lat_range[1], options.lon_range[0], options.lon_range[1])
+
+    session = requests.Session()
+    if options.auth is not None:
+        session.auth = tuple(options.auth.split(':', 1))
+
+    writer = StateArchiveWriter(options.archive)
+    print('Recording %s to %s (%d snapshots, %d states present)' % (url, options.archive, writer.snapshots, writer.rows))
+    sys.stdout.flush()
+
+    recorded = 0
+    try:
+        while options.count == 0 or recorded < options.count:
+            t0 = time.time()
+
+            try:
+                r = session.get(url, timeout=30)
+                if r.status_code != 200:
+                    print('HTTP error %d' % r.status_code)
+                else:
+                    data = r.json()
+                    states = data['states'] or []
+                    if data['time'] == writer.last_time:
+                        print('[%d] No new data' % data['time'])
+                    else:
+                        writer.append(data['time'], states)
+                        recorded += 1
+                        print('[%d] %d states' % (data['time'], len(states)))
+            except (requests.RequestException, ValueError) as e:
+                print('Error: %s' % e)
+
+            sys.stdout.flush()
+
+            if options.count == 0 or recorded < options.count:
+                time.sleep(max(0.0, options.interval - (time.time() - t0)))
+    except KeyboardInterrupt:
+        pass
+
+    writer.close()
+
+    archive = StateArchive(options.archive)
+    print('%s: %d snapshots, %d states' % (options.archive, len(archive), archive.rows))
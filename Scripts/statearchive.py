@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Columnar, append-only storage of OpenSky state vector snapshots
+# (https://openskynetwork.github.io/opensky-api/rest.html#all-state-vectors),
+# as recorded by record_opensky.py.
+#
+# An archive is a directory holding one raw little-endian binary file per
+# column (<column>.bin), with one entry per state vector, plus two snapshot
+# index columns: the snapshot time (the "time" field of the response) and the
+# end row of each snapshot. Only the fields used by PlaneData.ProcessDataUpdate
+# in the app are stored. Missing (null) values are stored as NaN for floats,
+# and as 0 for time_position (which the app skips).
+#
+# Rows are appended before the snapshot index entry, so after a crash the
+# index tells how many rows are valid, and a writer reopening the archive
+# drops any incomplete rows. Readers memory-map the files, so no parsing is
+# needed to replay or analyze a recording.
+import os, json
+from datetime import datetime, timezone
+import numpy as np
+
+# (name, dtype, index in the OpenSky state vector)
+STATE_COLUMNS = [
+    ('icao24',          '<u4', 0),      # 24-bit address, parsed from hex
+    ('callsign',        'S8', 1),
+    ('time_position',   '<i8', 3),
+    ('lon',             '<f8', 5),
+    ('lat',             '<f8', 6),
+    ('baro_altitude',   '<f4', 7),
+    ('on_ground',       'u1', 8),
+    ('velocity',        '<f4', 9),
+    ('heading',         '<f4', 10),     # true_track
+    ('vertical_rate',   '<f4', 11),
+    ('geo_altitude',    '<f4', 13),
+]
+
+SNAPSHOT_COLUMNS = [
+    ('snapshot_time',   '<i8'),
+    ('snapshot_end',    '<i8'),
+]
+
+FORMAT_VERSION = 1
+
+def states_to_columns(states):
+    """Convert a list of OpenSky state vectors (as parsed from JSON) to a dict of column arrays"""
+    columns = {}
+    n = len(states)
+    for name, dtype, idx in STATE_COLUMNS:
+        if name == 'icao24':
+            values = [int(s[idx], 16) for s in states]
+        elif name == 'callsign':
+            values = [(s[idx] or '').strip().encode('ascii', 'replace') for s in states]
+        elif name == 'time_position':
+            values = [s[idx] or 0 for s in states]
+        elif name == 'on_ground':
+            values = [bool(s[idx]) for s in states]
+        else:
+            values = [np.nan if s[idx] is None else s[idx] for s in states]
+        columns[name] = np.array(values, dtype=dtype).reshape(n)
+    return columns
+
+def columns_to_states(columns):
+    """Inverse of states_to_columns(): a list of OpenSky state vectors, with the
+    fields that are not stored set to None"""
+    states = []
+    for r in range(len(columns['icao24'])):
+        s = [None] * 17
+        for name, dtype, idx in STATE_COLUMNS:
+            v = columns[name][r]
+            if name == 'icao24':
+                v = icao24_string(v)
+            elif name == 'callsign':
+                v = v.decode('ascii')
+            elif name == 'time_position':
+                v = None if v == 0 else int(v)
+            elif name == 'on_ground':
+                v = bool(v)
+            else:
+                v = None if np.isnan(v) else float(v)
+            s[idx] = v
+        states.append(s)
+    return states
+
+def parse_time(s):
+    """Unix time, or an ISO date (and time), taken as UTC"""
+    try:
+        return int(s)
+    except ValueError:
+        t = datetime.fromisoformat(s)
+        if t.tzinfo is None:
+            t = t.replace(tzinfo=timezone.utc)
+        return int(t.timestamp())
+
+def icao24_string(value):
+    return '%06x' % value
+
+def column_fname(directory, name):
+    return os.path.join(directory, name + '.bin')
+
+
+class StateArchiveWriter:
+
+    """Appends snapshots to an archive, creating it if needed"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        meta_fname = os.path.join(directory, 'meta.json')
+        meta = dict(
+            version=FORMAT_VERSION,
+            columns=[(name, dtype) for name, dtype, idx in STATE_COLUMNS],
+            snapshot_columns=SNAPSHOT_COLUMNS
+        )
+        if os.path.isfile(meta_fname):
+            existing = json.load(open(meta_fname, 'rt'))
+            assert existing['version'] == FORMAT_VERSION, 'Archive %s has format version %d' % (directory, existing['version'])
+        else:
+            with open(meta_fname, 'wt') as f:
+                f.write(json.dumps(meta, indent=4))
+
+        # Drop anything beyond the last complete snapshot, left by an interrupted append
+        self.snapshots, self.rows, self.last_time = _valid_lengths(directory)
+        for name, dtype in SNAPSHOT_COLUMNS:
+            _truncate(column_fname(directory, name), self.snapshots * np.dtype(dtype).itemsize)
+        for name, dtype, idx in STATE_COLUMNS:
+            _truncate(column_fname(directory, name), self.rows * np.dtype(dtype).itemsize)
+
+        self.files = {}
+        for name, dtype, idx in STATE_COLUMNS:
+            self.files[name] = open(column_fname(directory, name), 'ab')
+        for name, dtype in SNAPSHOT_COLUMNS:
+            self.files[name] = open(column_fname(directory, name), 'ab')
+
+    def append(self, time, states):
+        """Append a snapshot, i.e. the time and states of a single API response"""
+
+        columns = states_to_columns(states)
+        for name, dtype, idx in STATE_COLUMNS:
+            f = self.files[name]
+            f.write(columns[name].tobytes())
+            f.flush()
+
+        self.rows += len(states)
+        self.snapshots += 1
+        self.last_time = time
+
+        for name, value in [('snapshot_time', time), ('snapshot_end', self.rows)]:
+            f = self.files[name]
+            f.write(np.array([value], dtype='<i8').tobytes())
+            f.flush()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+def _truncate(fname, size):
+    if os.path.isfile(fname) and os.path.getsize(fname) > size:
+        with open(fname, 'r+b') as f:
+            f.truncate(size)
+
+def _valid_lengths(directory):
+    """Return (number of snapshots, number of rows, last snapshot time) of the complete part of an archive"""
+
+    counts = []
+    for name, dtype in SNAPSHOT_COLUMNS:
+        fname = column_fname(directory, name)
+        size = os.path.getsize(fname) if os.path.isfile(fname) else 0
+        counts.append(size // np.dtype(dtype).itemsize)
+    snapshots = min(counts)
+
+    if snapshots == 0:
+        return 0, 0, None
+
+    with open(column_fname(directory, 'snapshot_end'), 'rb') as f:
+        f.seek((snapshots-1) * 8)
+        rows = int(np.frombuffer(f.read(8), dtype='<i8')[0])
+    with open(column_fname(directory, 'snapshot_time'), 'rb') as f:
+        f.seek((snapshots-1) * 8)
+        last_time = int(np.frombuffer(f.read(8), dtype='<i8')[0])
+
+    # Rows beyond the shortest column are incomplete as well
+    for name, dtype, idx in STATE_COLUMNS:
+        fname = column_fname(directory, name)
+        size = os.path.getsize(fname) if os.path.isfile(fname) else 0
+        assert size // np.dtype(dtype).itemsize >= rows, 'Column %s of %s is truncated' % (name, directory)
+
+    return snapshots, rows, last_time
+
+def _map(fname, dtype, count):
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(fname, dtype=dtype, mode='r', shape=(count,))
+
+
+class StateArchive:
+
+    """
+    Read-only, memory-mapped view of an archive. Each column is available as
+    an array attribute over all rows (e.g. archive.lat), snapshot i covers rows
+    archive.snapshot_start[i] to archive.snapshot_end[i].
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        assert os.path.isfile(os.path.join(directory, 'meta.json')), '%s is not a state archive' % directory
+
+        snapshots, self.rows, last_time = _valid_lengths(directory)
+
+        for name, dtype in SNAPSHOT_COLUMNS:
+            setattr(self, name, _map(column_fname(directory, name), dtype, snapshots))
+        for name, dtype, idx in STATE_COLUMNS:
+            setattr(self, name, _map(column_fname(directory, name), dtype, self.rows))
+
+        self.snapshot_start = np.concatenate(([0], self.snapshot_end[:-1])).astype(np.int64)
+
+    def __len__(self):
+        """Number of snapshots"""
+        return len(self.snapshot_time)
+
+    def column_names(self):
+        return [name for name, dtype, idx in STATE_COLUMNS]
+
+    def snapshot(self, i):
+        """Return the columns of snapshot i, as a dict of arrays (views, no copies)"""
+        s = slice(self.snapshot_start[i], self.snapshot_end[i])
+        return { name: getattr(self, name)[s] for name in self.column_names() }
+
+    def snapshot_index(self, time):
+        """Index of the last snapshot at or before time, or -1"""
+        return int(np.searchsorted(self.snapshot_time, time, side='right')) - 1
+
+    def row_times(self):
+        """Snapshot time of each row"""
+        return np.repeat(self.snapshot_time, self.snapshot_end - self.snapshot_start)
+
+    def gather(self, rows):
+        """The columns of the given rows (an index array), as a dict of arrays"""
+        return { name: getattr(self, name)[rows] for name in self.column_names() }
+
+    def row_snapshots(self, rows):
+        """Snapshot index of each of the given rows"""
+        return np.searchsorted(self.snapshot_end, rows, side='right')
+
+    def states(self, i):
+        """Snapshot i as a list of OpenSky state vectors, i.e. as in the original API
+        response (with the fields that are not stored set to None)"""
+        return columns_to_states(self.snapshot(i))
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Texture-ready map image data.
+# A map PNG has to be decoded on the device before it can be uploaded to the
+# GPU, which stalls rendering for large maps. A .tex file holds the image
+# already padded to power-of-two dimensions, with a complete mip chain, as
+# raw RGBA (8 bits per channel) or BC1 (DXT1) compressed blocks, so it can
+# be memory-mapped and uploaded level by level as-is.
+#
+# File layout (all values little-endian):
+#
+#   header      magic 'DSTX', uint32 version, uint32 format (FORMATS),
+#               uint32 width, height (padded), uint32 image width, height,
+#               uint32 number of levels
+#   level table per level: uint32 width, height, uint64 offset, size
+#   data        the levels, largest first, each starting at a multiple of
+#               ALIGNMENT bytes from the start of the file
+#
+# Rows are stored top to bottom, like the PNG. The image is in the upper-left
+# corner of the padded texture, the padding repeats the image's edge pixels
+# (so downsampled levels don't darken towards the image edges). The texture
+# coordinates of the image corner are therefore (image width / width,
+# image height / height), the 'uv_scale' in the .png.json metadata.
+import os, struct
+import numpy as np
+
+MAGIC = b'DSTX'
+VERSION = 1
+
+# Format name -> id in the header
+FORMATS = { 'rgba8': 0, 'bc1': 1 }
+
+ALIGNMENT = 256
+
+HEADER = struct.Struct('<4s7I')
+LEVEL = struct.Struct('<2I2Q')
+
+# BC1 blocks are compressed this many block rows at a time, to limit memory use
+BC1_BLOCK_ROWS = 64
+
+def next_power_of_two(n):
+    return 1 << max(n - 1, 0).bit_length()
+
+def level_sizes(width, height):
+    """Sizes of the mip levels of a (power-of-two) texture, down to 1x1"""
+    sizes = [(width, height)]
+    while sizes[-1] != (1, 1):
+        w, h = sizes[-1]
+        sizes.append((max(w // 2, 1), max(h // 2, 1)))
+    return sizes
+
+def level_bytes(width, height, format):
+    if format == 'bc1':
+        # 8 bytes per 4x4 block, levels smaller than a block still take a full one
+        return ((width + 3) // 4) * ((height + 3) // 4) * 8
+    return width * height * 4
+
+def texture_layout(image_size, format):
+    """
+    Padded size and (width, height, offset, size) of each level, for an image
+    of image_size in the given format
+    """
+    assert format in FORMATS, 'Unknown texture format %s' % format
+    width, height = [next_power_of_two(s) for s in image_size]
+    sizes = level_sizes(width, height)
+
+    offset = HEADER.size + len(sizes) * LEVEL.size
+    levels = []
+    for w, h in sizes:
+        offset = (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+        n = level_bytes(w, h, format)
+        levels.append((w, h, offset, n))
+        offset += n
+
+    return (width, height), levels
+
+def texture_metadata(url, image_size, format):
+    """Texture entry for the .png.json metadata of a map image of image_size"""
+    (width, height), levels = texture_layout(image_size, format)
+    return dict(
+        url=url,
+        format=format,
+        width=width,
+        height=height,
+        image_width=image_size[0],
+        image_height=image_size[1],
+        padding=[width - image_size[0], height - image_size[1]],
+        uv_scale=[image_size[0] / width, image_size[1] / height],
+        levels=[dict(width=w, height=h, offset=o, size=n) for w, h, o, n in levels]
+    )
+
+def pad_image(pixels, width, height):
+    """Pad an RGBA array to width x height, repeating the right and bottom edges"""
+    h, w = pixels.shape[:2]
+    return np.pad(pixels, ((0, height - h), (0, width - w), (0, 0)), mode='edge')
+
+def downsample(pixels):
+    """Next mip level, averaging 2x2 pixels (or 2x1/1x2 once a dimension is 1)"""
+    p = pixels.astype(np.uint16)
+    if p.shape[0] > 1:
+        p = p[0::2] + p[1::2]
+    else:
+        p = p * 2
+    if p.shape[1] > 1:
+        p = p[:, 0::2] + p[:, 1::2]
+    else:
+        p = p * 2
+    return ((p + 2) // 4).astype(np.uint8)
+
+def to_565(rgb):
+    """Quantize uint8 RGB (..., 3) to RGB565 values"""
+    rgb = rgb.astype(np.uint32)
+    return ((rgb[..., 0] * 31 + 127) // 255 << 11) | ((rgb[..., 1] * 63 + 127) // 255 << 5) | ((rgb[..., 2] * 31 + 127) // 255)
+
+def from_565(c):
+    """RGB565 values to float RGB (..., 3) in 0-255, as decoded by the GPU"""
+    r = (c >> 11) & 31
+    g = (c >> 5) & 63
+    b = c & 31
+    return np.stack([r * 255 / 31.0, g * 255 / 63.0, b * 255 / 31.0], axis=-1)
+
+def bc1_endpoints(blocks):
+    """
+    Endpoint colors (uint8 RGB) of (blocks, 16, 3) texels: the diagonal of the
+    bounding box of each block's colors that follows the sign of their
+    covariance (relative to the channel with the largest range), inset by 1/16
+    of the range on each side, as common fast BC1 encoders do. Taking the
+    box's max and min corners instead gives endpoints far from both colors of
+    e.g. a red/green edge.
+    """
+    lo = blocks.min(axis=1).astype(np.float32)
+    hi = blocks.max(axis=1).astype(np.float32)
+    n = len(blocks)
+
+    d = blocks - 0.5 * (lo + hi)[:, None, :]
+    main = (hi - lo).argmax(axis=1)
+    cov = (d * d[np.arange(n), :, main][:, :, None]).sum(axis=1)
+    flip = cov < 0
+    lo, hi = np.where(flip, hi, lo), np.where(flip, lo, hi)
+
+    inset = (hi - lo) / 16
+    e0 = np.clip(np.rint(hi - inset), 0, 255).astype(np.uint8)
+    e1 = np.clip(np.rint(lo + inset), 0, 255).astype(np.uint8)
+    return e0, e1
+
+def compress_bc1(pixels):
+    """
+    BC1 blocks (bytes) for an RGBA array, alpha is ignored. The endpoints are
+    taken from the bounding box of each block's colors (see bc1_endpoints()),
+    i.e. a fast encoder rather than a high-quality one, which works well for
+    the mostly flat colors of map tiles.
+    """
+    h, w = pixels.shape[:2]
+    if h % 4 or w % 4:
+        pixels = np.pad(pixels, ((0, -h % 4), (0, -w % 4), (0, 0)), mode='edge')
+    bh, bw = pixels.shape[0] // 4, pixels.shape[1] // 4
+
+    output = []
+    for r in range(0, bh, BC1_BLOCK_ROWS):
+        rows = pixels[r*4:(r+BC1_BLOCK_ROWS)*4, :, :3]
+        n = rows.shape[0] // 4
+        # (blocks, 16 texels, rgb), texels in row-major order within a block
+        blocks = rows.reshape(n, 4, bw, 4, 3).transpose(0, 2, 1, 3, 4).reshape(n * bw, 16, 3)
+
+        e0, e1 = bc1_endpoints(blocks)
+        c0 = to_565(e0)
+        c1 = to_565(e1)
+        # The 4-color mode needs c0 > c1. For c0 == c1 (3-color mode) only
+        # index 0 is used.
+        swap = c0 < c1
+        c0, c1 = np.where(swap, c1, c0), np.where(swap, c0, c1)
+
+        e0 = from_565(c0)
+        e1 = from_565(c1)
+        palette = np.stack([e0, e1, (2*e0 + e1) / 3, (e0 + 2*e1) / 3], axis=1)
+        d = ((blocks[:, :, None, :].astype(np.float32) - palette[:, None, :, :].astype(np.float32))**2).sum(axis=3)
+        indices = d.argmin(axis=2).astype(np.uint32)
+        indices[c0 == c1] = 0
+
+        bits = (indices << (2 * np.arange(16, dtype=np.uint32))).sum(axis=1, dtype=np.uint32)
+
+        data = np.empty((n * bw, 2), dtype='<u4')
+        data[:, 0] = c0 | (c1 << 16)
+        data[:, 1] = bits
+        output.append(data.tobytes())
+
+    return b''.join(output)
+
+def decompress_bc1(data, width, height):
+    """Decode BC1 blocks to a (height, width, 3) float RGB array in 0-255, as the GPU does"""
+    bw, bh = (width + 3) // 4, (height + 3) // 4
+    blocks = np.frombuffer(data, dtype='<u4', count=bw * bh * 2).reshape(-1, 2)
+    c0 = blocks[:, 0] & 0xffff
+    c1 = blocks[:, 0] >> 16
+
+    e0 = from_565(c0)
+    e1 = from_565(c1)
+    four = (c0 > c1)[:, None]
+    # 3-color mode: index 2 is the midpoint, index 3 black (transparent)
+    palette = np.stack([e0, e1,
+        np.where(four, (2*e0 + e1) / 3, (e0 + e1) / 2),
+        np.where(four, (e0 + 2*e1) / 3, 0)], axis=1)
+
+    indices = (blocks[:, 1][:, None] >> (2 * np.arange(16, dtype=np.uint32))) & 3
+    texels = np.take_along_axis(palette, indices[:, :, None].astype(np.int64), axis=1)
+    pixels = texels.reshape(bh, bw, 4, 4, 3).transpose(0, 2, 1, 3, 4).reshape(bh * 4, bw * 4, 3)
+    return pixels[:height, :width]
+
+def bc1_error(pixels):
+    """Maximum and RMS per-channel error (0-255) of BC1 compressing the RGBA array pixels"""
+    h, w = pixels.shape[:2]
+    decoded = decompress_bc1(compress_bc1(pixels), w, h)
+    diff = decoded - pixels[:, :, :3].astype(np.float64)
+    return np.abs(diff).max(), np.sqrt((diff * diff).mean())
+
+def write_texture(fname, img, format='rgba8'):
+    """
+    Write PIL image img as texture file fname, returns the metadata entry
+    (see texture_metadata(), with url set to the base name of fname)
+    """
+    assert format in FORMATS, 'Unknown texture format %s' % format
+    image_size = img.size
+    (width, height), levels = texture_layout(image_size, format)
+
+    pixels = pad_image(np.asarray(img.convert('RGBA')), width, height)
+
+    with open(fname, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, FORMATS[format], width, height, image_size[0], image_size[1], len(levels)))
+        for level in levels:
+            f.write(LEVEL.pack(*level))
+
+        for idx, (w, h, offset, size) in enumerate(levels):
+            if idx > 0:
+                pixels = downsample(pixels)
+            assert pixels.shape[:2] == (h, w)
+            f.write(b'\0' * (offset - f.tell()))
+            if format == 'bc1':
+                data = compress_bc1(pixels)
+            else:
+                data = np.ascontiguousarray(pixels).tobytes()
+            assert len(data) == size
+            f.write(data)
+
+    return texture_metadata(os.path.basename(fname), image_size, format)
+
+def read_texture(fname):
+    """Header of a texture file: (format, (width, height), (image width, height), levels)"""
+    with open(fname, 'rb') as f:
+        magic, version, format, width, height, image_width, image_height, count = HEADER.unpack(f.read(HEADER.size))
+        assert magic == MAGIC, '%s is not a texture file' % fname
+        assert version == VERSION, '%s: unsupported texture file version %d' % (fname, version)
+        levels = [LEVEL.unpack(f.read(LEVEL.size)) for i in range(count)]
+    names = { v: k for k, v in FORMATS.items() }
+    return names[format], (width, height), (image_width, image_height), levels
+
+
+if __name__ == '__main__':
+
+    # Round-trip check of the BC1 encoder: compress, decode as the GPU does and
+    # compare, on synthetic blocks (with error bounds) plus the given images
+    import argparse
+    from PIL import Image
+
+    parser = argparse.ArgumentParser(description='Round-trip check of the BC1 encoder')
+    parser.add_argument('images', nargs='*',
+        help='Images to report the BC1 error of, e.g. map PNGs')
+    parser.add_argument('--blocks', type=int, default=4096,
+        help='Number of random synthetic blocks per test (default: %(default)d)')
+    parser.add_argument('--seed', type=int, default=123456)
+    options = parser.parse_args()
+
+    rng = np.random.default_rng(options.seed)
+    n = options.blocks
+
+    def blocks_image(texels):
+        """(n, 4, 4, 3) block texels as a 4 x 4n RGBA image"""
+        img = np.full((4, 4 * n, 4), 255, dtype=np.uint8)
+        img[:, :, :3] = texels.transpose(1, 0, 2, 3).reshape(4, 4 * n, 3)
+        return img
+
+    # Two colors per block in random positions, i.e. an edge, line or label.
+    # The error is bounded by the endpoint inset (1/16 of the range) plus the
+    # RGB565 quantization
+    a = rng.integers(0, 256, (n, 1, 1, 3))
+    b = rng.integers(0, 256, (n, 1, 1, 3))
+    mask = rng.random((n, 4, 4, 1)) < 0.5
+    two_colors = blocks_image(np.where(mask, a, b))
+    # Linear ramps between two colors, along x
+    t = (np.arange(4) / 3.0)[None, None, :, None]
+    ramps = blocks_image(np.rint(a + (b - a) * t).repeat(4, axis=1))
+    flat = blocks_image(np.broadcast_to(a, (n, 4, 4, 3)))
+
+    # Largest error of RGB565 (5-bit channels) and of the inset endpoints (rounded)
+    quantization = 255 / 62.0
+    inset = 255 / 16.0 + 0.5
+
+    for name, img, bound in [('flat', flat, quantization), ('two colors', two_colors, inset + quantization), ('ramps', ramps, inset + quantization)]:
+        max_error, rms = bc1_error(img)
+        print('%-12s max error %6.2f, RMS %5.2f (bound %.1f)' % (name, max_error, rms, bound))
+        assert max_error <= bound, 'BC1 error %.2f of %s blocks exceeds %.1f' % (max_error, name, bound)
+
+    for fname in options.images:
+        max_error, rms = bc1_error(np.asarray(Image.open(fname).convert('RGBA')))
+        print('%-12s max error %6.2f, RMS %5.2f' % (fname, max_error, rms))
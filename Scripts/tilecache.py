@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Persistent on-disk cache of slippy-map tiles, stored in a single SQLite file.
+# The file follows the MBTiles layout (https://github.com/mapbox/mbtiles-spec),
+# i.e. a `tiles` table with TMS row numbering, so it can also be opened by other
+# MBTiles tools. The extra columns hold what is needed for HTTP revalidation
+# (ETag, Last-Modified, expiry time) and LRU eviction (time of last use).
+#
+# A cache file holds the tiles of a single tile server. For the tile servers
+# of a configuration (each with their own imagery) there is one file per tile
+# server id, see server_cache_fname().
+import os, re, time, sqlite3, threading
+from email.utils import parsedate_to_datetime
+
+# Used when the tile server does not specify a max-age or Expires header
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'dutchskies')
+
+def server_cache_fname(server_id, directory=DEFAULT_CACHE_DIR):
+    """Cache file for the tiles of the tile server with the given id (as in tile_servers)"""
+    return os.path.join(directory, '%s-tiles.mbtiles' % re.sub(r'[^A-Za-z0-9_.-]', '_', server_id))
+
+# The OSM tile servers, see osmtiles.OSM_TILE_SERVERS
+DEFAULT_CACHE_FILE = server_cache_fname('osm')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT, UNIQUE (name));
+CREATE TABLE IF NOT EXISTS tiles (
+    zoom_level INTEGER,
+    tile_column INTEGER,
+    tile_row INTEGER,
+    tile_data BLOB,
+    etag TEXT,
+    last_modified TEXT,
+    expires REAL,
+    last_used REAL,
+    PRIMARY KEY (zoom_level, tile_column, tile_row)
+);
+CREATE INDEX IF NOT EXISTS tiles_last_used ON tiles (last_used);
+"""
+
+# Number of cache writes after which changes are committed
+COMMIT_INTERVAL = 100
+
+def tms_row(zoom, y):
+    """MBTiles uses TMS row numbering, i.e. row 0 is at the south"""
+    return (1 << zoom) - 1 - y
+
+def expiry_time(headers, now):
+    """Return time at which a response with the given headers needs revalidation"""
+
+    cc = headers.get('Cache-Control', '')
+    m = re.search(r'max-age=(\d+)', cc)
+    if m is not None:
+        return now + int(m.group(1))
+
+    if 'Expires' in headers:
+        try:
+            return parsedate_to_datetime(headers['Expires']).timestamp()
+        except (TypeError, ValueError):
+            pass
+
+    return now + DEFAULT_MAX_AGE
+
+
+class CachedTile:
+
+    def __init__(self, data, etag, last_modified, fresh):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        # False if the tile has expired and needs revalidation
+        self.fresh = fresh
+
+    def conditional_headers(self):
+        """Request headers to revalidate this tile with the tile server"""
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class TileCache:
+
+    """
+    Tile cache with a size limit (in bytes of tile data), least-recently-used
+    tiles are evicted first. Safe to use from multiple threads.
+    """
+
+    def __init__(self, fname=DEFAULT_CACHE_FILE, max_bytes=2048*1024*1024):
+        d = os.path.dirname(fname)
+        if d != '':
+            os.makedirs(d, exist_ok=True)
+
+        self.fname = fname
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(fname, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.db.execute("INSERT OR IGNORE INTO metadata VALUES ('name', 'DutchSkies tile cache')")
+        self.db.execute("INSERT OR IGNORE INTO metadata VALUES ('format', 'png')")
+        self.db.commit()
+
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(LENGTH(tile_data)), 0) FROM tiles').fetchone()[0]
+        self.pending_writes = 0
+
+        # Statistics
+        self.hits = 0               # Served from disk, still fresh
+        self.revalidated = 0        # Served from disk after a 304 Not Modified
+        self.misses = 0             # Not cached, or changed on the server
+        self.evicted = 0
+        self.bytes_from_cache = 0
+        self.bytes_downloaded = 0
+
+    def _written(self):
+        # Lock must be held
+        self.pending_writes += 1
+        if self.pending_writes >= COMMIT_INTERVAL:
+            self.db.commit()
+            self.pending_writes = 0
+
+    def lookup(self, zoom, x, y):
+        """Return CachedTile, or None if the tile is not in the cache"""
+
+        now = time.time()
+
+        with self.lock:
+            row = self.db.execute(
+                'SELECT tile_data, etag, last_modified, expires FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                (zoom, x, tms_row(zoom, y))).fetchone()
+
+            if row is None:
+                return None
+
+            data, etag, last_modified, expires = row
+            fresh = now < expires
+
+            if fresh:
+                self.hits += 1
+                self.bytes_from_cache += len(data)
+                self.db.execute(
+                    'UPDATE tiles SET last_used=? WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                    (now, zoom, x, tms_row(zoom, y)))
+                self._written()
+
+        return CachedTile(data, etag, last_modified, fresh)
+
+    def store(self, zoom, x, y, data, headers):
+        """Store tile data retrieved from the server (i.e. a 200 response)"""
+
+        now = time.time()
+
+        with self.lock:
+            old = self.db.execute(
+                'SELECT LENGTH(tile_data) FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                (zoom, x, tms_row(zoom, y))).fetchone()
+            if old is not None:
+                self.total_bytes -= old[0]
+
+            self.db.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (zoom, x, tms_row(zoom, y), data,
+                headers.get('ETag'), headers.get('Last-Modified'), expiry_time(headers, now), now))
+
+            self.misses += 1
+            self.bytes_downloaded += len(data)
+            self.total_bytes += len(data)
+
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+            self._written()
+
+    def refresh(self, zoom, x, y, tile, headers):
+        """Mark cached tile as still valid, after the server responded 304 Not Modified"""
+
+        now = time.time()
+
+        with self.lock:
+            self.db.execute(
+                'UPDATE tiles SET expires=?, last_used=? WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                (expiry_time(headers, now), now, zoom, x, tms_row(zoom, y)))
+
+            self.revalidated += 1
+            self.bytes_from_cache += len(tile.data)
+
+            self._written()
+
+    def _evict(self):
+        # Lock must be held. Evicts down to 90% of the limit, to avoid
+        # evicting on every store once the cache is full
+        target = int(0.9 * self.max_bytes)
+
+        rows = self.db.execute('SELECT rowid, LENGTH(tile_data) FROM tiles ORDER BY last_used')
+        evict = []
+        for rowid, size in rows:
+            if self.total_bytes <= target:
+                break
+            evict.append((rowid,))
+            self.total_bytes -= size
+
+        self.db.executemany('DELETE FROM tiles WHERE rowid=?', evict)
+        self.evicted += len(evict)
+
+    def report(self):
+        return 'Tile cache: %d hits, %d revalidated, %d misses, %d evicted | %.1f MB from cache, %.1f MB downloaded | %.1f MB in %s' % \
+            (self.hits, self.revalidated, self.misses, self.evicted,
+            self.bytes_from_cache/1e6, self.bytes_downloaded/1e6, self.total_bytes/1e6, self.fname)
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
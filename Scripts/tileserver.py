@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Local tile server, answering /<server-id>/{zoom}/{x}/{y}.png from the
+# TileCache (MBTiles) file of tile server <server-id>, for tile_server map
+# configurations on a LAN. Instead of every device fetching every tile from
+# the public tile servers on every map load, point the tile_servers urls of a
+# configuration at this server, e.g. http://<host>:8700/osm/{zoom}/{x}/{y}.png
+# (prewarm_tiles.py -o writes such a configuration). /{zoom}/{x}/{y}.png
+# serves the tiles of --default-server.
+#
+# Fill the caches beforehand with prewarm_tiles.py. Tiles missing from a
+# cache are fetched from the --upstream servers of that id, if given, and stored
+# (concurrent requests for the same tile share a single fetch), otherwise
+# they are answered with 404. Cached tiles are served even when they have
+# expired, prewarm_tiles.py revalidates them.
+#
+# This uses https://pypi.org/project/aiohttp/
+import os, sys, time, asyncio, argparse
+from urllib.parse import urlsplit
+from aiohttp import web, ClientSession, ClientTimeout, ClientError
+from tilecache import TileCache, DEFAULT_CACHE_DIR, server_cache_fname
+from osmtiles import tile_url, USER_AGENT
+
+# Max-age for clients, the app doesn't cache tiles itself though
+CLIENT_MAX_AGE = 24 * 3600
+
+class TileServer:
+
+    """
+    Serves the tiles of each tile server id from its own cache file in
+    cache_dir. upstream maps tile server ids to lists of URL templates.
+    """
+
+    def __init__(self, cache_dir, cache_size, upstream=None, default_server='osm', max_per_host=2):
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.upstream = upstream or {}
+        self.default_server = default_server
+        self.max_per_host = max_per_host
+        self.caches = {}
+        self.session = None
+        self.host_slots = {}
+        self.pending = {}
+        self.next_server = {}
+        self.stats = dict(requests=0, served=0, not_found=0, upstream_fetches=0, upstream_errors=0, merged_requests=0)
+        self.seconds = 0.0
+
+    async def start(self, app):
+        if self.upstream:
+            self.session = ClientSession(timeout=ClientTimeout(total=30), headers={'User-Agent': USER_AGENT})
+            for urls in self.upstream.values():
+                for url in urls:
+                    self.host_slots.setdefault(urlsplit(url).netloc, asyncio.Semaphore(self.max_per_host))
+
+    async def stop(self, app):
+        if self.session is not None:
+            await self.session.close()
+        for cache in self.caches.values():
+            cache.close()
+
+    def cache(self, server):
+        """Cache of tile server id server, or None if there is none (and no upstream for it)"""
+        cache = self.caches.get(server)
+        if cache is None:
+            fname = server_cache_fname(server, self.cache_dir)
+            if not os.path.isfile(fname) and server not in self.upstream:
+                return None
+            cache = self.caches[server] = TileCache(fname, self.cache_size)
+        return cache
+
+    async def fetch(self, server, zoom, x, y):
+        """Fetch a tile from upstream and store it, returns the data, or None on error"""
+        urls = self.upstream[server]
+        n = self.next_server.get(server, 0)
+        url = tile_url(urls[n % len(urls)], zoom, x, y)
+        self.next_server[server] = n + 1
+        self.stats['upstream_fetches'] += 1
+        try:
+            async with self.host_slots[urlsplit(url).netloc]:
+                async with self.session.get(url) as r:
+                    if r.status != 200:
+                        raise ClientError('HTTP error %d' % r.status)
+                    data = await r.read()
+                    headers = r.headers
+        except (ClientError, asyncio.TimeoutError) as e:
+            self.stats['upstream_errors'] += 1
+            print('Could not get %s: %s' % (url, e or type(e).__name__))
+            sys.stdout.flush()
+            return None
+
+        await asyncio.get_running_loop().run_in_executor(None, self.caches[server].store, zoom, x, y, data, headers)
+        return data
+
+    async def fetch_shared(self, server, zoom, x, y):
+        """Fetch a tile, or join the fetch of the same tile in progress"""
+        key = (server, zoom, x, y)
+        pending = self.pending.get(key)
+        if pending is None:
+            pending = self.pending[key] = asyncio.ensure_future(self.fetch(server, zoom, x, y))
+            pending.add_done_callback(lambda f: self.pending.pop(key, None))
+        else:
+            self.stats['merged_requests'] += 1
+        return await asyncio.shield(pending)
+
+    async def handle_tile(self, request):
+        t0 = time.perf_counter()
+        self.stats['requests'] += 1
+
+        server = request.match_info.get('server', self.default_server)
+        zoom, x, y = [int(request.match_info[k]) for k in ('zoom', 'x', 'y')]
+        if zoom > 30 or x >= (1 << zoom) or y >= (1 << zoom):
+            raise web.HTTPBadRequest(text='Invalid tile %d/%d/%d' % (zoom, x, y))
+
+        cache = self.cache(server)
+        if cache is None:
+            self.stats['not_found'] += 1
+            raise web.HTTPNotFound(text='Unknown tile server %s' % server)
+
+        # SQLite access is blocking, keep it off the event loop
+        cached = await asyncio.get_running_loop().run_in_executor(None, cache.lookup, zoom, x, y)
+        data = None if cached is None else cached.data
+        if data is None and server in self.upstream:
+            data = await self.fetch_shared(server, zoom, x, y)
+        if data is None:
+            self.stats['not_found'] += 1
+            raise web.HTTPNotFound(text='Tile %s/%d/%d/%d not available' % (server, zoom, x, y))
+
+        self.stats['served'] += 1
+        self.seconds += time.perf_counter() - t0
+        return web.Response(body=data, content_type='image/png',
+            headers={'Cache-Control': 'public, max-age=%d' % CLIENT_MAX_AGE})
+
+    async def handle_stats(self, request):
+        stats = dict(self.stats)
+        stats.update(tiles_mb=dict((server, round(cache.total_bytes / 1e6, 1)) for server, cache in self.caches.items()),
+            average_ms=round(self.seconds / max(self.stats['served'], 1) * 1000, 3))
+        return web.json_response(stats)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Local tile server, serving tiles from an MBTiles tile cache')
+    parser.add_argument('--port', type=int, default=8700,
+        help='Port to listen on (default: %(default)d)')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+        help='Directory of the tile cache files, one per tile server id, see prewarm_tiles.py (default: %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=2048,
+        help='Maximum size in MB of each tile cache file, least recently used tiles are evicted (default: %(default)d)')
+    parser.add_argument('--upstream', nargs='+', action='append', metavar=('ID', 'URL'),
+        help='Tile server id followed by the URL templates ({zoom}/{x}/{y}) to fetch its missing tiles from, ' +
+             'can be given multiple times (default: only serve cached tiles)')
+    parser.add_argument('--default-server', default='osm',
+        help='Tile server id served under /{zoom}/{x}/{y}.png (default: %(default)s)')
+    parser.add_argument('--per-host', type=int, default=2,
+        help='Maximum number of concurrent requests per upstream host (default: %(default)d)')
+    options = parser.parse_args()
+
+    upstream = {}
+    for values in options.upstream or []:
+        assert len(values) >= 2, '--upstream needs a tile server id and at least one URL template'
+        upstream[values[0]] = values[1:]
+
+    server = TileServer(options.cache_dir, options.cache_size*1024*1024, upstream, options.default_server, options.per_host)
+
+    app = web.Application()
+    app.router.add_get(r'/{zoom:\d+}/{x:\d+}/{y:\d+}.png', server.handle_tile)
+    app.router.add_get(r'/{server:[A-Za-z0-9_.-]+}/{zoom:\d+}/{x:\d+}/{y:\d+}.png', server.handle_tile)
+    app.router.add_get('/stats', server.handle_stats)
+    app.on_startup.append(server.start)
+    app.on_cleanup.append(server.stop)
+
+    print('Serving tiles from %s' % options.cache_dir)
+    for server_id, urls in upstream.items():
+        print('Fetching missing %s tiles from %s' % (server_id, ', '.join(urls)))
+    print('Listening on http://localhost:%d/<server-id>/{zoom}/{x}/{y}.png' % options.port)
+    web.run_app(app, port=options.port, print=None)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Batch Kalman filter track predictor, as a possible improvement over the
+# linear extrapolation of the last received state in PlaneData.Update(),
+# which is poor for turning or decelerating planes (see the FAQ in the README).
+#
+# Each plane is tracked with an extended Kalman filter using a constant turn
+# rate and velocity (CTRV) motion model, all planes at once as NumPy arrays.
+# Horizontal state is the position, ground speed v, heading (clockwise from
+# north) and turn rate. The position is kept as lat/lon, with its covariance
+# in meters in the local east/north plane around it, so no map projection is
+# involved. Altitude and vertical rate use a separate constant velocity filter.
+# OpenSky provides position, velocity, heading, altitude and vertical rate,
+# the turn rate is only estimated.
+import math
+import numpy as np
+
+RADIUS_METERS = 6378136.98
+
+# Planes without updates for this long are re-initialized on their next update,
+# as for the MISSING state in PlaneData
+RESET_SECONDS = 120.0
+
+# Updates further than this (meters) from the predicted position are taken as a
+# new track (e.g. a position glitch), instead of corrupting the filter state
+RESET_DISTANCE = 10000.0
+
+def wrap_angle(a):
+    """Wrap radians to [-pi, pi["""
+    return (a + np.pi) % (2 * np.pi) - np.pi
+
+def ctrv_displacement(v, heading, turn_rate, dt):
+    """
+    East/north displacement (meters) after dt seconds at constant speed v (m/s)
+    and turn rate (radians/s), starting at heading (radians). All arrays.
+    """
+    h1 = heading + turn_rate * dt
+    turning = np.abs(turn_rate) > 1e-6
+    w = np.where(turning, turn_rate, 1.0)
+    dx = np.where(turning, v / w * (np.cos(heading) - np.cos(h1)), v * np.sin(heading) * dt)
+    dy = np.where(turning, v / w * (np.sin(h1) - np.sin(heading)), v * np.cos(heading) * dt)
+    return dx, dy
+
+def offset_latlon(lat, lon, dx, dy):
+    """Move lat/lon (degrees) by dx meters east and dy meters north"""
+    lat2 = lat + np.degrees(dy / RADIUS_METERS)
+    lon2 = lon + np.degrees(dx / (RADIUS_METERS * np.cos(np.radians(lat))))
+    return lat2, lon2
+
+
+class KalmanTracker:
+
+    """
+    Tracks planes identified by a key (e.g. the icao24 address). Per-plane
+    arrays are indexed by slot, see slots.
+
+    Noise parameters: measurement standard deviations for position (m), speed
+    (m/s), heading (degrees), altitude (m) and vertical rate (m/s), and process
+    noise standard deviations of acceleration (m/s^2), turn rate change
+    (degrees/s^2) and vertical acceleration (m/s^2).
+    """
+
+    # Horizontal state: east, north (both 0 around the lat/lon anchor), v, heading, turn rate
+    NX = 5
+
+    def __init__(self, position_sigma=30.0, speed_sigma=2.0, heading_sigma=2.0,
+            altitude_sigma=15.0, vertical_rate_sigma=1.0,
+            acceleration_sigma=1.0, turn_acceleration_sigma=0.3, vertical_acceleration_sigma=0.5,
+            capacity=1024):
+
+        self.R = np.diag([position_sigma**2, position_sigma**2, speed_sigma**2, math.radians(heading_sigma)**2])
+        self.Rz = np.diag([altitude_sigma**2, vertical_rate_sigma**2])
+        self.acceleration_sigma = acceleration_sigma
+        self.turn_acceleration_sigma = math.radians(turn_acceleration_sigma)
+        self.vertical_acceleration_sigma = vertical_acceleration_sigma
+
+        self.H = np.zeros((4, self.NX))
+        self.H[np.arange(4), np.arange(4)] = 1.0
+
+        self.slots = {}
+        self.count = 0
+        # Number of track (re)starts
+        self.resets = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        def grow(a, shape, fill=0.0):
+            b = np.full((capacity,) + shape, fill)
+            if a is not None:
+                b[:len(a)] = a
+            return b
+        old = getattr(self, 'lat', None) is not None
+        self.lat = grow(self.lat if old else None, ())
+        self.lon = grow(self.lon if old else None, ())
+        self.t = grow(self.t if old else None, (), -np.inf)
+        self.x = grow(self.x if old else None, (self.NX,))
+        self.P = grow(self.P if old else None, (self.NX, self.NX))
+        self.z = grow(self.z if old else None, (2,))
+        self.Pz = grow(self.Pz if old else None, (2, 2))
+        self.capacity = capacity
+
+    def slot_indices(self, keys):
+        """Slots for the given keys, allocating slots for new keys"""
+        idx = np.empty(len(keys), dtype=np.int64)
+        for i, key in enumerate(keys):
+            s = self.slots.get(key)
+            if s is None:
+                s = self.slots[key] = self.count
+                self.count += 1
+            idx[i] = s
+        if self.count > self.capacity:
+            self._allocate(max(self.count, 2 * self.capacity))
+        return idx
+
+    def _initialize(self, idx, t, lat, lon, v, heading, altitude, vertical_rate):
+        n = len(idx)
+        self.lat[idx] = lat
+        self.lon[idx] = lon
+        self.t[idx] = t
+        self.x[idx] = np.stack((np.zeros(n), np.zeros(n), v, heading, np.zeros(n)), axis=1)
+        P = np.zeros((n, self.NX, self.NX))
+        P[:, np.arange(4), np.arange(4)] = np.diag(self.R)
+        # Initial turn rate uncertainty of 3 degrees/s
+        P[:, 4, 4] = math.radians(3.0)**2
+        self.P[idx] = P
+        self.z[idx] = np.stack((altitude, vertical_rate), axis=1)
+        self.Pz[idx] = self.Rz
+
+    def _predict(self, idx, t):
+        """Propagate the state of the planes in idx to times t"""
+        dt = t - self.t[idx]
+        x = self.x[idx]
+        v, h, w = x[:,2], x[:,3], x[:,4]
+        n = len(idx)
+
+        dx, dy = ctrv_displacement(v, h, w, dt)
+        lat, lon = offset_latlon(self.lat[idx], self.lon[idx], dx, dy)
+
+        # Jacobian of the displacement w.r.t. (v, heading, turn rate)
+        h1 = h + w * dt
+        turning = np.abs(w) > 1e-6
+        ws = np.where(turning, w, 1.0)
+        s0, c0, s1, c1 = np.sin(h), np.cos(h), np.sin(h1), np.cos(h1)
+        F = np.zeros((n, self.NX, self.NX))
+        F[:, np.arange(self.NX), np.arange(self.NX)] = 1.0
+        F[:,0,2] = np.where(turning, (c0 - c1) / ws, s0 * dt)
+        F[:,0,3] = np.where(turning, v / ws * (s1 - s0), v * c0 * dt)
+        F[:,0,4] = np.where(turning, -v / ws**2 * (c0 - c1) + v / ws * s1 * dt, v * c0 * dt*dt / 2)
+        F[:,1,2] = np.where(turning, (s1 - s0) / ws, c0 * dt)
+        F[:,1,3] = np.where(turning, v / ws * (c1 - c0), -v * s0 * dt)
+        F[:,1,4] = np.where(turning, -v / ws**2 * (s1 - s0) + v / ws * c1 * dt, -v * s0 * dt*dt / 2)
+        F[:,3,4] = dt
+
+        # Process noise from random acceleration and turn rate change, per component
+        qa = self.acceleration_sigma**2
+        qw = self.turn_acceleration_sigma**2
+        Q = np.zeros((n, self.NX, self.NX))
+        Q[:,0,0] = Q[:,1,1] = qa * dt**4 / 4
+        Q[:,2,2] = qa * dt**2
+        Q[:,3,3] = qw * dt**4 / 4
+        Q[:,3,4] = Q[:,4,3] = qw * dt**3 / 2
+        Q[:,4,4] = qw * dt**2
+
+        self.lat[idx] = lat
+        self.lon[idx] = lon
+        x[:,3] = wrap_angle(h1)
+        self.x[idx] = x
+        self.P[idx] = F @ self.P[idx] @ F.transpose(0, 2, 1) + Q
+
+        # Vertical, constant velocity
+        Fz = np.zeros((n, 2, 2))
+        Fz[:,0,0] = Fz[:,1,1] = 1.0
+        Fz[:,0,1] = dt
+        qz = self.vertical_acceleration_sigma**2
+        Qz = np.empty((n, 2, 2))
+        Qz[:,0,0] = qz * dt**4 / 4
+        Qz[:,0,1] = Qz[:,1,0] = qz * dt**3 / 2
+        Qz[:,1,1] = qz * dt**2
+        z = self.z[idx]
+        self.z[idx] = np.stack((z[:,0] + z[:,1] * dt, z[:,1]), axis=1)
+        self.Pz[idx] = Fz @ self.Pz[idx] @ Fz.transpose(0, 2, 1) + Qz
+
+        self.t[idx] = t
+
+    def _position_innovation(self, idx, lat, lon):
+        """East/north offset in meters of lat/lon from the current positions"""
+        return (np.radians(lon - self.lon[idx]) * RADIUS_METERS * np.cos(np.radians(self.lat[idx])),
+            np.radians(lat - self.lat[idx]) * RADIUS_METERS)
+
+    def _correct(self, idx, lat, lon, v, heading, altitude, vertical_rate):
+        # Innovation, position in meters around the predicted position
+        east, north = self._position_innovation(idx, lat, lon)
+        y = np.stack((
+            east, north,
+            v - self.x[idx,2],
+            wrap_angle(heading - self.x[idx,3])
+        ), axis=1)
+
+        P = self.P[idx]
+        H = self.H
+        S = H @ P @ H.T + self.R
+        K = np.linalg.solve(S, H @ P).transpose(0, 2, 1)     # P H^T S^-1, as S is symmetric
+        dx = np.einsum('nij,nj->ni', K, y)
+        self.P[idx] = (np.identity(self.NX) - K @ H) @ P
+
+        # Move the anchor by the position correction
+        self.lat[idx], self.lon[idx] = offset_latlon(self.lat[idx], self.lon[idx], dx[:,0], dx[:,1])
+        x = self.x[idx] + dx
+        x[:,0] = x[:,1] = 0.0
+        x[:,3] = wrap_angle(x[:,3])
+        self.x[idx] = x
+
+        # Vertical, both components measured
+        Pz = self.Pz[idx]
+        yz = np.stack((altitude, vertical_rate), axis=1) - self.z[idx]
+        Kz = np.linalg.solve(Pz + self.Rz, Pz).transpose(0, 2, 1)
+        self.z[idx] = self.z[idx] + np.einsum('nij,nj->ni', Kz, yz)
+        self.Pz[idx] = (np.identity(2) - Kz) @ Pz
+
+    def update(self, keys, t, lat, lon, v, heading, altitude, vertical_rate):
+        """
+        Process new measurements for the planes with the given keys, at times t
+        (seconds, per plane). Headings are in degrees, as in the OpenSky data,
+        other units are meters and seconds. All values need to be finite.
+        """
+        idx = self.slot_indices(keys)
+        t, lat, lon, v, heading, altitude, vertical_rate = [np.asarray(a, dtype=np.float64)
+            for a in (t, lat, lon, v, heading, altitude, vertical_rate)]
+        heading = np.radians(heading)
+
+        new = (t - self.t[idx]) > RESET_SECONDS
+        old = np.nonzero(~new)[0]
+        if len(old) > 0:
+            self._predict(idx[old], t[old])
+            east, north = self._position_innovation(idx[old], lat[old], lon[old])
+            jump = np.hypot(east, north) > RESET_DISTANCE
+            new[old[jump]] = True
+            old = old[~jump]
+            self._correct(idx[old], lat[old], lon[old], v[old], heading[old], altitude[old], vertical_rate[old])
+
+        if np.any(new):
+            self._initialize(idx[new], t[new], lat[new], lon[new], v[new], heading[new],
+                altitude[new], vertical_rate[new])
+
+        self.resets += np.count_nonzero(new)
+
+    def predict(self, keys, t):
+        """
+        Predicted (lat, lon, altitude) at times t of the planes with the given keys,
+        without changing their state. Unknown keys give NaN.
+        """
+        idx = np.array([self.slots.get(key, -1) for key in keys], dtype=np.int64)
+        known = idx >= 0
+        idx = np.where(known, idx, 0)
+
+        dt = np.where(known, np.asarray(t, dtype=np.float64) - self.t[idx], 0.0)
+        x = self.x[idx]
+        dx, dy = ctrv_displacement(x[:,2], x[:,3], x[:,4], dt)
+        lat, lon = offset_latlon(self.lat[idx], self.lon[idx], dx, dy)
+        altitude = self.z[idx,0] + self.z[idx,1] * dt
+
+        nan = np.where(known, 1.0, np.nan)
+        return lat * nan, lon * nan, altitude * nan
+
+    def turn_rate(self, keys):
+        """Estimated turn rates in degrees/s"""
+        idx = np.array([self.slots[key] for key in keys], dtype=np.int64)
+        return np.degrees(self.x[idx,4])
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Simplification of plane track histories, as drawn on the map with
+# map_show_track_lines. The app keeps every received position of a plane in
+# PlaneData.track_points/map_track_points (until the plane is on the ground)
+# and draws all of them each frame. Here tracks are limited to a sliding
+# window and simplified with Douglas-Peucker or Visvalingam-Whyatt, with the
+# tolerance given in map kilometers (positions as in map_track_points, i.e.
+# map x/y plus the altitude in km).
+import math, heapq
+import numpy as np
+
+METHODS = ['douglas-peucker', 'visvalingam']
+
+# Histories of planes without updates for this long are dropped
+EXPIRE_SECONDS = 300
+
+def segment_distances(points, a, b):
+    """Distances of points (N x D) to the line segment from a to b"""
+    ab = b - a
+    length2 = np.dot(ab, ab)
+    if length2 == 0.0:
+        return np.sqrt(((points - a)**2).sum(axis=1))
+    f = np.clip(((points - a) @ ab) / length2, 0.0, 1.0)
+    d = points - (a + f[:,None] * ab)
+    return np.sqrt((d**2).sum(axis=1))
+
+def douglas_peucker(points, tolerance):
+    """
+    Returns a boolean mask of the points (N x D array) to keep, such that no
+    removed point is further than tolerance from the simplified polyline.
+    The first and last point are always kept.
+    """
+    n = len(points)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    keep[0] = keep[-1] = True
+
+    stack = [(0, n - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j <= i + 1:
+            continue
+        d = segment_distances(points[i+1:j], points[i], points[j])
+        k = int(np.argmax(d))
+        if d[k] > tolerance:
+            k += i + 1
+            keep[k] = True
+            stack.append((i, k))
+            stack.append((k, j))
+    return keep
+
+def triangle_area(a, b, c):
+    """Area of the triangle a, b, c (sequences of 2 or 3 floats)"""
+    ab = [q - p for p, q in zip(a, b)]
+    ac = [q - p for p, q in zip(a, c)]
+    if len(ab) == 2:
+        return 0.5 * abs(ab[0] * ac[1] - ab[1] * ac[0])
+    x = ab[1] * ac[2] - ab[2] * ac[1]
+    y = ab[2] * ac[0] - ab[0] * ac[2]
+    z = ab[0] * ac[1] - ab[1] * ac[0]
+    return 0.5 * math.sqrt(x*x + y*y + z*z)
+
+def visvalingam(points, tolerance):
+    """
+    Returns a boolean mask of the points (N x D array) to keep. Points are
+    removed in order of the (effective) area of the triangle with their
+    neighbors, as long as the removed points stay within tolerance of the
+    simplified polyline. The first and last point are always kept.
+    """
+    n = len(points)
+    keep = np.ones(n, dtype=bool)
+    if n <= 2:
+        return keep
+
+    p = points.tolist()
+    prev = list(range(-1, n - 1))
+    next = list(range(1, n + 1))
+    area = [math.inf] * n
+    heap = []
+    for i in range(1, n - 1):
+        area[i] = triangle_area(p[i-1], p[i], p[i+1])
+        heap.append((area[i], i))
+    heapq.heapify(heap)
+
+    while heap:
+        a, i = heapq.heappop(heap)
+        if not keep[i] or a != area[i]:
+            # Removed, or area changed since pushed
+            continue
+        i0, i1 = prev[i], next[i]
+        # All points between the neighbors have been removed, check them against the new segment
+        if segment_distances(points[i0+1:i1], points[i0], points[i1]).max() > tolerance:
+            continue
+        keep[i] = False
+        next[i0] = i1
+        prev[i1] = i0
+        # Neighbors get at least the removed area, so the removal order stays monotonic
+        for j in (i0, i1):
+            if 0 < j < n - 1:
+                area[j] = max(triangle_area(p[prev[j]], p[j], p[next[j]]), a)
+                heapq.heappush(heap, (area[j], j))
+    return keep
+
+def max_deviation(points, keep):
+    """Largest distance of a removed point to the simplified polyline segment replacing it"""
+    points = np.asarray(points, dtype=np.float64)
+    idx = np.nonzero(keep)[0]
+    d = 0.0
+    for i, j in zip(idx[:-1], idx[1:]):
+        if j > i + 1:
+            d = max(d, segment_distances(points[i+1:j], points[i], points[j]).max())
+    return d
+
+def simplify(points, tolerance, method='douglas-peucker'):
+    """Boolean mask of the points to keep, see douglas_peucker() and visvalingam()"""
+    points = np.asarray(points, dtype=np.float64)
+    if method == 'douglas-peucker':
+        return douglas_peucker(points, tolerance)
+    elif method == 'visvalingam':
+        return visvalingam(points, tolerance)
+    raise ValueError('Unknown simplification method %s' % method)
+
+
+class TrackHistory:
+
+    """
+    Positions of a single plane, as PlaneData.track_points: added for each update
+    with a new time_position, and cleared when the plane is on the ground. Only
+    points of the last max_age seconds are kept (if set).
+    """
+
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self.callsign = ''
+        self.time = []
+        self.lat = []
+        self.lon = []
+        self.altitude = []
+        self.heading = []
+
+    def __len__(self):
+        return len(self.time)
+
+    def clear(self):
+        for values in (self.time, self.lat, self.lon, self.altitude, self.heading):
+            del values[:]
+
+    def add(self, time, lat, lon, altitude, heading, on_ground):
+        if on_ground:
+            self.clear()
+            return
+        self.time.append(time)
+        self.lat.append(lat)
+        self.lon.append(lon)
+        self.altitude.append(altitude)
+        self.heading.append(heading)
+
+        if self.max_age is not None:
+            start = 0
+            while time - self.time[start] > self.max_age:
+                start += 1
+            if start > 0:
+                for values in (self.time, self.lat, self.lon, self.altitude, self.heading):
+                    del values[:start]
+
+    def map_points(self, map):
+        """Points as in PlaneData.map_track_points, N x 3 in km (see extrapolation.MapProjection)"""
+        x, y = map.project(np.array(self.lon, dtype=np.float64), np.array(self.lat, dtype=np.float64))
+        altitude = np.nan_to_num(np.array(self.altitude, dtype=np.float64)) / 1000.0
+        return np.stack((x, y, altitude), axis=-1)
+
+    def simplified(self, map, tolerance, method='douglas-peucker', max_points=None):
+        """
+        Indices of the points to draw: simplified with the given tolerance (map km)
+        and, if set, only the last max_points of those
+        """
+        if tolerance > 0:
+            idx = np.nonzero(simplify(self.map_points(map), tolerance, method))[0]
+        else:
+            idx = np.arange(len(self))
+        if max_points is not None and len(idx) > max_points:
+            idx = idx[-max_points:]
+        return idx
+
+
+class TrackStore:
+
+    """Track histories of all planes, keyed on icao24 (as an integer)"""
+
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self.tracks = {}
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def add(self, columns):
+        """Add a snapshot, as a dict of column arrays (see statearchive.states_to_columns())"""
+        latest = 0
+        for i in range(len(columns['icao24'])):
+            t = int(columns['time_position'][i])
+            lat, lon = float(columns['lat'][i]), float(columns['lon'][i])
+            if t == 0 or not (np.isfinite(lat) and np.isfinite(lon)):
+                continue
+            key = int(columns['icao24'][i])
+            track = self.tracks.get(key)
+            if track is None:
+                track = self.tracks[key] = TrackHistory(self.max_age)
+            elif len(track) > 0 and t <= track.time[-1]:
+                continue
+            track.callsign = columns['callsign'][i].decode('ascii', 'replace')
+            # The map altitude, field 13 (geo_altitude), see extrapolation.py
+            track.add(t, lat, lon, float(columns['geo_altitude'][i]), float(columns['heading'][i]),
+                bool(columns['on_ground'][i]))
+            latest = max(latest, t)
+
+        # Drop planes gone for a while
+        for key in [k for k, track in self.tracks.items() if len(track) == 0 or latest - track.time[-1] > EXPIRE_SECONDS]:
+            del self.tracks[key]
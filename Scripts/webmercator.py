@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Web Mercator (EPSG:3857) and slippy-map tile math, shared by the scripts.
+# Based on info and code from https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
+#
+# The scalar functions are the ones originally in make_osm_map.py, and match
+# OSMTiles.CoordinateToTile/TileNWCorner and Projection.epsg4326_to_epsg3857
+# in the app. The batch functions do the same on NumPy arrays of lat/lon/zoom,
+# in float64 by default. Passing dtype=numpy.float32 reproduces the
+# single-precision computations done in the app, see bench_webmercator.py
+# for a comparison of the two.
+import math
+import numpy as np
+
+# Same value as Projection.RADIUS_METERS
+RADIUS_METERS = 6378136.98
+# Circumference, i.e. the EPSG:3857 X range
+RANGE = RADIUS_METERS * math.pi * 2.0
+
+TILE_SIZE = 256
+
+def coordinate_to_tile(lat_deg, lon_deg, zoom):
+    """Return tile number that contains given lat/lon coordinate"""
+    lat_rad = math.radians(lat_deg)
+    n = 2.0 ** zoom
+    xtile = int((lon_deg + 180.0) / 360.0 * n)
+    ytile = int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
+    return (xtile, ytile)
+
+def tile_nw_corner(xtile, ytile, zoom):
+    """
+    Convert tile number and zoom to lat/lon coordinate of NW-corner of tile
+
+    Use the function with xtile+1 and/or ytile+1 to get the other corners.
+    With xtile+0.5 & ytile+0.5 it will return the center of the tile.
+    """
+    n = 2.0 ** zoom
+    lon_deg = xtile / n * 360.0 - 180.0
+    lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * ytile / n)))
+    lat_deg = math.degrees(lat_rad)
+    return (lat_deg, lon_deg)
+
+def epsg4326_to_epsg3857(lon, lat):
+    """
+    WGS84 (EPSG:4326) -> Web Mercator (OSM, EPSG:3857)
+    EPSG:3857 has +X to the right, +Y up, with Y=0 at the equator.
+    Output units are meters. Note the lon, lat argument order.
+    """
+    x = lon * RANGE / 360.0
+
+    # Same clamping as in Projection.cs
+    if lat > 86.0:
+        y = RANGE
+    elif lat < -86.0:
+        y = -RANGE
+    else:
+        y = math.radians(lat)
+        y = math.log(math.tan(y) + (1.0 / math.cos(y)))
+        y *= RADIUS_METERS
+
+    return (x, y)
+
+def epsg3857_to_epsg4326(x, y):
+    """Web Mercator (EPSG:3857) -> WGS84 (EPSG:4326), returns (lon, lat)"""
+    lon = x / RANGE * 360.0
+    lat = math.degrees(math.atan(math.sinh(y / RADIUS_METERS)))
+    return (lon, lat)
+
+#
+# Batch versions
+#
+
+def _asarrays(dtype, *values):
+    return [np.asarray(v, dtype=dtype) for v in values]
+
+def coordinates_to_tile_positions(lat_deg, lon_deg, zoom, dtype=np.float64):
+    """
+    Return fractional tile positions (xtile, ytile) for arrays of lat/lon
+    coordinates. zoom can be a single value or an array. The integer part
+    of the positions is the tile number, the fractional part the position
+    within the tile.
+    """
+    dt = np.dtype(dtype)
+    lat_deg, lon_deg = _asarrays(dt, lat_deg, lon_deg)
+    pi = dt.type(math.pi)
+
+    lat_rad = lat_deg / dt.type(180) * pi
+    n = np.ldexp(dt.type(1), np.asarray(zoom, dtype=np.int32)).astype(dt)
+    xtile = (lon_deg + dt.type(180)) / dt.type(360) * n
+    ytile = (dt.type(1) - np.log(np.tan(lat_rad) + (dt.type(1) / np.cos(lat_rad))) / pi) / dt.type(2) * n
+    return (xtile, ytile)
+
+def coordinates_to_tiles(lat_deg, lon_deg, zoom, dtype=np.float64):
+    """Batch version of coordinate_to_tile(), returns integer arrays (xtile, ytile)"""
+    xtile, ytile = coordinates_to_tile_positions(lat_deg, lon_deg, zoom, dtype)
+    # Truncation towards zero, like the int() and (int) casts
+    return (xtile.astype(np.int64), ytile.astype(np.int64))
+
+def tiles_nw_corners(xtile, ytile, zoom, dtype=np.float64):
+    """Batch version of tile_nw_corner(), returns arrays (lat_deg, lon_deg)"""
+    dt = np.dtype(dtype)
+    xtile, ytile = _asarrays(dt, xtile, ytile)
+    pi = dt.type(math.pi)
+
+    n = np.ldexp(dt.type(1), np.asarray(zoom, dtype=np.int32)).astype(dt)
+    lon_deg = xtile / n * dt.type(360) - dt.type(180)
+    lat_rad = np.arctan(np.sinh(pi * (dt.type(1) - dt.type(2) * ytile / n)))
+    lat_deg = lat_rad / pi * dt.type(180)
+    return (lat_deg, lon_deg)
+
+def actual_map_extent(lat_range, lon_range, zoom, dtype=np.float32):
+    """
+    Tiles covering a map, as OSMTiles.ComputeActualMapExtent(), i.e. the tiles
+    the app requests for a tile_server map. Computed in float32 by default, so
+    tile boundary cases come out as in the app (make_osm_map.py uses float64).
+    Returns ((min_i, max_i, min_j, max_j), (min_lat, max_lat, min_lon, max_lon)),
+    the latter being the extent of the tiles.
+    """
+    dt = np.dtype(dtype)
+    f = dt.type
+    q_min_lat, q_max_lat = f(lat_range[0]), f(lat_range[1])
+    q_min_lon, q_max_lon = f(lon_range[0]), f(lon_range[1])
+    q_center_lat = f(0.5) * (q_min_lat + q_max_lat)
+    q_center_lon = f(0.5) * (q_min_lon + q_max_lon)
+
+    i, j = coordinates_to_tiles([q_center_lat, q_center_lat, q_min_lat, q_max_lat],
+        [q_min_lon, q_max_lon, q_center_lon, q_center_lon], zoom, dt)
+    min_i, max_i, max_j, min_j = int(i[0]), int(i[1]), int(j[2]), int(j[3])
+
+    lat, lon = tiles_nw_corners([min_i, max_i + 1], [min_j, max_j + 1], zoom, dt)
+    return ((min_i, max_i, min_j, max_j), (float(lat[1]), float(lat[0]), float(lon[0]), float(lon[1])))
+
+def epsg4326_to_epsg3857_batch(lon, lat, dtype=np.float64):
+    """Batch version of epsg4326_to_epsg3857(), returns arrays (x, y) in meters"""
+    dt = np.dtype(dtype)
+    lon, lat = _asarrays(dt, lon, lat)
+
+    # Constants derived in the same order as in Projection.cs
+    radius = dt.type(RADIUS_METERS)
+    rng = radius * dt.type(math.pi) * dt.type(2)
+    lon_to_x = rng / dt.type(360)
+    radians_over_degrees = dt.type(math.pi) / dt.type(180)
+
+    x = lon * lon_to_x
+
+    lat_rad = lat * radians_over_degrees
+    with np.errstate(invalid='ignore', divide='ignore'):
+        y = np.log(np.tan(lat_rad) + (dt.type(1) / np.cos(lat_rad))) * radius
+    y = np.where(lat > 86.0, rng, y)
+    y = np.where(lat < -86.0, -rng, y)
+
+    return (x, y)
+
+def epsg3857_to_epsg4326_batch(x, y, dtype=np.float64):
+    """Batch version of epsg3857_to_epsg4326(), returns arrays (lon, lat)"""
+    dt = np.dtype(dtype)
+    x, y = _asarrays(dt, x, y)
+    lon = x / dt.type(RANGE) * dt.type(360)
+    lat = np.degrees(np.arctan(np.sinh(y / dt.type(RADIUS_METERS))))
+    return (lon, lat)
+
+def pixel_size(zoom, lat_deg=0.0):
+    """Size in meters of a tile pixel at the given zoom level and latitude"""
+    return RANGE * math.cos(math.radians(lat_deg)) / (TILE_SIZE * 2 ** zoom)